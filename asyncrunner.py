@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# -*- Coding: UTF-8 -*-
+"""
+asyncio runner for the external commands of the pipeline.
+Several commands, e.g. inserttiles.py or the master frames phase of the
+recipe, are supervised from one event loop. The number of commands running
+at once is limited, each command may have a timeout and can be cancelled,
+and its stdout and stderr are sent, line by line, to the logger and to an
+optional log file.
+The reductions of the tiles are not run here: the TileScheduler admits
+each tile by the memory of the process trees already running, read from
+/proc, and not only by their number.
+"""
+import os
+import time
+import signal
+import asyncio
+import logging
+
+# Time, in seconds, between SIGTERM and SIGKILL when a command is stopped.
+KILL_GRACE_SECONDS = 10
+
+# Maximum length, in bytes, of a line of output of a command.
+LINE_LIMIT = 1024 * 1024
+
+
+class CommandResult(object):
+    """
+    The result of a command run by the CommandRunner.
+    Attr:
+        name: Name of the command
+        command: Shell command
+    """
+
+    def __init__(self, name, command):
+        self.name = name
+        self.command = command
+        self.returncode = None
+        self.start_time = None
+        self.end_time = None
+        self.timed_out = False
+        self.cancelled = False
+
+    @property
+    def ok(self):
+        """
+        Return True if the command ended with exit status 0.
+        """
+        return self.returncode == 0
+
+    @property
+    def duration(self):
+        """
+        Return the wall-clock time of the command, in seconds.
+        """
+        if self.start_time is None or self.end_time is None:
+            return 0.0
+        return self.end_time - self.start_time
+
+
+class CommandRunner(object):
+    """
+    Run shell commands concurrently in an asyncio event loop.
+    Optional Attr:
+        max_concurrent: Maximum number of commands running at once
+        timeout: Default timeout, in seconds, of each command. None waits
+                 forever.
+        logger: logging.Logger that receives the output of the commands
+        extra: extra dictionary passed to the logger
+    """
+
+    def __init__(self, max_concurrent=4, timeout=None, logger=None,
+                 extra=None):
+        self._max_concurrent = max_concurrent
+        self._timeout = timeout
+        self._logger = logger
+        self._extra = extra or {}
+        self._semaphore = None
+        self._tasks = {}
+        self._processes = set()
+
+    def _log(self, level, info):
+        if self._logger is not None:
+            self._logger.log(level, info, extra=self._extra)
+        else:
+            print(info)
+
+    async def _stream(self, name, process, stream, level, fout):
+        while True:
+            try:
+                line = await stream.readline()
+            except ValueError:
+                # A line longer than LINE_LIMIT. The pipe is not read
+                # anymore, so the command is stopped instead of blocking.
+                self._log(logging.ERROR,
+                          "[{0}] output line longer than {1} bytes, "
+                          "stopping the command".format(name, LINE_LIMIT))
+                await self._stop(process)
+                break
+            if not line:
+                break
+            text = line.decode(errors='replace').rstrip("\n")
+            self._log(level, "[{0}] {1}".format(name, text))
+            if fout is not None:
+                fout.write(text + "\n")
+                fout.flush()
+
+    async def _stop(self, process):
+        """
+        Terminate the process group of a command, and kill it if it does
+        not end after the grace time.
+        """
+        if process.returncode is not None:
+            return
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+        except OSError:
+            return
+        try:
+            await asyncio.wait_for(process.wait(), KILL_GRACE_SECONDS)
+        except asyncio.TimeoutError:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            await process.wait()
+
+    async def _execute(self, result, timeout, log_file):
+        fout = None
+        if log_file is not None:
+            fout = open(log_file, 'a')
+        try:
+            # A new session, so the whole process tree can be stopped.
+            process = await asyncio.create_subprocess_shell(
+                result.command,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                start_new_session=True,
+                limit=LINE_LIMIT)
+            self._processes.add(process)
+            result.start_time = time.time()
+            self._log(logging.INFO, "Starting {0}: {1}".format(
+                result.name, result.command))
+            streams = asyncio.gather(
+                self._stream(result.name, process, process.stdout,
+                             logging.INFO, fout),
+                self._stream(result.name, process, process.stderr,
+                             logging.WARNING, fout))
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(streams, process.wait()), timeout)
+            except asyncio.TimeoutError:
+                result.timed_out = True
+                await self._stop(process)
+            except asyncio.CancelledError:
+                result.cancelled = True
+                await self._stop(process)
+            result.returncode = process.returncode
+            result.end_time = time.time()
+            self._processes.discard(process)
+        finally:
+            if fout is not None:
+                fout.close()
+
+    async def run_command(self, name, command, timeout=None, log_file=None):
+        """
+        Run one command, waiting for a free slot, and return its
+        CommandResult. If the command does not end before the timeout, or
+        is cancelled, its process tree is stopped.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_concurrent)
+        if timeout is None:
+            timeout = self._timeout
+
+        result = CommandResult(name, command)
+        try:
+            async with self._semaphore:
+                await self._execute(result, timeout, log_file)
+        except asyncio.CancelledError:
+            result.cancelled = True
+
+        if result.timed_out:
+            self._log(logging.ERROR, "{0} stopped after {1}s timeout".format(
+                name, timeout))
+        elif result.cancelled:
+            self._log(logging.WARNING, "{} was cancelled".format(name))
+        elif result.ok:
+            self._log(logging.INFO, "{0} done in {1:.0f}s".format(
+                name, result.duration))
+        else:
+            self._log(logging.ERROR, "{0} failed with exit status {1}".format(
+                name, result.returncode))
+        return result
+
+    def submit(self, name, command, timeout=None, log_file=None):
+        """
+        Schedule a command in the running event loop and return its task.
+        """
+        if name in self._tasks and not self._tasks[name].done():
+            raise NameError("Command {} is already running".format(name))
+        task = asyncio.ensure_future(
+            self.run_command(name, command, timeout, log_file))
+        self._tasks[name] = task
+        return task
+
+    def cancel(self, name=None):
+        """
+        Cancel a command by its name, or all commands if name is None.
+        """
+        names = list(self._tasks) if name is None else [name]
+        for key in names:
+            task = self._tasks.get(key)
+            if task is not None and not task.done():
+                task.cancel()
+
+    async def gather(self):
+        """
+        Wait for all submitted commands, and return their results in the
+        order they were submitted.
+        """
+        tasks = list(self._tasks.values())
+        results = await asyncio.gather(*tasks)
+        self._tasks = {}
+        return results
+
+    def _kill_all(self):
+        """
+        Kill the process groups of the commands still running.
+        """
+        for process in self._processes:
+            if process.returncode is None:
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+        self._processes = set()
+
+    def run(self, commands, timeout=None, log_file=None):
+        """
+        Run a list of (name, command) in a new event loop, and return their
+        results in the same order. Blocks until all commands are done, so
+        the caller, e.g. the sched loop of the bot, waits for them.
+        If the run is interrupted, the commands are stopped before the
+        loop is closed: they run in their own sessions, and do not get the
+        SIGINT of the terminal.
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            asyncio.set_event_loop(loop)
+            self._semaphore = None
+            for name, command in commands:
+                self.submit(name, command, timeout, log_file)
+            return loop.run_until_complete(self.gather())
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            self.cancel()
+            loop.run_until_complete(asyncio.gather(
+                *self._tasks.values(), return_exceptions=True))
+            # A task interrupted in its own step does not stop its command.
+            self._kill_all()
+            self._tasks = {}
+            raise
+        finally:
+            self._semaphore = None
+            asyncio.set_event_loop(None)
+            loop.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    PARSER = argparse.ArgumentParser(
+        description="Run shell commands concurrently, streaming their output")
+
+    PARSER.add_argument("commands",
+                        help="Shell commands",
+                        type=str,
+                        nargs='+')
+
+    PARSER.add_argument("-j",
+                        help="Maximum number of commands running at once",
+                        type=int,
+                        default=4)
+
+    PARSER.add_argument("-t",
+                        help="Timeout of each command, in seconds",
+                        type=float,
+                        default=None)
+
+    ARGS = PARSER.parse_args()
+
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(message)s",
+                        level=logging.INFO)
+    RUNNER = CommandRunner(ARGS.j, ARGS.t, logger=logging.getLogger())
+    RESULTS = RUNNER.run([("cmd{}".format(i), command)
+                          for i, command in enumerate(ARGS.commands)])
+    if not all(result.ok for result in RESULTS):
+        raise SystemExit(1)
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- Coding: UTF-8 -*-
+"""
+Benchmark of search_images_bulk against the loop of search_images over
+the filters, on a synthetic sqlite table. The time and the number of
+queries sent to the database are reported; with a remote database, each
+query also costs one network round trip.
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from config import FILTERS
+from model import db
+from searchimages import search_images, search_images_bulk
+import synthetic
+
+FRAMETYPES = ("BIAS", "FLAS", "SCIE")
+
+
+def per_filter_loop(start_date, end_date):
+    """
+    Return the images with one search_images call by frame type and
+    filter, as the callers did before search_images_bulk.
+    """
+    images = {("BIAS", None): search_images(start_date, end_date, "BIAS")}
+    for frametype in FRAMETYPES[1:]:
+        for filt in FILTERS:
+            images[(frametype, filt)] = search_images(start_date, end_date,
+                                                      frametype, filt)
+    return images
+
+
+def _timed(function, *args):
+    # pyDAL keeps the last queries in db._timings.
+    del db._timings[:]
+    t0 = time.time()
+    result = function(*args)
+    elapsed = time.time() - t0
+    return result, elapsed, len(db._timings)
+
+
+def run(sizes, ndays, window, repeat, work_dir):
+    """
+    Run the benchmark for each number of rows in sizes, and return the
+    results.
+    """
+    results = []
+    end_date = date.today()
+    start_date = end_date - timedelta(days=window)
+    for nrows in sizes:
+        filename = os.path.join(work_dir, "bench_{}.sqlite".format(nrows))
+        synthetic.create_database(filename, nrows, ndays=ndays,
+                                  end_date=end_date)
+        # Warm the dimension cache, as in a running bot.
+        search_images(start_date, end_date, "BIAS")
+
+        loop_times = []
+        bulk_times = []
+        for _ in range(repeat):
+            loop, loop_time, loop_queries = _timed(per_filter_loop,
+                                                   start_date, end_date)
+            bulk, bulk_time, bulk_queries = _timed(search_images_bulk,
+                                                   start_date, end_date,
+                                                   FRAMETYPES, FILTERS)
+            loop_times.append(loop_time)
+            bulk_times.append(bulk_time)
+
+        loop = dict((key, value) for key, value in loop.items() if value)
+        assert dict((key, sorted(value)) for key, value in loop.items()) == \
+            dict((key, sorted(value)) for key, value in bulk.items())
+
+        result = {'nrows': nrows,
+                  'window_days': window,
+                  'nimages': sum(len(value) for value in bulk.values()),
+                  'loop_seconds': min(loop_times),
+                  'loop_queries': loop_queries,
+                  'bulk_seconds': min(bulk_times),
+                  'bulk_queries': bulk_queries}
+        results.append(result)
+        print("{nrows:>10d} rows {nimages:>8d} images  loop {loop_seconds:.4f}s "
+              "({loop_queries} queries)  bulk {bulk_seconds:.4f}s "
+              "({bulk_queries} queries)".format(**result))
+        db.close()
+        os.remove(filename)
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    PARSER = argparse.ArgumentParser(
+        description="Benchmark of search_images_bulk")
+
+    PARSER.add_argument("-n",
+                        help="Number of rows in t80oa",
+                        type=int,
+                        nargs='+',
+                        default=[10000, 100000, 1000000])
+
+    PARSER.add_argument("-d",
+                        help="Number of days with synthetic images",
+                        type=int,
+                        default=60)
+
+    PARSER.add_argument("-w",
+                        help="Size, in days, of the searched window",
+                        type=int,
+                        default=1)
+
+    PARSER.add_argument("-r",
+                        help="Number of repetitions",
+                        type=int,
+                        default=3)
+
+    PARSER.add_argument("-o",
+                        help="Save the results in a JSON file",
+                        type=str,
+                        default=None)
+
+    ARGS = PARSER.parse_args()
+    WORK_DIR = tempfile.mkdtemp()
+    RESULTS = run(ARGS.n, ARGS.d, ARGS.w, ARGS.r, WORK_DIR)
+    os.rmdir(WORK_DIR)
+    if ARGS.o is not None:
+        with open(ARGS.o, 'w') as fout:
+            json.dump(RESULTS, fout, indent=2)
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- Coding: UTF-8 -*-
+"""
+Benchmark of the query and tile-discovery hot paths of the reduction bot.
+For each data size, a synthetic sqlite stand-in of the Pipeline Data Base
+is created, with the raw frames of the science images of the last night,
+and search_images, count_images, has_all_flats, has_all_bias and
+_gen_tiles_info are timed. The results are saved as JSON, and can be
+compared with the results of a previous run.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import tempfile
+import subprocess
+from datetime import date, datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from config import FILTERS
+from model import db
+from searchimages import search_images, count_images
+from headerscan import HeaderScanner
+from reductionbott80s import ReductionBotT80S
+import synthetic
+
+
+def _git_revision():
+    try:
+        output = subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                         cwd=ROOT,
+                                         stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode().strip()
+
+
+def _timings(function, repeat):
+    """
+    Return the time, in seconds, of the first call of function, when the
+    caches are cold, and the minimum and the median of the repetitions.
+    """
+    times = []
+    for _ in range(repeat):
+        t0 = time.time()
+        function()
+        times.append(time.time() - t0)
+    ordered = sorted(times)
+    return {'first': times[0],
+            'min': ordered[0],
+            'median': ordered[len(ordered) // 2]}
+
+
+def make_bot(work_dir, raw_dir, tile_source):
+    """
+    Return a ReductionBotT80S that reads the raw frames of raw_dir. The
+    header index of the bot is kept, so the first _gen_tiles_info reads the
+    frames and the next ones hit the index.
+    """
+    bot = ReductionBotT80S("bench", "",
+                           work_dir=work_dir,
+                           tile_source=tile_source)
+    bot._header_scanner = HeaderScanner(raw_dir, index=bot._header_index)
+    return bot
+
+
+def hot_paths(bot, start_date, end_date):
+    """
+    Return a list of (name, function) with the hot paths to be timed.
+    """
+    filt = FILTERS[0]
+    return [("search_images[BIAS]",
+             lambda: search_images(start_date, end_date, "BIAS")),
+            ("search_images[FLAS]",
+             lambda: search_images(start_date, end_date, "FLAS", filt)),
+            ("search_images[SCIE]",
+             lambda: search_images(start_date, end_date, "SCIE", filt)),
+            ("count_images[BIAS]",
+             lambda: count_images(start_date, end_date, "BIAS")),
+            ("count_images[FLAS]",
+             lambda: count_images(start_date, end_date, "FLAS", filt)),
+            ("has_all_flats", bot.has_all_flats),
+            ("has_all_bias", bot.has_all_bias),
+            ("_gen_tiles_info[{}]".format(bot._tile_source),
+             bot._gen_tiles_info)]
+
+
+def run(sizes, ndays, repeat, missing_fraction, tile_source, work_dir):
+    """
+    Run the benchmark for each number of rows in sizes, and return the
+    results.
+    """
+    results = []
+    end_date = date.today()
+    last_night = (datetime.now() - timedelta(days=1)).date()
+    for nrows in sizes:
+        filename = os.path.join(work_dir, "bench_{}.sqlite".format(nrows))
+        raw_dir = os.path.join(work_dir, "raw{}".format(nrows)) + "/"
+        os.makedirs(raw_dir)
+
+        t0 = time.time()
+        synthetic.create_database(filename, nrows, ndays=ndays,
+                                  end_date=end_date,
+                                  missing_fraction=missing_fraction)
+        nframes = synthetic.write_frames(filename, raw_dir, last_night,
+                                         last_night)
+        setup = time.time() - t0
+
+        bot = make_bot(work_dir, raw_dir, tile_source)
+        timings = {}
+        for name, function in hot_paths(bot, last_night, last_night):
+            timings[name] = _timings(function, repeat)
+            print("{0:>10d} rows {1:30s} first {2[first]:.4f}s  min "
+                  "{2[min]:.4f}s  median {2[median]:.4f}s".format(
+                      nrows, name, timings[name]))
+
+        results.append({'nrows': nrows,
+                        'nframes': nframes,
+                        'setup_seconds': setup,
+                        'timings': timings})
+        db.close()
+        os.remove(filename)
+        shutil.rmtree(raw_dir)
+    return results
+
+
+def compare(report, baseline):
+    """
+    Print the ratio between the minimum times of report and of a baseline
+    report, for the sizes and hot paths in both.
+    """
+    old = dict((result['nrows'], result['timings'])
+               for result in baseline['results'])
+    for result in report['results']:
+        if result['nrows'] not in old:
+            continue
+        for name, timing in sorted(result['timings'].items()):
+            if name not in old[result['nrows']]:
+                continue
+            before = old[result['nrows']][name]['min']
+            ratio = timing['min'] / before if before > 0 else float('inf')
+            print("{0:>10d} rows {1:30s} {2:.4f}s -> {3:.4f}s  x{4:.2f}".format(
+                result['nrows'], name, before, timing['min'], ratio))
+
+
+if __name__ == "__main__":
+    import argparse
+    PARSER = argparse.ArgumentParser(
+        description="Benchmark of the query and tile-discovery hot paths")
+
+    PARSER.add_argument("-n",
+                        help="Number of rows in t80oa",
+                        type=int,
+                        nargs='+',
+                        default=[100000, 1000000, 3000000])
+
+    PARSER.add_argument("-d",
+                        help="Number of days with synthetic images",
+                        type=int,
+                        default=60)
+
+    PARSER.add_argument("-r",
+                        help="Number of repetitions",
+                        type=int,
+                        default=3)
+
+    PARSER.add_argument("-m",
+                        help="Fraction of science images without tile "
+                             "metadata in the database",
+                        type=float,
+                        default=0.05)
+
+    PARSER.add_argument("-s",
+                        help="Source of the tiles for _gen_tiles_info",
+                        type=str,
+                        choices=["db", "headers"],
+                        default="db")
+
+    PARSER.add_argument("-o",
+                        help="Save the results in a JSON file",
+                        type=str,
+                        default=None)
+
+    PARSER.add_argument("-b",
+                        help="JSON file of a previous run to compare with",
+                        type=str,
+                        default=None)
+
+    ARGS = PARSER.parse_args()
+    WORK_DIR = tempfile.mkdtemp()
+    try:
+        RESULTS = run(ARGS.n, ARGS.d, ARGS.r, ARGS.m, ARGS.s, WORK_DIR)
+    finally:
+        logging.shutdown()
+        shutil.rmtree(WORK_DIR)
+
+    REPORT = {'date': datetime.now().isoformat(),
+              'revision': _git_revision(),
+              'python': platform.python_version(),
+              'machine': platform.node(),
+              'days': ARGS.d,
+              'missing_fraction': ARGS.m,
+              'tile_source': ARGS.s,
+              'results': RESULTS}
+    if ARGS.o is not None:
+        with open(ARGS.o, 'w') as fout:
+            json.dump(REPORT, fout, indent=2)
+    if ARGS.b is not None:
+        with open(ARGS.b) as fin:
+            compare(REPORT, json.load(fin))
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- Coding: UTF-8 -*-
+"""
+Startup-time benchmark for the Pipeline Data Base model.
+Each measure runs in a fresh interpreter, so the import cache of a previous
+run does not affect the next one. The first access to a table is measured
+against a local sqlite database, so no MySQL server is needed.
+"""
+import os
+import sys
+import json
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = '''
+import json
+import time
+t0 = time.time()
+import {module}
+t1 = time.time()
+from model import db
+db.bind("sqlite:memory", check_reserved=False)
+t2 = time.time()
+db.t80oa
+t3 = time.time()
+for tablename in db.tables:
+    db[tablename]
+t4 = time.time()
+print(json.dumps({{"import": t1 - t0,
+                  "connect_first_table": t3 - t2,
+                  "all_tables": t4 - t3}}))
+'''
+
+MODULES = ("model", "searchimages", "reductionbott80s")
+
+
+def measure(module, repeat=5):
+    """
+    Return the median, in seconds, of the import time of a module, of the
+    first access to t80oa and of the definition of the remaining tables.
+    """
+    results = []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, "-c",
+                                          PROBE.format(module=module)],
+                                         cwd=ROOT)
+        results.append(json.loads(output.decode().strip().splitlines()[-1]))
+
+    median = {}
+    for key in results[0]:
+        values = sorted(result[key] for result in results)
+        median[key] = values[len(values) // 2]
+    return median
+
+
+def main(repeat):
+    """
+    Print the startup times for the modules that import the model.
+    """
+    report = {}
+    for module in MODULES:
+        try:
+            report[module] = measure(module, repeat)
+        except subprocess.CalledProcessError:
+            report[module] = None
+            continue
+        print("{0:20s} import {1[import]:.4f}s  first table "
+              "{1[connect_first_table]:.4f}s  remaining tables "
+              "{1[all_tables]:.4f}s".format(module, report[module]))
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+    PARSER = argparse.ArgumentParser(
+        description="Startup-time benchmark for model.py")
+
+    PARSER.add_argument("-r",
+                        help="Number of repetitions",
+                        type=int,
+                        default=5)
+
+    PARSER.add_argument("-o",
+                        help="Save the results in a JSON file",
+                        type=str,
+                        default=None)
+
+    ARGS = PARSER.parse_args()
+    REPORT = main(ARGS.r)
+    if ARGS.o is not None:
+        with open(ARGS.o, 'w') as fout:
+            json.dump(REPORT, fout, indent=2)
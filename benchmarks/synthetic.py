@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- Coding: UTF-8 -*-
+"""
+Synthetic stand-in of the Pipeline Data Base for benchmarks.
+The schema of model.py is created in a local sqlite file, the dimension
+tables are filled with the T80S frame types and filters, and t80oa is
+filled with random images spread over dates, filters and frame types.
+The model is then bound to this file, so the query helpers run unchanged.
+Small raw frames, .fits and .fits.fz, can be written for the science
+images, so the header scan runs over real files.
+"""
+import os
+import sys
+import random
+import sqlite3
+from datetime import date, timedelta
+
+import numpy as np
+from astropy.io import fits
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from config import FILTERS
+from model import db
+from dimensions import DIMENSIONS
+from headerscan import EXPTIME_KEY
+
+FRAMETYPES = ('BIAS', 'FLAS', 'SCIE')
+
+# Fraction of images of each frame type.
+FRAMETYPES_WEIGHTS = (0.15, 0.25, 0.6)
+
+
+def _fix_decimal_fields():
+    """
+    The sqlite adapter of pyDAL needs the precision of decimal fields.
+    """
+    for _, fields, _ in db.definitions():
+        for field in fields:
+            if field.type == 'decimal':
+                field.type = 'decimal(20,10)'
+
+
+def create_schema(filename):
+    """
+    Create the tables of model.py in a sqlite file.
+    """
+    _fix_decimal_fields()
+    conn = sqlite3.connect(filename)
+    for tablename, fields, _ in db.definitions():
+        columns = ", ".join('"{0}" {1}'.format(field.name, field.type)
+                            for field in fields)
+        conn.execute('CREATE TABLE IF NOT EXISTS "{0}" (id INTEGER PRIMARY '
+                     'KEY AUTOINCREMENT, {1})'.format(tablename, columns))
+    for frametype in FRAMETYPES:
+        conn.execute('INSERT INTO frametype (Name) VALUES (?)', (frametype,))
+    for filt in FILTERS:
+        conn.execute('INSERT INTO filter (Name) VALUES (?)', (filt,))
+    conn.commit()
+    conn.close()
+
+
+def fill_t80oa(filename, nrows, ndays=60, ntiles=200, end_date=None,
+               seed=42, chunk_size=100000, missing_fraction=0.0):
+    """
+    Insert nrows random images in t80oa, over the ndays before end_date.
+    A missing_fraction of the science images has no Object, RA and DEC, as
+    the images whose tile is only found in the raw header.
+    """
+    if end_date is None:
+        end_date = date.today()
+    rand = random.Random(seed)
+    nfilters = len(FILTERS)
+    tiles = [("STRIPE82_{:04d}".format(i), rand.uniform(0, 360),
+              rand.uniform(-60, 10)) for i in range(ntiles)]
+
+    conn = sqlite3.connect(filename)
+    first = conn.execute("SELECT COALESCE(MAX(id), 0) FROM t80oa").fetchone()
+    first = first[0] + 1
+    sql = ('INSERT INTO t80oa (Name, Date, ImageType_ID, Filter_ID, Object, '
+           'RA, DEC, RADECsys_ID, ExpTime) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)')
+    rows = []
+    for i in range(first, first + nrows):
+        type_id = rand.choices((1, 2, 3), FRAMETYPES_WEIGHTS)[0]
+        day = end_date - timedelta(days=rand.randrange(ndays))
+        filter_id = rand.randrange(nfilters) + 1
+        if type_id == 3 and rand.random() >= missing_fraction:
+            tile, ra, dec = tiles[rand.randrange(ntiles)]
+        else:
+            tile, ra, dec = None, None, None
+        rows.append(("t80img{:09d}.".format(i), day.isoformat(), type_id,
+                     filter_id, tile, ra, dec, 1, 30.0))
+        if len(rows) == chunk_size:
+            conn.executemany(sql, rows)
+            rows = []
+    if rows:
+        conn.executemany(sql, rows)
+    conn.commit()
+    conn.close()
+
+
+def write_frames(filename, raw_dir, start_date, end_date, ntiles=200,
+                 compressed_fraction=0.5, shape=(16, 16), seed=42):
+    """
+    Write a small raw frame for each science image of t80oa between
+    start_date and end_date, and return the number of frames. A
+    compressed_fraction of the frames is written as .fits.fz, with the
+    header in the HDU 1, and the others as .fits.
+    """
+    rand = random.Random(seed)
+    data = np.zeros(shape, dtype=np.int16)
+    conn = sqlite3.connect(filename)
+    rows = conn.execute("SELECT Name, Object, RA, DEC FROM t80oa WHERE "
+                        "ImageType_ID = 3 AND Date >= ? AND Date <= ?",
+                        (start_date.isoformat(), end_date.isoformat()))
+    nframes = 0
+    for name, tile, ra, dec in rows:
+        if tile is None:
+            tile = "STRIPE82_{:04d}".format(rand.randrange(ntiles))
+            ra, dec = rand.uniform(0, 360), rand.uniform(-60, 10)
+        header = fits.Header()
+        header['OBJECT'] = tile
+        header['CRVAL1'] = ra
+        header['CRVAL2'] = dec
+        header[EXPTIME_KEY] = 30.0
+        path = os.path.join(raw_dir, name)
+        if rand.random() < compressed_fraction:
+            hdus = fits.HDUList([fits.PrimaryHDU(),
+                                 fits.CompImageHDU(data, header)])
+            hdus.writeto(path + "fits.fz", overwrite=True)
+        else:
+            fits.PrimaryHDU(data, header).writeto(path + "fits",
+                                                  overwrite=True)
+        nframes += 1
+    conn.close()
+    return nframes
+
+
+def bind(filename):
+    """
+    Bind the model to a sqlite file created by create_schema.
+    """
+    _fix_decimal_fields()
+    folder, name = os.path.split(os.path.abspath(filename))
+    db.bind("sqlite://" + name, folder=folder, check_reserved=False)
+    DIMENSIONS.invalidate()
+
+
+def create_database(filename, nrows, **kwargs):
+    """
+    Create a synthetic database with nrows images in t80oa, and bind the
+    model to it.
+    """
+    if os.path.isfile(filename):
+        os.remove(filename)
+    create_schema(filename)
+    fill_t80oa(filename, nrows, **kwargs)
+    bind(filename)
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- Coding: UTF-8 -*-
+"""
+Reuse of the master calibration frames.
+The input of a master bias, or of a master flat of a filter, is the set of
+BIAS, or FLAS, frames of the reduction window. Its fingerprint is compared
+with the fingerprint of the frames combined in the valid masters of
+t80cftab (t80cfImgs -> rc -> t80oa), and runcf.py only needs to run when
+no valid master has the same input. A master flat is only reused if the
+master bias is reused too, since the flats are corrected by the bias.
+"""
+from model import db
+from dimensions import DIMENSIONS
+from searchimages import search_images
+from tilehashes import input_hash
+
+# In t80cftab, is_valid=0 marks the valid masters; the recipe invalidates
+# them setting is_valid=1.
+VALID = 0
+INVALID = 1
+
+
+def master_inputs(cf_ids):
+    """
+    Return a dictionary {CF_ID: [names]} with the t80oa frames combined in
+    each master frame, using a single query.
+    """
+    if len(cf_ids) == 0:
+        return {}
+    rows = db((db.t80cfImgs.CF_ID.belongs(list(cf_ids)))
+              &
+              (db.t80cfImgs.RC_ID == db.rc.id)
+              &
+              (db.rc.ori_id == db.t80oa.id)).select(db.t80cfImgs.CF_ID,
+                                                    db.t80oa.Name)
+    inputs = {}
+    for row in rows:
+        inputs.setdefault(row.t80cfImgs.CF_ID, []).append(row.t80oa.Name)
+    return inputs
+
+
+class CalibrationManager(object):
+    """
+    Find the valid master frames that can be reused in a reduction window.
+    Attr:
+        start_date, end_date: The reduction window
+    Optional Attr:
+        max_candidates: Number of the most recent valid masters, of each
+                        type and filter, compared with the window
+        windows: Windows of the masters, {(cftype, filter): (start_date,
+                 end_date)}, e.g. from CalibrationWindowPlanner. The
+                 masters without a window use the whole window.
+    """
+
+    def __init__(self, start_date, end_date, max_candidates=5,
+                 windows=None):
+        self._start_date = start_date
+        self._end_date = end_date
+        self._max_candidates = max_candidates
+        self._windows = windows or {}
+        self._masters = {}
+
+    def _query(self, cftype, filt):
+        table = db.t80cftab
+        query = table.CFtype_ID == DIMENSIONS.id_of('frametype', cftype)
+        if filt is not None:
+            query &= table.Filter_ID == DIMENSIONS.id_of('filter', filt)
+        return query
+
+    def fingerprint(self, cftype, filt=None):
+        """
+        Return the fingerprint of the input frames of a master in the
+        window, or None if there are no frames.
+        """
+        start_date, end_date = self._windows.get(
+            (cftype, filt), (self._start_date, self._end_date))
+        names = search_images(start_date, end_date, cftype, filt)
+        if len(names) == 0:
+            return None
+        return input_hash(names)
+
+    def find_master(self, cftype, filt=None):
+        """
+        Return the CFname of a valid master built from the same frames of
+        the window, or None.
+        """
+        key = (cftype, filt)
+        if key in self._masters:
+            return self._masters[key]
+
+        self._masters[key] = None
+        fingerprint = self.fingerprint(cftype, filt)
+        if fingerprint is None:
+            return None
+
+        rows = db(self._query(cftype, filt)
+                  &
+                  (db.t80cftab.is_valid == VALID)).select(
+                      db.t80cftab.id,
+                      db.t80cftab.CFname,
+                      orderby=~db.t80cftab.id,
+                      limitby=(0, self._max_candidates))
+        inputs = master_inputs([row.id for row in rows])
+        for row in rows:
+            if row.id in inputs and input_hash(inputs[row.id]) == fingerprint:
+                self._masters[key] = row.CFname
+                break
+        return self._masters[key]
+
+    def reusable(self, cftype, filt=None):
+        """
+        Return the CFname of the master that can be reused, or None. A
+        flat is only reused if the bias is reused too.
+        """
+        if cftype != "BIAS" and self.find_master("BIAS") is None:
+            return None
+        return self.find_master(cftype, filt)
+
+    def plan(self, filters):
+        """
+        Return a dictionary {(cftype, filter): CFname or None} with the
+        masters of the window that can be reused.
+        """
+        plan = {("BIAS", None): self.reusable("BIAS")}
+        for filt in filters:
+            plan[("FLAS", filt)] = self.reusable("FLAS", filt)
+        return plan
+
+    def invalidate(self, cftype, filt=None):
+        """
+        Invalidate the valid masters of a type and filter, before a new
+        master is built. Return the number of invalidated masters.
+        """
+        nrows = db(self._query(cftype, filt)
+                   &
+                   (db.t80cftab.is_valid == VALID)).update(is_valid=INVALID)
+        db.commit()
+        self._masters.pop((cftype, filt), None)
+        return nrows
+
+
+if __name__ == "__main__":
+    import argparse
+    DESCRIPTION = '''Reuse of the master calibration frames. "reuse" prints
+    the name of the valid master with the same input frames, and exits with
+    status 1 if there is none. "invalidate" invalidates the valid masters of
+    the type and filter.
+    '''
+    PARSER = argparse.ArgumentParser(description=DESCRIPTION)
+
+    PARSER.add_argument("start_date", help="Start date yyyy-mm-dd", type=str)
+    PARSER.add_argument("end_date", help="End date yyyy-mm-dd", type=str)
+    PARSER.add_argument("action", help="Action",
+                        choices=["reuse", "invalidate", "fingerprint"])
+    PARSER.add_argument("cftype", help="Type of master: BIAS or FLAS",
+                        type=str)
+    PARSER.add_argument("filter", help="Filter of the master flat", type=str,
+                        nargs='?', default=None)
+    PARSER.add_argument("-w",
+                        help="Use the narrowest windows of the masters, see "
+                             "calibrationwindow.py",
+                        action="store_true")
+
+    ARGS = PARSER.parse_args()
+    WINDOWS = None
+    if ARGS.w:
+        from calibrationwindow import CalibrationWindowPlanner
+        FILTERS = [ARGS.filter] if ARGS.filter is not None else []
+        WINDOWS = dict((KEY, (WINDOW.start_date, WINDOW.end_date))
+                       for KEY, WINDOW in CalibrationWindowPlanner(
+                           FILTERS).plan(ARGS.start_date,
+                                         ARGS.end_date).items()
+                       if WINDOW.start_date is not None)
+    MANAGER = CalibrationManager(ARGS.start_date, ARGS.end_date,
+                                 windows=WINDOWS)
+
+    if ARGS.action == "reuse":
+        CFNAME = MANAGER.reusable(ARGS.cftype, ARGS.filter)
+        if CFNAME is None:
+            raise SystemExit(1)
+        print(CFNAME)
+    elif ARGS.action == "invalidate":
+        print("{} masters invalidated".format(
+            MANAGER.invalidate(ARGS.cftype, ARGS.filter)))
+    else:
+        print(MANAGER.fingerprint(ARGS.cftype, ARGS.filter))
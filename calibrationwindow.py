@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- Coding: UTF-8 -*-
+"""
+Adaptive window of the master calibration frames.
+The number of BIAS and FLAS frames of each night and filter, in the
+look-back period, is read with a single grouped query into a NumPy matrix
+date x filter x frametype. For the master bias, and for the master flat of
+each filter, the window is the narrowest period ending at the reduction
+date with MIN_COMBINE_NUMBER_BIAS, or MIN_COMBINE_NUMBER_FLAT, frames. The
+smaller windows give fewer frames to runcf.py, and a filter with sparse
+flats does not block the other filters.
+"""
+from datetime import datetime, timedelta
+from collections import namedtuple
+
+import numpy as np
+
+from model import db
+from config import FILTERS, MIN_COMBINE_NUMBER_FLAT, MIN_COMBINE_NUMBER_BIAS
+from dimensions import DIMENSIONS
+
+FRAMETYPES = ("BIAS", "FLAS")
+
+# start_date is None when the look-back period does not have the minimum
+# number of frames. nframes is the number of frames in the window, or in
+# the whole look-back period.
+Window = namedtuple('Window', ['start_date', 'end_date', 'nframes'])
+
+
+def _date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, str):
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    return value
+
+
+def count_matrix(start_date, end_date, filters=FILTERS,
+                 frametypes=FRAMETYPES):
+    """
+    Return (dates, counts), with the number of frames of each day between
+    start_date and end_date, using a single grouped query. counts is an
+    integer array (len(dates), len(filters) + 1, len(frametypes)). The
+    last filter column counts the frames of the other filters, or without
+    filter, so counts[:, :, i].sum(axis=1) is the number of frames of the
+    type, e.g. the bias.
+    """
+    start_date = _date(start_date)
+    end_date = _date(end_date)
+    ndays = max((end_date - start_date).days + 1, 0)
+    dates = [start_date + timedelta(days=day) for day in range(ndays)]
+    counts = np.zeros((ndays, len(filters) + 1, len(frametypes)), dtype=int)
+
+    types_ids = DIMENSIONS.ids_of('frametype', frametypes)
+    nimages = db.t80oa.id.count()
+    rows = db((db.t80oa.ImageType_ID.belongs(list(types_ids.values())))
+              &
+              (db.t80oa.Date >= start_date)
+              &
+              (db.t80oa.Date <= end_date)).select(
+                  db.t80oa.Date,
+                  db.t80oa.ImageType_ID,
+                  db.t80oa.Filter_ID,
+                  nimages,
+                  groupby=(db.t80oa.Date | db.t80oa.ImageType_ID |
+                           db.t80oa.Filter_ID))
+    if len(rows) == 0:
+        return dates, counts
+
+    types_index = dict((types_ids[frametype], i)
+                       for i, frametype in enumerate(frametypes)
+                       if frametype in types_ids)
+    filters_ids = DIMENSIONS.ids_of('filter', filters)
+    filters_index = dict((filters_ids[filt], i)
+                         for i, filt in enumerate(filters)
+                         if filt in filters_ids)
+
+    days = np.array([(_date(row.t80oa.Date) - start_date).days
+                     for row in rows])
+    filters_col = np.array([filters_index.get(row.t80oa.Filter_ID,
+                                              len(filters))
+                            for row in rows])
+    types_col = np.array([types_index[row.t80oa.ImageType_ID]
+                          for row in rows])
+    np.add.at(counts, (days, filters_col, types_col),
+              np.array([row[nimages] for row in rows]))
+    return dates, counts
+
+
+def narrowest_windows(counts, minimum):
+    """
+    Return, for each column of counts (ndays, ncolumns), the number of
+    last days whose frames reach the minimum, or 0 if all the days do not
+    reach it.
+    """
+    if counts.shape[0] == 0:
+        return np.zeros(counts.shape[1], dtype=int)
+    cumulative = np.cumsum(counts[::-1], axis=0)
+    reached = cumulative >= minimum
+    ndays = np.argmax(reached, axis=0) + 1
+    ndays[~reached.any(axis=0)] = 0
+    return ndays
+
+
+class CalibrationWindowPlanner(object):
+    """
+    Choose the narrowest window of the master bias, and of the master flat
+    of each filter, inside a look-back period.
+    Optional Attr:
+        filters: Filters of the master flats
+        min_bias: Minimum number of bias combined in the master bias
+        min_flats: Minimum number of flats combined in a master flat
+    """
+
+    def __init__(self, filters=FILTERS, min_bias=MIN_COMBINE_NUMBER_BIAS,
+                 min_flats=MIN_COMBINE_NUMBER_FLAT):
+        self._filters = list(filters)
+        self._min_bias = min_bias
+        self._min_flats = min_flats
+
+    def plan(self, start_date, end_date):
+        """
+        Return a dictionary {(cftype, filter): Window}, with the keys
+        ("BIAS", None) and ("FLAS", filter), for the look-back period
+        between start_date and end_date.
+        """
+        dates, counts = count_matrix(start_date, end_date, self._filters)
+        end_date = _date(end_date)
+        bias = counts[:, :, FRAMETYPES.index("BIAS")].sum(axis=1)
+        flats = counts[:, :-1, FRAMETYPES.index("FLAS")]
+
+        columns = np.column_stack([bias, flats])
+        minimum = np.array([self._min_bias] +
+                           [self._min_flats] * len(self._filters))
+        ndays = narrowest_windows(columns, minimum)
+        cumulative = np.cumsum(columns[::-1], axis=0)
+        total = columns.sum(axis=0)
+
+        plan = {}
+        keys = [("BIAS", None)] + [("FLAS", filt) for filt in self._filters]
+        for i, key in enumerate(keys):
+            if ndays[i] == 0:
+                plan[key] = Window(None, end_date, int(total[i]))
+            else:
+                plan[key] = Window(dates[-ndays[i]], end_date,
+                                   int(cumulative[ndays[i] - 1, i]))
+        return plan
+
+    def ready_filters(self, plan):
+        """
+        Return the filters with a window in the plan, or an empty list if
+        the master bias has not.
+        """
+        if plan[("BIAS", None)].start_date is None:
+            return []
+        return [filt for filt in self._filters
+                if plan[("FLAS", filt)].start_date is not None]
+
+
+if __name__ == "__main__":
+    import argparse
+    DESCRIPTION = '''Adaptive window of the master calibration frames. Print
+    one line "cftype filter start_date end_date nframes" for the master bias
+    and the master flat of each filter, with the narrowest window inside the
+    period between start_date and end_date. Masters without the minimum
+    number of frames are printed with the start_date "none".
+    '''
+    PARSER = argparse.ArgumentParser(description=DESCRIPTION)
+
+    PARSER.add_argument("start_date", help="Start date yyyy-mm-dd", type=str)
+    PARSER.add_argument("end_date", help="End date yyyy-mm-dd", type=str)
+    PARSER.add_argument("filters", help="Filters of the master flats",
+                        type=str, nargs='*', default=list(FILTERS))
+
+    ARGS = PARSER.parse_args()
+    PLAN = CalibrationWindowPlanner(ARGS.filters).plan(ARGS.start_date,
+                                                        ARGS.end_date)
+    for CFTYPE, FILT in [("BIAS", None)] + [("FLAS", FILT)
+                                            for FILT in ARGS.filters]:
+        WINDOW = PLAN[(CFTYPE, FILT)]
+        print("{0} {1} {2} {3} {4}".format(CFTYPE, FILT or "-",
+                                           WINDOW.start_date or "none",
+                                           WINDOW.end_date, WINDOW.nframes))
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- Coding: UTF-8 -*-
+"""
+Stage checkpoints of the reduction of the tiles.
+The stages of the recipe that finished for each tile, filter and period
+are saved in a sqlite file, shared by the bot and the recipes running at
+once. In resume mode, a recipe skips the stages already done, so a failure
+in the coaddition does not recreate the master bias and flats.
+When the coaddition fails, its stage code (COADING_ERROR, in
+t80tilesinfo.Exit_Status) is saved with the checkpoint.
+"""
+import time
+import sqlite3
+import threading
+
+from config import COADING_ERROR
+
+# Stages of runcoadding.py, by their Exit_Status code, see config.py.
+COADDING_STAGES = {1: '__init__',
+                   2: 'GetSciImages',
+                   3: 'prepare_catalogs',
+                   4: 'do_internal_astro',
+                   5: 'do_internal_photo',
+                   6: 'SwarpImages',
+                   7: 'CreateObjMask',
+                   8: 'MaskImprove',
+                   9: 'ComputeIndCatalog',
+                   10: 'ComputeDualModeCatalog',
+                   11: 'ReferenceFilterMissing',
+                   12: 'UpdateTile',
+                   0: 'Complete'}
+
+DONE = "done"
+FAILED = "failed"
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS checkpoints (
+    tile TEXT,
+    filter TEXT,
+    stage TEXT,
+    start_date TEXT,
+    end_date TEXT,
+    status TEXT,
+    code INTEGER,
+    updated REAL,
+    PRIMARY KEY (tile, filter, stage, start_date, end_date)
+);
+'''
+
+
+class CheckpointStore(object):
+    """
+    Checkpoints of the recipe stages, stored in a sqlite file.
+    Attr:
+        filename: The sqlite file. It is created if it does not exist.
+    Optional Attr:
+        timeout: Time, in seconds, waiting for the lock of the file when
+                 other process is writing
+    """
+
+    def __init__(self, filename, timeout=60):
+        self._filename = filename
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(filename, timeout=timeout,
+                                     check_same_thread=False)
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+
+    def _set(self, tile, stage, period, filt, status, code=None):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO checkpoints VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?)",
+                (tile, filt or "", stage, str(period[0]), str(period[1]),
+                 status, code, time.time()))
+            self._conn.commit()
+
+    def mark_done(self, tile, stage, period, filt=None):
+        """
+        Save that a stage finished for a tile, filter and period
+        (start_date, end_date).
+        """
+        self._set(tile, stage, period, filt, DONE)
+
+    def mark_failed(self, tile, stage, period, filt=None, code=None):
+        """
+        Save that a stage failed, with the code of the failed sub-stage,
+        e.g. a COADING_ERROR code.
+        """
+        self._set(tile, stage, period, filt, FAILED, code)
+
+    def is_done(self, tile, stage, period, filt=None):
+        """
+        Return True if the stage finished for the tile, filter and period.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT status FROM checkpoints WHERE tile=? AND filter=? "
+                "AND stage=? AND start_date=? AND end_date=?",
+                (tile, filt or "", stage, str(period[0]),
+                 str(period[1]))).fetchone()
+        return row is not None and row[0] == DONE
+
+    def stages(self, tile, period=None):
+        """
+        Return a list of (stage, filter, start_date, end_date, status, code)
+        saved for a tile, optionally only for one period, in the order they
+        were saved.
+        """
+        sql = ("SELECT stage, filter, start_date, end_date, status, code "
+               "FROM checkpoints WHERE tile=?")
+        args = [tile]
+        if period is not None:
+            sql += " AND start_date=? AND end_date=?"
+            args += [str(period[0]), str(period[1])]
+        with self._lock:
+            return self._conn.execute(sql + " ORDER BY updated",
+                                      args).fetchall()
+
+    def incomplete_period(self, tile):
+        """
+        Return the period (start_date, end_date) of the last reduction of
+        the tile that did not finish, or None.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT start_date, end_date FROM checkpoints WHERE tile=? "
+                "ORDER BY updated DESC LIMIT 1", (tile,)).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1]
+
+    def clear(self, tile, period=None):
+        """
+        Remove the checkpoints of a tile, e.g. when its reduction ends.
+        """
+        sql = "DELETE FROM checkpoints WHERE tile=?"
+        args = [tile]
+        if period is not None:
+            sql += " AND start_date=? AND end_date=?"
+            args += [str(period[0]), str(period[1])]
+        with self._lock:
+            self._conn.execute(sql, args)
+            self._conn.commit()
+
+    def reset(self, tile, period, stages, filt=None):
+        """
+        Remove the checkpoints of some stages of a tile and period, of one
+        filter or, if filt is None, of all filters. Used when a master is
+        rebuilt, so the stages that read the previous master run again.
+        """
+        sql = ("DELETE FROM checkpoints WHERE tile=? AND start_date=? "
+               "AND end_date=? AND stage IN ({})".format(
+                   ", ".join("?" * len(stages))))
+        args = [tile, str(period[0]), str(period[1])] + list(stages)
+        if filt is not None:
+            sql += " AND filter=?"
+            args.append(filt)
+        with self._lock:
+            self._conn.execute(sql, args)
+            self._conn.commit()
+
+    def close(self):
+        """
+        Close the sqlite file.
+        """
+        with self._lock:
+            self._conn.close()
+
+
+def coadd_failures(tile, filters, since):
+    """
+    Return a dictionary {filter: code} with the COADING_ERROR code of the
+    last coaddition of the tile in each filter, for the filters whose last
+    coaddition failed. Only the tile info inserted or updated since the
+    datetime since, the start of the reduction, is read, so the failures of
+    the previous reductions of the tile are not reported again.
+    """
+    from model import db
+    from dimensions import DIMENSIONS
+
+    filters_ids = DIMENSIONS.ids_of('filter', filters)
+    filters_names = dict((filter_id, filt)
+                         for filt, filter_id in filters_ids.items())
+    rows = db((db.t80tilesinfo.TileName == tile)
+              &
+              (db.t80tilesinfo.Filter_ID.belongs(list(filters_ids.values())))
+              &
+              ((db.t80tilesinfo.UPDATEDATE_tile >= since)
+               |
+               (db.t80tilesinfo.DateInsert >= since.date()))
+              ).select(db.t80tilesinfo.Filter_ID,
+                       db.t80tilesinfo.Exit_Status,
+                       orderby=db.t80tilesinfo.id)
+    status = {}
+    for row in rows:
+        status[filters_names[row.Filter_ID]] = row.Exit_Status
+    return dict((filt, code) for filt, code in status.items()
+                if code in COADING_ERROR)
+
+
+if __name__ == "__main__":
+    import argparse
+    DESCRIPTION = '''Stage checkpoints of the reduction of a tile, used by
+    the recipes. "done" exits with status 0 if the stage is done, and 1
+    otherwise. "reset" removes the checkpoints of the stages, separated by
+    commas, of the filter, or of all filters.
+    '''
+    PARSER = argparse.ArgumentParser(description=DESCRIPTION)
+
+    PARSER.add_argument("filename", help="The sqlite file", type=str)
+    PARSER.add_argument("action", help="Action",
+                        choices=["done", "mark", "fail", "list", "clear",
+                                 "reset"])
+    PARSER.add_argument("tile", help="Name of the tile", type=str)
+    PARSER.add_argument("start_date", help="Start date yyyy-mm-dd", type=str,
+                        nargs='?', default=None)
+    PARSER.add_argument("end_date", help="End date yyyy-mm-dd", type=str,
+                        nargs='?', default=None)
+    PARSER.add_argument("stage", help="Name of the stage", type=str,
+                        nargs='?', default=None)
+    PARSER.add_argument("filter", help="Filter of the stage", type=str,
+                        nargs='?', default=None)
+
+    ARGS = PARSER.parse_args()
+    STORE = CheckpointStore(ARGS.filename)
+    PERIOD = None
+    if ARGS.start_date is not None:
+        PERIOD = (ARGS.start_date, ARGS.end_date)
+
+    if ARGS.action == "done":
+        if not STORE.is_done(ARGS.tile, ARGS.stage, PERIOD, ARGS.filter):
+            raise SystemExit(1)
+    elif ARGS.action == "mark":
+        STORE.mark_done(ARGS.tile, ARGS.stage, PERIOD, ARGS.filter)
+    elif ARGS.action == "fail":
+        STORE.mark_failed(ARGS.tile, ARGS.stage, PERIOD, ARGS.filter)
+    elif ARGS.action == "list":
+        for STAGE in STORE.stages(ARGS.tile, PERIOD):
+            print(" ".join(str(value) for value in STAGE))
+    elif ARGS.action == "reset":
+        STORE.reset(ARGS.tile, PERIOD, ARGS.stage.split(","), ARGS.filter)
+    else:
+        STORE.clear(ARGS.tile, PERIOD)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- Coding: UTF-8 -*-
+"""
+Pipelined cosmetic correction of the science images of a tile.
+The list of images is read once with jgetlist.py, and each image goes
+through the two runcosmet.py passes back to back, in a bounded pool of
+workers. So the second pass of an image does not wait for the first pass
+of all the other images.
+"""
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Options of the two runcosmet.py passes, in order.
+COSMET_PASSES = (["-o", "-u"], [])
+
+
+def get_image_list(tile, filt, start_date, end_date):
+    """
+    Return the science images of a tile and filter, with the same query of
+    the shell recipe.
+    """
+    output = subprocess.check_output(
+        ["jgetlist.py",
+         "-t", "SCIE",
+         "-f", filt,
+         "--addcond", "Object like '%{}%'".format(tile[0:3]),
+         "-s", start_date,
+         "-e", end_date])
+    return [line.strip() for line in output.decode().splitlines()
+            if line.strip() != ""]
+
+
+def run_cosmet(image, passes=COSMET_PASSES):
+    """
+    Run the runcosmet.py passes for one image. Return the image and the list
+    of exit status, one for each pass run. A pass is not run after a failed
+    pass.
+    """
+    status = []
+    for options in passes:
+        status.append(subprocess.call(["runcosmet.py"] + options + [image]))
+        if status[-1] != 0:
+            break
+    return image, status
+
+
+def run_cosmet_stage(images, nprocess=3, passes=COSMET_PASSES):
+    """
+    Run the cosmetic correction of a list of images in a pool of nprocess
+    workers. Yield (image, status) as each image is finished.
+    """
+    if len(images) == 0:
+        return
+    with ThreadPoolExecutor(max_workers=nprocess) as executor:
+        futures = [executor.submit(run_cosmet, image, passes)
+                   for image in images]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+if __name__ == "__main__":
+    import argparse
+    PARSER = argparse.ArgumentParser(
+        description="Cosmetic correction of the science images of a tile")
+
+    PARSER.add_argument("-t",
+                        help="Name of the tile",
+                        type=str,
+                        required=True)
+
+    PARSER.add_argument("-f",
+                        help="Filter",
+                        type=str,
+                        required=True)
+
+    PARSER.add_argument("-s",
+                        help="Start date yyyy-mm-dd",
+                        type=str,
+                        required=True)
+
+    PARSER.add_argument("-e",
+                        help="End date yyyy-mm-dd",
+                        type=str,
+                        required=True)
+
+    PARSER.add_argument("-p",
+                        help="Number of parallel process",
+                        type=int,
+                        default=3)
+
+    PARSER.add_argument("-m",
+                        help="Exit with error if more than M images failed. "
+                             "By default the failures are only reported, as "
+                             "in the recipe before this stage",
+                        type=int,
+                        default=None)
+
+    ARGS = PARSER.parse_args()
+
+    IMAGES = get_image_list(ARGS.t, ARGS.f, ARGS.s, ARGS.e)
+    NFAILED = 0
+    for IMAGE, STATUS in run_cosmet_stage(IMAGES, ARGS.p):
+        if any(STATUS):
+            NFAILED += 1
+            print("Cosmetic correction failed for {0}: {1}".format(
+                IMAGE, STATUS))
+        else:
+            print("Cosmetic correction done for {}".format(IMAGE))
+
+    print("{0} of {1} images corrected.".format(len(IMAGES) - NFAILED,
+                                                len(IMAGES)))
+    if ARGS.m is not None and NFAILED > ARGS.m:
+        raise SystemExit(1)
@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+# -*- Coding: UTF-8 -*-
+"""
+Runtime and memory cost model of the reduction of the tiles.
+The time of the reduction of a tile in a filter is fitted as a power law
+of its number of input frames, t = a * n ** b, on the successful entries
+of t80tilesinfo (NCombined and TimTotalTile, or the sum of the stage
+times when TimTotalTile is missing), by filter when the filter has enough
+entries. The peak memory of the reduction of a tile is fitted as a linear
+function of its input frames, on the "reduction" spans of the bot.
+The predictions are used by the TileScheduler to start the longest tiles
+first, and simulate gives the expected plan and makespan of a night.
+"""
+import json
+import os
+
+import numpy as np
+
+from model import db
+from dimensions import DIMENSIONS
+from throughputstats import load_tile_timings, TILE_STAGES, MIN_POINTS
+
+
+def input_counts(tiles, filters, start_date=None, end_date=None):
+    """
+    Return a dictionary {(tile, filter): nframes} with the number of
+    science images of each tile and filter, observed between start_date
+    and end_date if given, using a single grouped query over t80oa. Pairs
+    without images are not in the output.
+    """
+    type_id = DIMENSIONS.id_of('frametype', 'SCIE')
+    filters_ids = DIMENSIONS.ids_of('filter', filters)
+    filters_names = dict((filter_id, filt)
+                         for filt, filter_id in filters_ids.items())
+
+    query = ((db.t80oa.ImageType_ID == type_id)
+             &
+             (db.t80oa.Object.belongs(list(tiles)))
+             &
+             (db.t80oa.Filter_ID.belongs(list(filters_ids.values()))))
+    if start_date is not None:
+        query &= db.t80oa.Date >= start_date
+    if end_date is not None:
+        query &= db.t80oa.Date <= end_date
+    nimages = db.t80oa.id.count()
+    rows = db(query).select(db.t80oa.Object,
+                            db.t80oa.Filter_ID,
+                            nimages,
+                            groupby=db.t80oa.Object | db.t80oa.Filter_ID)
+    return dict(((row.t80oa.Object, filters_names[row.t80oa.Filter_ID]),
+                 row[nimages]) for row in rows)
+
+
+def fit_power_law(nframes, seconds):
+    """
+    Return (a, b) of the fit seconds = a * nframes ** b, or None if there
+    are few points.
+    """
+    valid = (nframes > 0) & (seconds > 0)
+    if np.count_nonzero(valid) < MIN_POINTS or \
+            np.unique(nframes[valid]).size < 2:
+        return None
+    exponent, log_a = np.polyfit(np.log(nframes[valid]),
+                                 np.log(seconds[valid]), 1)
+    return float(np.exp(log_a)), float(exponent)
+
+
+def load_memory_history(spans_file):
+    """
+    Return two arrays, nframes and peak_rss_mb, of the successful
+    "reduction" spans of the bot with the number of input frames.
+    """
+    nframes = []
+    peaks = []
+    if spans_file is not None and os.path.isfile(spans_file):
+        with open(spans_file) as fin:
+            for line in fin:
+                try:
+                    span = json.loads(line)
+                except ValueError:
+                    continue
+                if span.get('stage') != "reduction" or \
+                        span.get('status') != "ok" or \
+                        span.get('nframes') is None or \
+                        span.get('peak_rss_mb') is None:
+                    continue
+                nframes.append(float(span['nframes']))
+                peaks.append(float(span['peak_rss_mb']))
+    return np.array(nframes), np.array(peaks)
+
+
+class CostModel(object):
+    """
+    Predicted wall-clock time and peak memory of the reduction of a tile.
+    Optional Attr:
+        seconds_per_frame: Time by input frame used while there is no
+                           history to fit
+        memory_percentile: Percentile of the residuals of the memory fit
+                           added to the prediction, so few jobs exceed it
+    """
+
+    def __init__(self, seconds_per_frame=60.0, memory_percentile=90):
+        self._default = (seconds_per_frame, 1.0)
+        self._memory_percentile = memory_percentile
+        self._global = None
+        self._filters = {}
+        self._memory = None
+
+    @classmethod
+    def from_history(cls, start_date=None, end_date=None, spans_file=None,
+                     **kwargs):
+        """
+        Return a CostModel fitted on the t80tilesinfo entries inserted
+        between start_date and end_date, and on the spans file of the bot.
+        """
+        model = cls(**kwargs)
+        model.fit(load_tile_timings(start_date, end_date))
+        model.fit_memory(*load_memory_history(spans_file))
+        return model
+
+    def fit(self, data):
+        """
+        Fit the time by filter on the dictionary returned by
+        throughputstats.load_tile_timings.
+        """
+        total = data['times'][:, TILE_STAGES.index('TimTotalTile')]
+        stages = data['times'][:, :TILE_STAGES.index('TimTotalTile')]
+        missing = np.isnan(total)
+        if np.any(missing):
+            total = total.copy()
+            summed = np.nansum(stages[missing], axis=1)
+            summed[np.all(np.isnan(stages[missing]), axis=1)] = np.nan
+            total[missing] = summed
+
+        valid = (data['exit_status'] == 0) & ~np.isnan(total) & \
+            ~np.isnan(data['ncombined'])
+        nframes = data['ncombined'][valid]
+        seconds = total[valid]
+        filters = data['filter'][valid]
+
+        self._global = fit_power_law(nframes, seconds)
+        self._filters = {}
+        for filt in np.unique(filters):
+            fit = fit_power_law(nframes[filters == filt],
+                                seconds[filters == filt])
+            if fit is not None:
+                self._filters[str(filt).upper()] = fit
+
+    def fit_memory(self, nframes, peak_mb):
+        """
+        Fit the peak memory, in MB, of the reduction of a tile as a linear
+        function of its input frames.
+        """
+        self._memory = None
+        if len(nframes) < MIN_POINTS or np.unique(nframes).size < 2:
+            return
+        slope, intercept = np.polyfit(nframes, peak_mb, 1)
+        residuals = peak_mb - (slope * nframes + intercept)
+        margin = max(float(np.percentile(residuals,
+                                         self._memory_percentile)), 0.0)
+        self._memory = (float(slope), float(intercept) + margin)
+
+    def predict_seconds(self, filt, nframes):
+        """
+        Return the predicted time, in seconds, of the reduction of a tile
+        in a filter.
+        """
+        if nframes <= 0:
+            return 0.0
+        a, b = self._filters.get(str(filt).upper(),
+                                 self._global or self._default)
+        return a * nframes ** b
+
+    def predict_memory_mb(self, nframes):
+        """
+        Return the predicted peak memory, in MB, of the reduction of a
+        tile, or None if there is no history to fit.
+        """
+        if self._memory is None:
+            return None
+        slope, intercept = self._memory
+        return max(slope * nframes + intercept, 0.0)
+
+    def predict_tile(self, counts):
+        """
+        Return (seconds, memory_mb) of the reduction of a tile, from the
+        dictionary {filter: nframes}. The filters are reduced one after
+        the other by the recipe, so their times are added.
+        """
+        seconds = sum(self.predict_seconds(filt, nframes)
+                      for filt, nframes in counts.items())
+        return seconds, self.predict_memory_mb(sum(counts.values()))
+
+    def describe(self):
+        """
+        Return a text with the fitted parameters.
+        """
+        lines = []
+        if self._global is None:
+            lines.append("time: no history, {0:.1f} s by frame".format(
+                self._default[0]))
+        else:
+            lines.append("time: {0:.2f} * n ** {1:.2f} s".format(
+                *self._global))
+        for filt in sorted(self._filters):
+            lines.append("    {0:6s} {1:.2f} * n ** {2:.2f} s".format(
+                filt, *self._filters[filt]))
+        if self._memory is None:
+            lines.append("memory: no history")
+        else:
+            lines.append("memory: {0:.2f} * n + {1:.0f} MB".format(
+                *self._memory))
+        return "\n".join(lines)
+
+
+def simulate(jobs, max_cpus, memory_mb, longest_first=True):
+    """
+    Return (plan, makespan) of the jobs run by a TileScheduler with the
+    same budget. jobs is a list of dictionaries with name, seconds, cpus
+    and memory_mb. plan is a list of dictionaries, one by job, with its
+    start and end time, in the order the jobs start.
+    """
+    pending = list(jobs)
+    if longest_first:
+        pending.sort(key=lambda job: -job['seconds'])
+    running = []
+    plan = []
+    now = 0.0
+
+    def can_start(job):
+        if len(running) == 0:
+            return True
+        used_cpus = sum(other['cpus'] for other in running)
+        reserved = sum(other['memory_mb'] for other in running)
+        return used_cpus + job['cpus'] <= max_cpus and \
+            reserved + job['memory_mb'] <= memory_mb
+
+    while pending or running:
+        started = True
+        while started:
+            started = False
+            candidates = pending if longest_first else pending[:1]
+            for job in candidates:
+                if can_start(job):
+                    pending.remove(job)
+                    job = dict(job, start=now, end=now + job['seconds'])
+                    running.append(job)
+                    plan.append(job)
+                    started = True
+                    break
+        running.sort(key=lambda job: job['end'])
+        now = running[0]['end']
+        while running and running[0]['end'] <= now:
+            running.pop(0)
+
+    makespan = max([job['end'] for job in plan] or [0.0])
+    return plan, makespan
+
+
+if __name__ == "__main__":
+    import argparse
+    from datetime import datetime, timedelta
+
+    from config import FILTERS
+    from searchimages import search_tiles
+    from tilescheduler import total_memory_mb
+
+    DESCRIPTION = '''Dry run of the scheduling of the tiles observed in a
+    period: print the predicted time and memory of each tile, the plan of
+    the TileScheduler, longest tiles first, and the makespan.
+    '''
+    PARSER = argparse.ArgumentParser(description=DESCRIPTION)
+
+    PARSER.add_argument("-s",
+                        help="Start date yyyy-mm-dd of the observations, "
+                             "the default is yesterday",
+                        type=str,
+                        default=None)
+
+    PARSER.add_argument("-e",
+                        help="End date yyyy-mm-dd of the observations",
+                        type=str,
+                        default=None)
+
+    PARSER.add_argument("-c",
+                        help="Number of CPUs used by concurrent reductions",
+                        type=int,
+                        default=os.cpu_count() or 1)
+
+    PARSER.add_argument("-M",
+                        help="Memory, in MB, used by concurrent reductions",
+                        type=float,
+                        default=(total_memory_mb() or 16384) * 0.8)
+
+    PARSER.add_argument("-j",
+                        help="CPUs reserved for the reduction of one tile",
+                        type=int,
+                        default=4)
+
+    PARSER.add_argument("-m",
+                        help="Memory, in MB, of a tile without memory "
+                             "history",
+                        type=float,
+                        default=8192)
+
+    PARSER.add_argument("-S",
+                        help="Spans file of the bot, with the memory "
+                             "history",
+                        type=str,
+                        default=None)
+
+    ARGS = PARSER.parse_args()
+    START = ARGS.s or (datetime.now() - timedelta(days=1)).strftime(
+        "%Y-%m-%d")
+    END = ARGS.e or datetime.now().strftime("%Y-%m-%d")
+
+    MODEL = CostModel.from_history(spans_file=ARGS.S)
+    print(MODEL.describe())
+
+    TILES = [TILE[0] for TILE in search_tiles(START, END, FILTERS)[0]]
+    COUNTS = input_counts(TILES, FILTERS, START, END)
+    JOBS = []
+    for TILE in TILES:
+        TILE_COUNTS = dict((FILT, COUNTS[(TILE, FILT)]) for FILT in FILTERS
+                           if (TILE, FILT) in COUNTS)
+        SECONDS, MEMORY = MODEL.predict_tile(TILE_COUNTS)
+        JOBS.append({'name': TILE,
+                     'nframes': sum(TILE_COUNTS.values()),
+                     'seconds': SECONDS,
+                     'cpus': ARGS.j,
+                     'memory_mb': MEMORY if MEMORY is not None else ARGS.m})
+
+    PLAN, MAKESPAN = simulate(JOBS, ARGS.c, ARGS.M)
+    _, FIFO_MAKESPAN = simulate(JOBS, ARGS.c, ARGS.M, longest_first=False)
+    print("\n{0:20s} {1:>8s} {2:>10s} {3:>10s} {4:>10s} {5:>10s}".format(
+        "tile", "frames", "seconds", "memory MB", "start", "end"))
+    for JOB in PLAN:
+        print("{0:20s} {1:8d} {2:10.0f} {3:10.0f} {4:10.0f} {5:10.0f}".format(
+            JOB['name'], JOB['nframes'], JOB['seconds'], JOB['memory_mb'],
+            JOB['start'], JOB['end']))
+    print("\nPredicted makespan: {0:.0f}s, {1:.0f}s in the discovery "
+          "order.".format(MAKESPAN, FIFO_MAKESPAN))
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- Coding: UTF-8 -*-
+"""
+Connection management for concurrent access to the Pipeline Data Base.
+pyDAL keeps one connection by thread. The ConnectionManager bounds the
+number of threads, or tasks, using the database at once, recycles their
+connections in the pyDAL pool, reconnects after the MySQL idle timeout and
+keeps statistics of the pool usage.
+"""
+import time
+import threading
+from contextlib import contextmanager
+
+from model import db
+
+# MySQL client errors of a lost connection: server gone away, lost
+# connection during query and lost connection to server.
+DISCONNECT_ERRORS = (2006, 2013, 2055)
+
+
+def _open_connection(database):
+    """
+    Open, or take from the pyDAL pool, the connection of the current
+    thread. pyDAL 17.7 only connects the thread that created the DAL, the
+    other threads call reconnect. Newer versions, with get_connection,
+    connect on first use.
+    """
+    adapter = database._adapter
+    if not hasattr(adapter, 'get_connection') and \
+            hasattr(adapter, 'reconnect'):
+        adapter.reconnect()
+
+
+def _close_connection(database, really):
+    """
+    Send the connection of the current thread back to the pyDAL pool, or
+    close it if really is True. ConnectionPool.close(action, really) is the
+    same from pyDAL 17.7, the version of requirements.txt, onwards. The
+    public DAL.close is used by adapters without it.
+    """
+    adapter = getattr(database, '_adapter', None)
+    if adapter is not None and hasattr(adapter, 'close'):
+        adapter.close(action=None, really=really)
+    else:
+        database.close()
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when no connection is free before the checkout timeout.
+    """
+    pass
+
+
+class ConnectionManager(object):
+    """
+    Bounded, thread-safe access to the database.
+    Each thread, or task, uses the database inside a session; in the
+    session the module level db, and so all query helpers, use a connection
+    owned by the current thread.
+    Attr:
+        database: The LazyDAL of model.py
+    Optional Attr:
+        pool_size: Maximum number of sessions open at once. The pyDAL pool
+                   of the database is configured at startup with the same
+                   size, database.configure(pool_size=...)
+        checkout_timeout: Maximum time, in seconds, waiting for a session.
+                          None waits forever.
+        max_idle_seconds: A connection idle for more than this time is
+                          tested, and open again if the server closed it
+    """
+
+    def __init__(self, database=db, pool_size=4, checkout_timeout=None,
+                 max_idle_seconds=600):
+        self._db = database
+        self._pool_size = pool_size
+        self._checkout_timeout = checkout_timeout
+        self._max_idle_seconds = max_idle_seconds
+        self._semaphore = threading.BoundedSemaphore(pool_size)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stats = {'checkouts': 0,
+                       'waits': 0,
+                       'wait_seconds': 0.0,
+                       'reconnects': 0,
+                       'errors': 0,
+                       'in_use': 0}
+
+    def _count(self, key, value=1):
+        with self._lock:
+            self._stats[key] += value
+
+    def stats(self):
+        """
+        Return a dictionary with the number of checkouts, the number of
+        checkouts that waited for a free connection and the total waiting
+        time, the number of reconnects and errors, and the sessions in use.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats['pool_size'] = self._pool_size
+        return stats
+
+    def is_disconnect(self, error):
+        """
+        Return True if the error means that the connection was lost.
+        """
+        args = getattr(error, 'args', ())
+        return len(args) != 0 and args[0] in DISCONNECT_ERRORS
+
+    def _reconnect(self, database):
+        _close_connection(database, really=True)
+        _open_connection(database)
+        self._count('reconnects')
+
+    def _check_idle(self, database):
+        last_use = getattr(self._local, 'last_use', None)
+        if last_use is None or \
+                time.time() - last_use < self._max_idle_seconds:
+            return
+        try:
+            database.executesql("SELECT 1")
+        except Exception as err:
+            if not self.is_disconnect(err):
+                raise
+            self._reconnect(database)
+
+    def _acquire(self):
+        if self._semaphore.acquire(False):
+            return
+        self._count('waits')
+        t0 = time.time()
+        if self._checkout_timeout is None:
+            acquired = self._semaphore.acquire()
+        else:
+            acquired = self._semaphore.acquire(True, self._checkout_timeout)
+        self._count('wait_seconds', time.time() - t0)
+        if not acquired:
+            raise PoolTimeout("No free connection after {} seconds".format(
+                self._checkout_timeout))
+
+    @contextmanager
+    def session(self):
+        """
+        Check out the database for the current thread. The transaction is
+        committed at the end of the session, or rolled back on errors, and
+        the connection goes back to the pool.
+        """
+        depth = getattr(self._local, 'depth', 0)
+        if depth != 0:
+            # Nested sessions share the connection of the outer one.
+            self._local.depth = depth + 1
+            try:
+                yield self._db
+            finally:
+                self._local.depth = depth
+            return
+
+        self._acquire()
+        self._count('checkouts')
+        self._count('in_use')
+        self._local.depth = 1
+        database = self._db.connect()
+        closed = False
+        try:
+            _open_connection(database)
+            self._check_idle(database)
+            try:
+                yield database
+                database.commit()
+            except Exception as err:
+                self._count('errors')
+                if self.is_disconnect(err):
+                    # Do not send a broken connection back to the pool.
+                    _close_connection(database, really=True)
+                    closed = True
+                else:
+                    database.rollback()
+                raise
+        finally:
+            self._local.depth = 0
+            self._local.last_use = time.time()
+            if not closed:
+                _close_connection(database, really=False)
+            self._count('in_use', -1)
+            self._semaphore.release()
+
+    def run(self, function, *args, **kwargs):
+        """
+        Run function(*args, **kwargs) inside a session. If the connection
+        is lost, the function runs once more with a new connection.
+        """
+        for attempt in range(2):
+            try:
+                with self.session():
+                    return function(*args, **kwargs)
+            except Exception as err:
+                if attempt == 0 and self.is_disconnect(err):
+                    self._count('reconnects')
+                    continue
+                raise
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- Coding: UTF-8 -*-
+"""
+In-process cache for the small dimension tables of the Pipeline Data Base.
+The tables frametype, filter, t80instrument, telescope and ccdchip almost
+never change, so the Name <-> id mapping is read once and reused by every
+query helper.
+"""
+import time
+import threading
+
+from model import db
+
+DIMENSION_TABLES = ('frametype', 'filter', 't80instrument', 'telescope',
+                    'ccdchip')
+
+
+class DimensionCache(object):
+    """
+    Memoized Name <-> id lookup for the dimension tables.
+    Attr:
+        database: The pyDAL database with the dimension tables
+    Optional Attr:
+        ttl: Time, in seconds, that a loaded table is kept. None means
+             that the table is kept until invalidate is called.
+        tables: Names of the cached tables
+    """
+
+    def __init__(self, database, ttl=3600, tables=DIMENSION_TABLES):
+        self._db = database
+        self._ttl = ttl
+        self._tables = tuple(tables)
+        self._ids = {}
+        self._names = {}
+        self._loaded_at = {}
+        self._lock = threading.Lock()
+
+    def _expired(self, table):
+        loaded_at = self._loaded_at.get(table)
+        if loaded_at is None:
+            return True
+        if self._ttl is None:
+            return False
+        return time.time() - loaded_at > self._ttl
+
+    def _load_table(self, table):
+        if table not in self._tables:
+            raise NameError("{} is not a dimension table".format(table))
+        dbtable = self._db[table]
+        rows = self._db(dbtable.id > 0).select(dbtable.id, dbtable.Name)
+        ids = {}
+        names = {}
+        for row in rows:
+            if row.Name is not None:
+                # MySQL compare strings ignoring the case.
+                ids.setdefault(row.Name.upper(), row.id)
+            names[row.id] = row.Name
+        self._ids[table] = ids
+        self._names[table] = names
+        self._loaded_at[table] = time.time()
+
+    def load(self, tables=None):
+        """
+        Read the full content of the dimension tables, one select by table.
+        """
+        with self._lock:
+            for table in tables or self._tables:
+                self._load_table(table)
+
+    def invalidate(self, table=None):
+        """
+        Drop the cached values of a table, or of all tables if table is
+        None. The values are read again in the next lookup.
+        """
+        with self._lock:
+            if table is None:
+                self._loaded_at.clear()
+            else:
+                self._loaded_at.pop(table, None)
+
+    def _get(self, table):
+        with self._lock:
+            if self._expired(table):
+                self._load_table(table)
+            return self._ids[table], self._names[table]
+
+    def id_of(self, table, name):
+        """
+        Return the id of the row with the given Name, or None if the name is
+        not found.
+        """
+        if name is None:
+            return None
+        ids, _ = self._get(table)
+        return ids.get(name.upper())
+
+    def ids_of(self, table, names):
+        """
+        Return a dictionary {name: id} for the names found in the table.
+        """
+        ids, _ = self._get(table)
+        return dict((name, ids[name.upper()]) for name in names
+                    if name.upper() in ids)
+
+    def name_of(self, table, row_id):
+        """
+        Return the Name of the row with the given id, or None if the id is
+        not found.
+        """
+        _, names = self._get(table)
+        return names.get(row_id)
+
+
+DIMENSIONS = DimensionCache(db)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- Coding: UTF-8 -*-
+"""
+Persistent index of the raw image headers.
+The header keywords used by the bot are saved in a sqlite file, keyed by
+the path of the image. An entry is valid while the size and the
+modification time of the image do not change, so rescans, backfills and
+debugging sessions do not need to read the raw images again.
+"""
+import sqlite3
+import threading
+
+from headerscan import HeaderRecord
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS headers (
+    path TEXT PRIMARY KEY,
+    name TEXT,
+    size INTEGER,
+    mtime INTEGER,
+    hdu INTEGER,
+    object TEXT,
+    crval1 REAL,
+    crval2 REAL,
+    exptime REAL
+);
+CREATE INDEX IF NOT EXISTS headers_name ON headers (name);
+'''
+
+_COLUMNS = "name, path, hdu, object, crval1, crval2, exptime"
+
+
+class HeaderIndex(object):
+    """
+    Header index stored in a sqlite file.
+    Attr:
+        filename: The sqlite file. It is created if it does not exist.
+    """
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(filename, check_same_thread=False)
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+
+    @staticmethod
+    def _record(row):
+        if row is None:
+            return None
+        return HeaderRecord(*(tuple(row) + (None,)))
+
+    def get(self, path, size, mtime):
+        """
+        Return the HeaderRecord of an image, or None if the image is not in
+        the index or if its size or modification time changed.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT {} FROM headers WHERE path=? AND size=? AND "
+                "mtime=?".format(_COLUMNS), (path, size, mtime)).fetchone()
+        return self._record(row)
+
+    def find(self, name):
+        """
+        Return the HeaderRecord of an image by its name in the pipeline
+        database, without checking the raw image, or None if it is not in
+        the index.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT {} FROM headers WHERE name=?".format(_COLUMNS),
+                (name,)).fetchone()
+        return self._record(row)
+
+    def put(self, record, size, mtime):
+        """
+        Save, or replace, the entry of an image.
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO headers (path, name, size, mtime, "
+                "hdu, object, crval1, crval2, exptime) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (record.path, record.name, size, mtime, record.hdu,
+                 record.object, record.crval1, record.crval2,
+                 record.exptime))
+
+    def commit(self):
+        """
+        Write the new entries to the sqlite file.
+        """
+        with self._lock:
+            self._conn.commit()
+
+    def close(self):
+        """
+        Commit and close the sqlite file.
+        """
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM headers").fetchone()[0]
+
+
+if __name__ == "__main__":
+    import argparse
+    PARSER = argparse.ArgumentParser(
+        description="Show the entries of the raw header index")
+
+    PARSER.add_argument("index",
+                        help="The sqlite file with the header index",
+                        type=str)
+
+    PARSER.add_argument("names",
+                        help="Names of images in the pipeline database",
+                        type=str,
+                        nargs='*')
+
+    ARGS = PARSER.parse_args()
+    INDEX = HeaderIndex(ARGS.index)
+    print("{} images in the index".format(len(INDEX)))
+    for NAME in ARGS.names:
+        print(INDEX.find(NAME))
+    INDEX.close()
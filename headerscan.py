@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- Coding: UTF-8 -*-
+"""
+Header-only scanner for the raw images of T80S.
+Only the FITS header blocks are read from disk: the data units are skipped
+with a seek, so a compressed .fits.fz costs a few 2880 bytes blocks instead
+of a full open and parse. The images are read by a bounded pool of threads.
+"""
+import os
+import sqlite3
+import logging
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from astropy.io import fits
+
+from config import RAW_PATH_PATTERN
+
+BLOCK_SIZE = 2880
+RAW_EXTENSIONS = ('fits', 'fits.fz', 'fz')
+EXPTIME_KEY = 'HIERARCH T80S DET EXPTIME'
+
+HeaderRecord = namedtuple('HeaderRecord', ['name', 'path', 'hdu', 'object',
+                                           'crval1', 'crval2', 'exptime',
+                                           'error'])
+
+
+def _data_size(header):
+    """
+    Return the size, in bytes and with padding, of the data unit that
+    follows the header.
+    """
+    naxis = header.get('NAXIS', 0)
+    if naxis == 0:
+        return 0
+    size = 1
+    for i in range(1, naxis + 1):
+        size *= header.get('NAXIS{}'.format(i), 0)
+    size = (abs(header.get('BITPIX', 8)) // 8
+            * header.get('GCOUNT', 1)
+            * (header.get('PCOUNT', 0) + size))
+    return ((size + BLOCK_SIZE - 1) // BLOCK_SIZE) * BLOCK_SIZE
+
+
+def read_headers(path, max_hdus=2):
+    """
+    Return the header of the first HDU that contains the T80S exposure time
+    and its index. If no HDU contain it, the header of the HDU 1, or of the
+    HDU 0 for single HDU files, is returned, as in the original astropy
+    based scan.
+    """
+    headers = []
+    with open(path, 'rb') as fin:
+        for index in range(max_hdus):
+            try:
+                header = fits.Header.fromfile(fin)
+            except EOFError:
+                break
+            if EXPTIME_KEY in header:
+                return index, header
+            headers.append(header)
+            fin.seek(_data_size(header), os.SEEK_CUR)
+
+    if len(headers) == 0:
+        raise IOError("No FITS header found in {}".format(path))
+    index = min(1, len(headers) - 1)
+    return index, headers[index]
+
+
+class HeaderScanner(object):
+    """
+    Parallel header scanner for raw images.
+    Optional Attr:
+        raw_path: Root directory of the raw images
+        max_workers: Number of threads reading headers
+        max_hdus: Maximum number of HDUs visited for each image
+        index: A HeaderIndex used to cache the headers between runs
+        trust_index: If True, images found in the index are not checked
+                     in the raw path
+        logger: logging.Logger used to report the errors of the index
+        extra: extra dictionary passed to the logger
+    """
+
+    def __init__(self, raw_path=RAW_PATH_PATTERN, max_workers=8, max_hdus=2,
+                 index=None, trust_index=False, logger=None, extra=None):
+        if raw_path[-1] != "/":
+            raw_path += "/"
+        self._raw_path = raw_path
+        self._max_workers = max_workers
+        self._max_hdus = max_hdus
+        self._index = index
+        self._trust_index = trust_index
+        self._logger = logger
+        self._extra = extra or {}
+        self._listing = {}
+        self._lock = threading.Lock()
+
+    def _index_call(self, method, *args):
+        """
+        Call a method of the index. If the sqlite file is locked or
+        corrupt, the error is logged and None is returned, so the header
+        is read from the image.
+        """
+        try:
+            return getattr(self._index, method)(*args)
+        except sqlite3.Error as err:
+            if self._logger is not None:
+                self._logger.log(logging.WARNING,
+                                 "Header index {0} failed: {1}".format(
+                                     method, err),
+                                 extra=self._extra)
+            return None
+
+    def _list_dir(self, dirname):
+        with self._lock:
+            if dirname not in self._listing:
+                try:
+                    self._listing[dirname] = set(os.listdir(dirname))
+                except OSError:
+                    self._listing[dirname] = None
+            return self._listing[dirname]
+
+    def clear(self):
+        """
+        Forget the directory listings, so new images can be found.
+        """
+        with self._lock:
+            self._listing.clear()
+
+    def locate(self, name):
+        """
+        Return the path of a raw image, trying the known extensions, or None
+        if the image is not found. Each directory is listed only once.
+        """
+        img_loc = self._raw_path + name
+        dirname, basename = os.path.split(img_loc)
+        listing = self._list_dir(dirname)
+        for ext in RAW_EXTENSIONS:
+            if listing is None:
+                if os.path.isfile(img_loc + ext):
+                    return img_loc + ext
+            elif basename + ext in listing:
+                return img_loc + ext
+        return None
+
+    def read(self, name, path):
+        """
+        Return the HeaderRecord of one image.
+        """
+        try:
+            if self._index is not None:
+                stat = os.stat(path)
+                record = self._index_call('get', path, stat.st_size,
+                                          stat.st_mtime_ns)
+                if record is not None:
+                    return record
+            hdu, header = read_headers(path, self._max_hdus)
+        except (IOError, OSError, ValueError) as err:
+            return HeaderRecord(name, path, None, None, None, None, None,
+                                str(err))
+        record = HeaderRecord(name,
+                              path,
+                              hdu,
+                              header.get('OBJECT'),
+                              header.get('CRVAL1'),
+                              header.get('CRVAL2'),
+                              header.get(EXPTIME_KEY, header.get('EXPTIME')),
+                              None)
+        if self._index is not None:
+            self._index_call('put', record, stat.st_size, stat.st_mtime_ns)
+        return record
+
+    def scan(self, names):
+        """
+        Return the HeaderRecord of each image found in the raw path, in the
+        same order of the input names. Images not found are skipped.
+        """
+        self.clear()
+        records = []
+        located = []
+        for name in names:
+            if self._index is not None and self._trust_index:
+                record = self._index_call('find', name)
+                if record is not None:
+                    records.append(record)
+                    continue
+            path = self.locate(name)
+            if path is not None:
+                records.append(None)
+                located.append((name, path))
+
+        if len(located) != 0:
+            workers = max(1, min(self._max_workers, len(located)))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                read = iter(executor.map(lambda item: self.read(*item),
+                                         located))
+                records = [next(read) if record is None else record
+                           for record in records]
+            if self._index is not None:
+                self._index_call('commit')
+        return records
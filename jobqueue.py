@@ -0,0 +1,579 @@
+#!/usr/bin/env python
+# -*- Coding: UTF-8 -*-
+"""
+Job queue of the reduction of the tiles, shared by bots in several hosts.
+The jobs, a tile in a filter for a period, are rows of t80jobqueue, as the
+loads of t80tilestoload. The master bias, and the master flat of each
+filter, of a period are jobs of the tile MASTERS, so each master is built
+once by one host: a flat job waits for the bias job, and the job of a tile
+waits for the flat job of its filter, DependsOn. A worker claims a queued
+job with a conditional UPDATE, so only one worker of all hosts gets it,
+and holds it with a lease
+renewed by its heartbeats while the reduction runs. The jobs of a worker
+that stopped sending heartbeats are queued again when their lease
+expires, until max_attempts.
+The leases are written with the clock of each worker, so the clocks of
+the hosts must be synchronised, e.g. by NTP.
+t80jobqueue is not in the schema of the Pipeline Data Base: the bot and
+the workers create it, or add its new columns, on start, see
+JobQueue.ensure_table.
+"""
+import os
+import time
+import signal
+import socket
+import logging
+import subprocess
+from datetime import datetime, timedelta
+
+from model import db
+from config import INSTRUMENT_CONFIG_FILE, JYPE_VERSION, FILTERS
+from reductiondag import RECIPE_FILTERS, MASTERS_TILE
+from schemaindexes import missing_indexes, create_index_sql
+
+QUEUED = 0
+RUNNING = 1
+DONE = 2
+FAILED = 3
+
+STATUS_NAMES = {QUEUED: "queued",
+                RUNNING: "running",
+                DONE: "done",
+                FAILED: "failed"}
+
+RECIPE_NAMES = dict((filt.upper(), filt) for filt in RECIPE_FILTERS)
+
+# The phase, see reductiondag.PHASES, runs only the stages of the job.
+DEFAULT_COMMAND = ("T80S_PHASE={phase} reductiondag.py {start_date} "
+                   "{end_date} " + INSTRUMENT_CONFIG_FILE + " {tile} " +
+                   JYPE_VERSION + " {mail_to} {filter_option}")
+
+# Time, in seconds, between two checks of a stop request while a job runs.
+STOP_POLL_SECONDS = 1
+
+# Columns added to t80jobqueue after its first version, and their types.
+ADDED_COLUMNS = (("DependsOn", "INTEGER"),)
+
+
+def job_phase(tile, filt):
+    """
+    Return the phase of the recipe that runs a job: "bias" and "flats" for
+    the jobs of the masters, or "tile".
+    """
+    if tile != MASTERS_TILE:
+        return "tile"
+    return "flats" if filt else "bias"
+
+
+def default_worker_id():
+    """
+    Return the name of the worker: host and process id.
+    """
+    return "{0}:{1}".format(socket.gethostname(), os.getpid())
+
+
+class JobQueue(object):
+    """
+    Queue of reduction jobs stored in t80jobqueue.
+    Optional Attr:
+        database: The pyDAL database, model.db
+        lease_seconds: Time that a claimed job is held without heartbeats
+        max_attempts: Number of times a job is claimed before it is
+                      marked as failed, when its workers stop
+    """
+
+    def __init__(self, database=db, lease_seconds=300, max_attempts=3):
+        self._db = database
+        self._lease_seconds = lease_seconds
+        self._max_attempts = max_attempts
+
+    @property
+    def lease_seconds(self):
+        return self._lease_seconds
+
+    def create_table(self):
+        """
+        Create t80jobqueue and its indexes, if they do not exist, e.g. in a
+        local sqlite database for tests.
+        """
+        table = self._db.t80jobqueue
+        sql = self._db._adapter.create_table(table, migrate=False)
+        self._db.executesql(sql.replace("CREATE TABLE",
+                                        "CREATE TABLE IF NOT EXISTS", 1))
+        for index in missing_indexes(self._db, tables=['t80jobqueue']):
+            self._db.executesql(create_index_sql(*index))
+        self._db.commit()
+
+    def existing_columns(self):
+        """
+        Return the list of columns of t80jobqueue in the database, or None
+        if the table does not exist.
+        """
+        if self._db._adapter.dbengine == "sqlite":
+            rows = self._db.executesql('PRAGMA table_info("t80jobqueue")')
+            columns = [row[1] for row in rows]
+        else:
+            rows = self._db.executesql(
+                "SELECT COLUMN_NAME FROM information_schema.COLUMNS "
+                "WHERE TABLE_SCHEMA = DATABASE() "
+                "AND TABLE_NAME = 't80jobqueue'")
+            columns = [row[0] for row in rows]
+        return columns or None
+
+    def ensure_table(self):
+        """
+        Create t80jobqueue if it does not exist, or add the columns of
+        ADDED_COLUMNS missing in an older table. Return the list of
+        executed ALTER TABLE statements.
+        """
+        columns = self.existing_columns()
+        if columns is None:
+            self.create_table()
+            return []
+        columns = [column.lower() for column in columns]
+        statements = ["ALTER TABLE t80jobqueue ADD COLUMN {0} {1};".format(
+            name, sqltype) for name, sqltype in ADDED_COLUMNS
+                      if name.lower() not in columns]
+        for sql in statements:
+            self._db.executesql(sql)
+        self._db.commit()
+        return statements
+
+    def enqueue(self, tiles, start_date, end_date, filters=FILTERS):
+        """
+        Add a job for each tile and filter, after the jobs of the master
+        bias and flats of the period, and return the number of new jobs.
+        Jobs already queued, running or done for the same period are not
+        added, and failed jobs are queued again.
+        """
+        table = self._db.t80jobqueue
+        filters = list(filters)
+        rows = self._db((table.TileName.belongs(list(tiles) +
+                                                [MASTERS_TILE]))
+                        &
+                        (table.StartDate == start_date)
+                        &
+                        (table.EndDate == end_date)).select(table.id,
+                                                            table.TileName,
+                                                            table.Filter,
+                                                            table.Status)
+        existing = dict(((row.TileName, row.Filter), row) for row in rows)
+
+        now = datetime.now()
+        njobs = [0]
+
+        def add(tile, filt, depends_on):
+            row = existing.get((tile, filt))
+            if row is None:
+                njobs[0] += 1
+                return table.insert(TileName=tile, Filter=filt,
+                                    StartDate=start_date, EndDate=end_date,
+                                    Status=QUEUED, Attempts=0,
+                                    DateInsert=now, DependsOn=depends_on)
+            if row.Status == FAILED:
+                self._db(table.id == row.id).update(Status=QUEUED,
+                                                    Worker=None,
+                                                    Attempts=0,
+                                                    ExitStatus=None,
+                                                    LeaseExpires=None)
+                njobs[0] += 1
+            return row.id
+
+        bias = add(MASTERS_TILE, "", None)
+        flats = dict((filt, add(MASTERS_TILE, filt, bias))
+                     for filt in filters)
+        for tile in tiles:
+            for filt in filters:
+                add(tile, filt, flats[filt])
+        self._db.commit()
+        return njobs[0]
+
+    def requeue_expired(self, now=None):
+        """
+        Queue again the running jobs whose lease expired, and mark as
+        failed the ones already claimed max_attempts times. Return the
+        number of queued and of failed jobs.
+        """
+        table = self._db.t80jobqueue
+        now = now or datetime.now()
+        expired = (table.Status == RUNNING) & (table.LeaseExpires < now)
+        nfailed = self._db(expired &
+                           (table.Attempts >= self._max_attempts)).update(
+                               Status=FAILED)
+        nqueued = self._db(expired &
+                           (table.Attempts < self._max_attempts)).update(
+                               Status=QUEUED,
+                               Worker=None,
+                               LeaseExpires=None)
+        # The jobs waiting for a failed master fail too. The ids are read
+        # first, MySQL does not update a table read by a subquery.
+        while True:
+            blocked = self._db((table.Status == QUEUED)
+                               &
+                               (table.DependsOn.belongs(
+                                   self._db(table.Status == FAILED)._select(
+                                       table.id)))).select(table.id)
+            if len(blocked) == 0:
+                break
+            nfailed += self._db(table.id.belongs(
+                [row.id for row in blocked])).update(Status=FAILED)
+        self._db.commit()
+        return nqueued, nfailed
+
+    def claim(self, worker, candidates=10):
+        """
+        Claim the oldest queued job whose dependency is done for the
+        worker, and return its row, or None if there is no such job.
+        Expired jobs are queued again before.
+        """
+        self.requeue_expired()
+        table = self._db.t80jobqueue
+        ready = (table.DependsOn == None) | table.DependsOn.belongs(
+            self._db(table.Status == DONE)._select(table.id))
+        rows = self._db((table.Status == QUEUED) & ready).select(
+            table.id, orderby=table.id, limitby=(0, candidates))
+        for row in rows:
+            now = datetime.now()
+            # Only one worker finds the job still queued.
+            nrows = self._db((table.id == row.id)
+                             &
+                             (table.Status == QUEUED)).update(
+                                 Status=RUNNING,
+                                 Worker=worker,
+                                 Attempts=table.Attempts + 1,
+                                 LeaseExpires=now + timedelta(
+                                     seconds=self._lease_seconds),
+                                 Heartbeat=now)
+            self._db.commit()
+            if nrows == 1:
+                return self._db(table.id == row.id).select().first()
+        return None
+
+    def _update_own(self, job_id, worker, **fields):
+        table = self._db.t80jobqueue
+        nrows = self._db((table.id == job_id)
+                         &
+                         (table.Worker == worker)
+                         &
+                         (table.Status == RUNNING)).update(**fields)
+        self._db.commit()
+        return nrows == 1
+
+    def heartbeat(self, job_id, worker):
+        """
+        Renew the lease of a job. Return False if the worker lost the job,
+        e.g. its lease expired and another worker claimed it.
+        """
+        now = datetime.now()
+        return self._update_own(job_id, worker,
+                                Heartbeat=now,
+                                LeaseExpires=now + timedelta(
+                                    seconds=self._lease_seconds))
+
+    def finish(self, job_id, worker, exit_status):
+        """
+        Mark a job as done, or as failed if exit_status is not 0. Return
+        False if the worker lost the job.
+        """
+        return self._update_own(job_id, worker,
+                                Status=DONE if exit_status == 0 else FAILED,
+                                ExitStatus=exit_status,
+                                LeaseExpires=None)
+
+    def release(self, job_id, worker):
+        """
+        Give back a job to the queue, e.g. when the worker is stopped. The
+        claim is not counted as an attempt.
+        """
+        return self._update_own(job_id, worker,
+                                Status=QUEUED,
+                                Worker=None,
+                                Attempts=self._db.t80jobqueue.Attempts - 1,
+                                LeaseExpires=None)
+
+    def counts(self):
+        """
+        Return a dictionary {status name: number of jobs}.
+        """
+        table = self._db.t80jobqueue
+        njobs = table.id.count()
+        rows = self._db(table.id > 0).select(table.Status, njobs,
+                                             groupby=table.Status)
+        counts = dict((name, 0) for name in STATUS_NAMES.values())
+        for row in rows:
+            counts[STATUS_NAMES[row.t80jobqueue.Status]] = row[njobs]
+        return counts
+
+    def jobs(self, status=None):
+        """
+        Return the rows of the jobs, optionally only with one status.
+        """
+        table = self._db.t80jobqueue
+        query = table.id > 0
+        if status is not None:
+            query &= table.Status == status
+        return self._db(query).select(orderby=table.id)
+
+
+class QueueWorker(object):
+    """
+    Claim jobs from a JobQueue and run their reduction, sending heartbeats
+    while the reduction runs.
+    Attr:
+        queue: The JobQueue
+    Optional Attr:
+        worker_id: Name of the worker, the default is host:pid
+        command: Command of a job, formatted with phase, tile, filter,
+                 filter_option, start_date, end_date and mail_to
+        mail_to: E-mail passed to the recipe
+        poll_seconds: Time between two claims when the queue is empty
+        heartbeat_seconds: Time between two heartbeats, the default is a
+                           third of the lease
+        logger: logging.Logger used to report the jobs
+        extra: extra dictionary passed to the logger
+    """
+
+    def __init__(self, queue, **kwargs):
+        self._queue = queue
+        self._worker_id = kwargs.get('worker_id') or default_worker_id()
+        self._command = kwargs.get('command', DEFAULT_COMMAND)
+        self._mail_to = kwargs.get('mail_to', "")
+        self._poll_seconds = kwargs.get('poll_seconds', 30)
+        self._heartbeat_seconds = kwargs.get('heartbeat_seconds',
+                                             queue.lease_seconds / 3.0)
+        self._logger = kwargs.get('logger')
+        self._extra = kwargs.get('extra', {})
+        self._stop = False
+
+    def _log(self, level, info):
+        if self._logger is not None:
+            self._logger.log(level, info, extra=self._extra)
+
+    def stop(self):
+        """
+        Stop the worker. The running reduction is stopped and its job is
+        given back to the queue.
+        """
+        self._stop = True
+
+    def command(self, job):
+        """
+        Return the command of a job.
+        """
+        filt = RECIPE_NAMES.get(job.Filter.upper(), job.Filter) \
+            if job.Filter else ""
+        return self._command.format(
+            phase=job_phase(job.TileName, job.Filter),
+            tile=job.TileName,
+            filter=filt,
+            filter_option="-f " + filt if filt else "",
+            start_date=job.StartDate,
+            end_date=job.EndDate,
+            mail_to=self._mail_to)
+
+    def run_job(self, job):
+        """
+        Run the reduction of a claimed job, and return its exit status, or
+        None if the worker lost the job, or was stopped, and stopped its
+        reduction.
+        """
+        info = "{0} claimed {1} {2} ({3} attempt).".format(
+            self._worker_id, job.TileName, job.Filter, job.Attempts)
+        self._log(logging.INFO, info)
+        process = subprocess.Popen(self.command(job), shell=True,
+                                   start_new_session=True)
+        next_heartbeat = time.time() + self._heartbeat_seconds
+        while True:
+            try:
+                returncode = process.wait(timeout=min(
+                    STOP_POLL_SECONDS, self._heartbeat_seconds))
+                break
+            except subprocess.TimeoutExpired:
+                pass
+            if self._stop:
+                self._kill(process)
+                self._queue.release(job.id, self._worker_id)
+                info = "{0} stopped, {1} {2} given back to the queue.".format(
+                    self._worker_id, job.TileName, job.Filter)
+                self._log(logging.WARNING, info)
+                return None
+            if time.time() < next_heartbeat:
+                continue
+            next_heartbeat = time.time() + self._heartbeat_seconds
+            if self._queue.heartbeat(job.id, self._worker_id):
+                continue
+            info = "{0} lost {1} {2}, stopping its reduction.".format(
+                self._worker_id, job.TileName, job.Filter)
+            self._log(logging.ERROR, info)
+            self._kill(process)
+            return None
+
+        self._queue.finish(job.id, self._worker_id, returncode)
+        info = "{0} finished {1} {2} with exit status {3}.".format(
+            self._worker_id, job.TileName, job.Filter, returncode)
+        self._log(logging.INFO if returncode == 0 else logging.ERROR, info)
+        return returncode
+
+    @staticmethod
+    def _kill(process):
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+        except OSError:
+            pass
+        process.wait()
+
+    def run(self, max_jobs=None, exit_when_empty=False):
+        """
+        Claim and run jobs until stop, max_jobs, or, with exit_when_empty,
+        until no job is queued or running. Return the number of jobs run.
+        """
+        njobs = 0
+        while not self._stop and (max_jobs is None or njobs < max_jobs):
+            job = self._queue.claim(self._worker_id)
+            if job is None:
+                # A running job may be queued again if its worker stops.
+                if exit_when_empty and self._queue.counts()['running'] == 0:
+                    break
+                time.sleep(self._poll_seconds)
+                continue
+            self.run_job(job)
+            njobs += 1
+        return njobs
+
+
+def demo(uri, nworkers, njobs, seconds, lease_seconds):
+    """
+    Run nworkers worker processes, standing in for hosts, on njobs jobs
+    that sleep for some seconds. The first worker is killed during its
+    first job, so its job is queued again when the lease expires.
+    """
+    import sys
+
+    queue = JobQueue(lease_seconds=lease_seconds)
+    queue.create_table()
+    db((db.t80jobqueue.TileName.startswith("DEMO_")) |
+       (db.t80jobqueue.TileName == MASTERS_TILE)).delete()
+    db.commit()
+    queue.enqueue(["DEMO_{:03d}".format(i) for i in range(njobs)],
+                  "2026-10-18", "2026-10-18", ["R"])
+
+    def worker(name):
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                 "-u", uri, "-l", str(lease_seconds),
+                                 "work", "-i", name, "-e", "-p", "0.2",
+                                 "-x", "sleep {}".format(seconds)])
+
+    workers = [worker("host{}".format(i)) for i in range(nworkers)]
+    time.sleep(seconds / 2.0 + 1)
+    print("Killing host0 during its job.")
+    workers[0].kill()
+    for process in workers[1:]:
+        process.wait()
+
+    print("{0:10s} {1:8s} {2:8s} {3:>8s}".format("tile", "status",
+                                                 "worker", "attempts"))
+    for job in queue.jobs():
+        print("{0:10s} {1:8s} {2:8s} {3:8d}".format(
+            job.TileName, STATUS_NAMES[job.Status], job.Worker or "-",
+            job.Attempts))
+    print(queue.counts())
+
+
+if __name__ == "__main__":
+    import argparse
+    DESCRIPTION = '''Job queue of the reduction of the tiles, shared by bots
+    in several hosts. "work" runs a worker, "enqueue" adds the jobs of
+    tiles and of their masters, "status" lists the jobs, "create" creates the table and "demo"
+    runs several worker processes on a test database, e.g.
+    -u sqlite:///tmp/queue.sqlite.
+    '''
+    PARSER = argparse.ArgumentParser(description=DESCRIPTION)
+
+    PARSER.add_argument("-u",
+                        help="pyDAL connection string of the database, the "
+                             "default is the Pipeline Data Base",
+                        type=str,
+                        default=None)
+    PARSER.add_argument("-l",
+                        help="Lease, in seconds, of a claimed job, the "
+                             "default is 300, and 3 in the demo",
+                        type=float,
+                        default=None)
+    PARSER.add_argument("-a",
+                        help="Maximum number of attempts of a job",
+                        type=int,
+                        default=3)
+
+    SUBPARSERS = PARSER.add_subparsers(dest="action")
+    SUBPARSERS.required = True
+
+    SUBPARSERS.add_parser("create", help="Create the queue table, or add "
+                                         "its missing columns")
+
+    ENQUEUE = SUBPARSERS.add_parser("enqueue", help="Add jobs")
+    ENQUEUE.add_argument("start_date", help="Start date yyyy-mm-dd")
+    ENQUEUE.add_argument("end_date", help="End date yyyy-mm-dd")
+    ENQUEUE.add_argument("tiles", help="Tiles", nargs='+')
+    ENQUEUE.add_argument("-f", help="Filters, one job by filter",
+                         nargs='+', default=list(FILTERS))
+
+    WORK = SUBPARSERS.add_parser("work", help="Run a worker")
+    WORK.add_argument("-i", help="Name of the worker", type=str,
+                      default=None)
+    WORK.add_argument("-x", help="Command of a job, see QueueWorker",
+                      type=str, default=DEFAULT_COMMAND)
+    WORK.add_argument("-m", help="E-mail passed to the recipe", type=str,
+                      default="")
+    WORK.add_argument("-n", help="Maximum number of jobs", type=int,
+                      default=None)
+    WORK.add_argument("-p", help="Time, in seconds, between two claims "
+                                 "when the queue is empty",
+                      type=float, default=30)
+    WORK.add_argument("-e", help="Exit when the queue is empty",
+                      action="store_true")
+
+    SUBPARSERS.add_parser("status", help="List the jobs")
+
+    DEMO = SUBPARSERS.add_parser("demo", help="Run worker processes on "
+                                              "sleeping jobs")
+    DEMO.add_argument("-w", help="Number of workers", type=int, default=3)
+    DEMO.add_argument("-j", help="Number of jobs", type=int, default=9)
+    DEMO.add_argument("-s", help="Seconds of each job", type=float,
+                      default=2)
+
+    ARGS = PARSER.parse_args()
+    if ARGS.u is not None:
+        db.bind(ARGS.u, folder=os.getcwd(), check_reserved=False)
+    elif ARGS.action == "demo":
+        PARSER.error("demo needs a test database, -u")
+
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)-15s %(message)s")
+    if ARGS.l is None:
+        ARGS.l = 3 if ARGS.action == "demo" else 300
+    QUEUE = JobQueue(lease_seconds=ARGS.l, max_attempts=ARGS.a)
+
+    if ARGS.action in ("create", "enqueue", "work"):
+        for SQL in QUEUE.ensure_table():
+            print(SQL)
+
+    if ARGS.action == "enqueue":
+        print("{} jobs queued".format(QUEUE.enqueue(ARGS.tiles,
+                                                    ARGS.start_date,
+                                                    ARGS.end_date,
+                                                    ARGS.f)))
+    elif ARGS.action == "work":
+        WORKER = QueueWorker(QUEUE, worker_id=ARGS.i, command=ARGS.x,
+                             mail_to=ARGS.m, poll_seconds=ARGS.p,
+                             logger=logging.getLogger())
+        signal.signal(signal.SIGTERM, lambda *_: WORKER.stop())
+        signal.signal(signal.SIGINT, lambda *_: WORKER.stop())
+        WORKER.run(ARGS.n, ARGS.e)
+    elif ARGS.action == "status":
+        for JOB in QUEUE.jobs():
+            print("{0} {1} {2} {3} {4} {5} {6}".format(
+                JOB.TileName, JOB.Filter or "-", JOB.StartDate, JOB.EndDate,
+                STATUS_NAMES[JOB.Status], JOB.Worker or "-", JOB.Attempts))
+        print(QUEUE.counts())
+    elif ARGS.action == "demo":
+        demo(ARGS.u, ARGS.w, ARGS.j, ARGS.s, ARGS.l)
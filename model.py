@@ -2,15 +2,149 @@
 # -*- Coding: UTF-8 -*-
 """
 The Pipeline Data Base Model for pyDAL.
+The connection with the database is open only on first use, and each table
+is defined only the first time it is accessed.
 """
+import copy
+import threading
+
 from pydal import Field, DAL
 from config import DB_NAME, DB_USER_NAME, DB_PASSWORD, DB_ADDRESS
 
 
-db = DAL('mysql://{0}:{1}@{2}/{3}'.format(DB_USER_NAME,
-                                          DB_PASSWORD,
-                                          DB_ADDRESS,
-                                          DB_NAME), check_reserved=False)
+class LazyDAL(object):
+    """
+    Lazy registry for the pyDAL database.
+    The table definitions are only recorded at import time. The DAL object
+    is created, and the connection is open, on the first access to any
+    attribute, table or query. The tables are defined with lazy_tables,
+    so pyDAL builds a table only the first time it is used.
+    Attr:
+        uri: The pyDAL connection string
+    Optional Attr:
+        Any keyword accepted by pydal.DAL
+    """
+
+    _OWN_ATTRS = frozenset(['_uri', '_kwargs', '_definitions', '_indexes',
+                            '_db', '_lock'])
+
+    def __init__(self, uri, **kwargs):
+        self._uri = uri
+        self._kwargs = kwargs
+        self._definitions = []
+        self._indexes = []
+        self._db = None
+        self._lock = threading.RLock()
+
+    def define_table(self, tablename, *fields, **kwargs):
+        """
+        Record the definition of a table, to be created on first use.
+        """
+        with self._lock:
+            self._definitions.append((tablename, fields, kwargs))
+            if self._db is not None:
+                self._define(self._db, tablename, fields, kwargs)
+
+    def define_index(self, tablename, name, *columns):
+        """
+        Record an index needed by the queries on a table. The indexes are
+        not created here, see schemaindexes.py.
+        """
+        with self._lock:
+            self._indexes.append((tablename, name, tuple(columns)))
+
+    def indexes(self):
+        """
+        Return the list of recorded indexes, as tuples
+        (tablename, name, columns).
+        """
+        return list(self._indexes)
+
+    @staticmethod
+    def _define(database, tablename, fields, kwargs):
+        fields = [copy.copy(field) for field in fields]
+        database.define_table(tablename, *fields, **kwargs)
+
+    def bind(self, uri, **kwargs):
+        """
+        Set a new connection string, e.g. a local sqlite database for
+        benchmarks. If the database is already connected, the connection
+        is closed and a new one is open on next use.
+        """
+        with self._lock:
+            self.close()
+            self._uri = uri
+            self._kwargs = kwargs
+
+    def configure(self, **kwargs):
+        """
+        Update the keywords passed to pydal.DAL, e.g. pool_size. If the
+        database is already connected, the connection is closed and a new
+        one is open on next use.
+        """
+        with self._lock:
+            self.close()
+            self._kwargs.update(kwargs)
+
+    def definitions(self):
+        """
+        Return the list of recorded definitions, as tuples
+        (tablename, fields, kwargs).
+        """
+        return list(self._definitions)
+
+    @property
+    def connected(self):
+        """
+        Return True if the DAL object was already created.
+        """
+        return self._db is not None
+
+    def connect(self):
+        """
+        Return the pyDAL database, creating it if it is the first use.
+        """
+        database = self._db
+        if database is None:
+            with self._lock:
+                if self._db is None:
+                    kwargs = dict(self._kwargs)
+                    kwargs['lazy_tables'] = True
+                    database = DAL(self._uri, **kwargs)
+                    for tablename, fields, tkwargs in self._definitions:
+                        self._define(database, tablename, fields, tkwargs)
+                    self._db = database
+                database = self._db
+        return database
+
+    def close(self):
+        """
+        Close the connection, if it is open.
+        """
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def __getattr__(self, name):
+        if name in LazyDAL._OWN_ATTRS:
+            raise AttributeError(name)
+        return getattr(self.connect(), name)
+
+    def __getitem__(self, name):
+        return self.connect()[name]
+
+    def __contains__(self, name):
+        return name in self.connect()
+
+    def __call__(self, *args, **kwargs):
+        return self.connect()(*args, **kwargs)
+
+
+db = LazyDAL('mysql://{0}:{1}@{2}/{3}'.format(DB_USER_NAME,
+                                              DB_PASSWORD,
+                                              DB_ADDRESS,
+                                              DB_NAME), check_reserved=False)
 
 db.define_table('AstromParam',
                 Field('DISTORT_DEGREES', type='integer', length=3),
@@ -548,6 +682,8 @@ db.define_table('t80cfImgs',
                 Field('RC_ID', type='mediumint', length=8),
                 migrate=False)
 
+db.define_index('t80cfImgs', 'idx_t80cfimgs_cf', 'CF_ID')
+
 db.define_table('t80cftab',
                 Field('CFname', type='string', length=50),
                 Field('CFtype_ID', type='integer', length=3),
@@ -586,6 +722,9 @@ db.define_table('t80cftab',
                 Field('BlockExec', type='integer', length=3),
                 migrate=False)
 
+db.define_index('t80cftab', 'idx_t80cftab_type_filter_valid',
+                'CFtype_ID', 'Filter_ID', 'is_valid')
+
 db.define_table('t80instrument',
                 Field('Name', type='string', length=15),
                 Field('Telescope_ID', type='integer', length=3),
@@ -609,6 +748,26 @@ db.define_table('t80nighttab',
                 Field('NightQM', type='integer', length=4),
                 migrate=False)
 
+db.define_table('t80jobqueue',
+                Field('TileName', type='string', length=45),
+                Field('Filter', type='string', length=10),
+                Field('StartDate', type='date'),
+                Field('EndDate', type='date'),
+                Field('Status', type='integer', length=1),
+                Field('Worker', type='string', length=64),
+                Field('Attempts', type='integer', length=3),
+                Field('ExitStatus', type='integer', length=3),
+                Field('LeaseExpires', type='datetime'),
+                Field('Heartbeat', type='datetime'),
+                Field('DateInsert', type='datetime'),
+                Field('DependsOn', type='integer'),
+                migrate=False)
+
+db.define_index('t80jobqueue', 'idx_t80jobqueue_status_lease',
+                'Status', 'LeaseExpires')
+db.define_index('t80jobqueue', 'idx_t80jobqueue_tile',
+                'TileName', 'Filter', 'StartDate', 'EndDate')
+
 db.define_table('t80oa',
                 Field('Name', type='char', length=55),
                 Field('Origfile', type='char', length=55),
@@ -687,6 +846,12 @@ db.define_table('t80oa',
                 Field('Insert_Code', type='integer', length=3),
                 migrate=False)
 
+db.define_index('t80oa', 'idx_t80oa_type_filter_date',
+                'ImageType_ID', 'Filter_ID', 'Date')
+db.define_index('t80oa', 'idx_t80oa_type_date', 'ImageType_ID', 'Date')
+db.define_index('t80oa', 'idx_t80oa_object', 'Object')
+db.define_index('t80oa', 'idx_t80oa_updatedate', 'UPDATEDATE_OA')
+
 db.define_table('t80tileImgs',
                 Field('Tile_ID', type='mediumint', length=8),
                 Field('RC_ID', type='mediumint', length=8),
@@ -785,6 +950,9 @@ db.define_table('t80tilesinfo',
                 Field('TileType', type='integer', length=3),
                 migrate=False)
 
+db.define_index('t80tilesinfo', 'idx_t80tilesinfo_tile_filter',
+                'TileName', 'Filter_ID')
+
 db.define_table('t80tilestoload',
                 Field('tile_ID', type='mediumint', length=8),
                 Field('ref_tile_ID', type='mediumint', length=8),
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- Coding: UTF-8 -*-
+"""
+Event-driven trigger for new data.
+The science frames ingested in t80oa are followed with an id watermark.
+A tile is reported as ready when no new frame of it arrived during a quiet
+period, so a tile whose frames are still being ingested is not reduced
+with partial data.
+"""
+import os
+import json
+import time
+
+from model import db
+from dimensions import DIMENSIONS
+from config import FILTERS
+
+
+class NewDataWatcher(object):
+    """
+    Poll t80oa for new science frames.
+    Optional Attr:
+        debounce_seconds: Quiet period, in seconds, after the last new frame
+                          of a tile, before the tile is ready
+        watermark_file: JSON file where the watermark and the pending tiles
+                        are saved, so a restart does not lose them
+        filters: Only frames in these filters are followed
+    """
+
+    def __init__(self, debounce_seconds=1800, watermark_file=None,
+                 filters=FILTERS):
+        self._debounce_seconds = debounce_seconds
+        self._watermark_file = watermark_file
+        self._filters = filters
+        self._last_id = None
+        self._pending = {}
+        self._load()
+
+    def _load(self):
+        if self._watermark_file is None:
+            return
+        if not os.path.isfile(self._watermark_file):
+            return
+        with open(self._watermark_file) as fin:
+            state = json.load(fin)
+        self._last_id = state.get('last_id')
+        self._pending = state.get('pending', {})
+
+    def _save(self):
+        if self._watermark_file is None:
+            return
+        tmp_file = self._watermark_file + ".tmp"
+        with open(tmp_file, 'w') as fout:
+            json.dump({'last_id': self._last_id, 'pending': self._pending},
+                      fout)
+        os.rename(tmp_file, self._watermark_file)
+
+    @property
+    def last_id(self):
+        """
+        Return the id of the last frame seen in t80oa.
+        """
+        return self._last_id
+
+    def pending(self):
+        """
+        Return the tiles with new frames that are not ready yet.
+        """
+        return sorted(self._pending)
+
+    def poll(self, now=None):
+        """
+        Read the science frames ingested since the last poll, and return
+        the list of tiles whose last new frame is older than the quiet
+        period. In the first poll, without a saved watermark, only the
+        watermark is set.
+        """
+        if now is None:
+            now = time.time()
+
+        type_id = DIMENSIONS.id_of('frametype', 'SCIE')
+        if self._last_id is None:
+            self._last_id = db(db.t80oa).select(
+                db.t80oa.id.max()).first()[db.t80oa.id.max()] or 0
+            self._save()
+            return []
+
+        filters_ids = list(DIMENSIONS.ids_of('filter', self._filters).values())
+        rows = db((db.t80oa.id > self._last_id)
+                  &
+                  (db.t80oa.ImageType_ID == type_id)
+                  &
+                  (db.t80oa.Filter_ID.belongs(filters_ids))).select(
+                      db.t80oa.id.max(),
+                      db.t80oa.Object,
+                      groupby=db.t80oa.Object)
+
+        for row in rows:
+            last_id = row[db.t80oa.id.max()]
+            self._last_id = max(self._last_id, last_id)
+            if row.t80oa.Object is not None:
+                self._pending[row.t80oa.Object] = now
+
+        ready = [tile for tile, seen in self._pending.items()
+                 if now - seen >= self._debounce_seconds]
+        for tile in ready:
+            del self._pending[tile]
+        self._save()
+        return sorted(ready)
+
+    def defer(self, tiles, now=None):
+        """
+        Put tiles back in the pending list, to be reported again after the
+        quiet period.
+        """
+        if now is None:
+            now = time.time()
+        for tile in tiles:
+            self._pending[tile] = now
+        self._save()
@@ -27,6 +27,59 @@ function splitDate(){
     dd=${a[2]}
 }
 
+function span(){
+    # Run a stage, and append its timing span to $T80S_SPANS_FILE, if set.
+    local stage=$1
+    shift
+    local start=$(date +%s.%N)
+    "$@"
+    local rc=$?
+    if [ -n "$T80S_SPANS_FILE" ]; then
+        local status=ok
+        if [ $rc -ne 0 ]; then
+            status=error
+        fi
+        echo "{\"stage\": \"$stage\", \"tile\": \"$tile\", \"start\": $start, \"end\": $(date +%s.%N), \"status\": \"$status\", \"returncode\": $rc}" >> $T80S_SPANS_FILE
+    fi
+    return $rc
+}
+
+function stage(){
+    # Run a stage of a filter, or of all filters if the filter is "".
+    # With $T80S_CHECKPOINTS, a stage already done for the tile and period
+    # is skipped, and the stage is saved as done or failed when it ends.
+    local name=$1
+    local filt=$2
+    shift 2
+    if [ -n "$T80S_CHECKPOINTS" ]; then
+        if checkpoints.py $T80S_CHECKPOINTS done $tile $sDate $eDate $name $filt; then
+            echo "Skipping $name $filt for $tile, already done."
+            return 0
+        fi
+    fi
+    span $name${filt:+_$filt} "$@"
+    local rc=$?
+    if [ -n "$T80S_CHECKPOINTS" ]; then
+        if [ $rc -eq 0 ]; then
+            checkpoints.py $T80S_CHECKPOINTS mark $tile $sDate $eDate $name $filt
+        else
+            checkpoints.py $T80S_CHECKPOINTS fail $tile $sDate $eDate $name $filt
+        fi
+    fi
+    if [ $rc -ne 0 ]; then
+        failed=1
+    fi
+    return $rc
+}
+
+function resetStages(){
+    # Remove the checkpoints of the stages $1, separated by commas, of the
+    # filter $2, or of all filters, when the master they read is rebuilt.
+    if [ -n "$T80S_CHECKPOINTS" ]; then
+        checkpoints.py $T80S_CHECKPOINTS reset $tile $sDate $eDate $1 $2
+    fi
+}
+
 function sendmail(){
     msg=$1
     if [ $mailTo != '' ]; then
@@ -78,42 +131,177 @@ nprR=3
 ei=e
 vcf=0
 
+#Set to 1 when a stage fails, so the bot can resume the reduction.
+failed=0
+
+filters=(R I G F660 U z F378 F395 F410 F861 F515 F430)
+
+#With $T80S_PHASE, only a part of the recipe runs: "masters" builds the
+#master bias and flats, "tile" reduces and combines the images of the tile
+#with the valid masters, "bias" and "flats" build only those masters. The
+#bot builds the masters once, before reducing several tiles at once.
+phase=${T80S_PHASE:-all}
+
+function inPhase(){
+    case $phase in
+        all) return 0;;
+        masters) [ "$1" != "tile" ];;
+        *) [ "$1" == "$phase" ];;
+    esac
+}
+
+function selective(){
+    # Invalidate only the previous master of each rebuilt master, instead
+    # of all the masters.
+    [ -n "$T80S_REUSE_MASTERS" ] || [ "$phase" != "all" ]
+}
+
+#With $T80S_ADAPTIVE_WINDOW, the master bias and each master flat use the
+#narrowest window, ending at $eDate, with the minimum number of frames, and
+#the filters without enough flats are skipped.
+declare -A windowStart
+if [ -n "$T80S_ADAPTIVE_WINDOW" ]; then
+    while read cftype filt start end nframes;
+    do
+        if [ "$cftype" == "BIAS" ]; then
+            filt=BIAS
+        fi
+        if [ "$start" == "none" ]; then
+            echo "Only $nframes frames found for the master $cftype $filt."
+            continue
+        fi
+        windowStart[$filt]=$start
+    done < <(calibrationwindow.py $sDate $eDate "${filters[@]}")
+
+    readyFilters=()
+    for filt in "${filters[@]}";
+    do
+        if [ -n "${windowStart[$filt]}" ]; then
+            readyFilters+=($filt)
+        else
+            echo "Skipping filter $filt."
+        fi
+    done
+    filters=("${readyFilters[@]}")
+    # The flats are corrected by the bias.
+    if [ -z "${windowStart[BIAS]}" ]; then
+        echo "Skipping the master bias and all filters."
+        filters=()
+    fi
+fi
+
+function start(){
+    # Start date of the window of a master: BIAS or the filter.
+    echo ${windowStart[$1]:-$sDate}
+}
+
+function period(){
+    # Period in the name of a master, from its start date to $eDate.
+    splitDate $1
+    echo b$yyyy$mm$dd$ei$mm1$dd1
+}
+
+function skipped(){
+    # A master without window, or a flat without the window of the bias.
+    [ -n "$T80S_ADAPTIVE_WINDOW" ] && \
+        { [ -z "${windowStart[$1]}" ] || [ -z "${windowStart[BIAS]}" ]; }
+}
+
+#With $T80S_REUSE_MASTERS, the valid masters built from the same input
+#frames are reused. BIAS, and the filters, of the reused masters.
+reusedMasters=""
+if [ -n "$T80S_REUSE_MASTERS" ] && [ "$phase" != "tile" ]; then
+    if calibrations.py $sDate $eDate reuse BIAS ${T80S_ADAPTIVE_WINDOW:+-w}; then
+        reusedMasters="BIAS"
+        for filt in "${filters[@]}";
+        do
+            if calibrations.py $sDate $eDate reuse FLAS $filt ${T80S_ADAPTIVE_WINDOW:+-w}; then
+                reusedMasters="$reusedMasters $filt"
+            fi
+        done
+    fi
+fi
+
+function reused(){
+    [[ " $reusedMasters " == *" $1 "* ]]
+}
+
+function masterFlat(){
+    # Build the master sky-flat of a filter, invalidating only the
+    # previous master of the same filter when masters are reused.
+    local filt=$1
+    resetStages validate,cosmet,coadd $filt
+    if selective; then
+        calibrations.py $sDate $eDate invalidate FLAS $filt
+    fi
+    runcf.py  -s $(start $filt) -e $eDate  -t 16 --instconfig $inst -f $filt
+}
+
 function parallelMasterFlat(){
     # Warning: The pipelie has a large space complexity,
     # max recomeded three filters.
+    # The status of each background stage is read by wait in this shell,
+    # a failure set inside the subshell would be lost.
     local filters=($1 $2 $3 $4)
+    local pids=()
     for filt in "${filters[@]}";
     do
+          if skipped $filt; then
+              continue
+          fi
+          if reused $filt; then
+              echo "Reusing the master sky-flat for filter $filt."
+              continue
+          fi
           echo ''
           echo ''
           echo ''
           echo "Starting the creation of master sky-flat for filter $filt."
           echo ''
           echo ''
-          runcf.py  -s $sDate -e $eDate  -t 16 --instconfig $inst -f $filt &
+          stage flat $filt masterFlat $filt &
+          pids+=($!)
           echo ''
           echo ''
           echo ''
     done
-    wait
+    for pid in "${pids[@]}";
+    do
+        wait "$pid" || failed=1
+    done
 
 }
 
-echo ""
-echo "Invalidating all previous master frame."
-jsubmitsql.py "update t80cftab set is_valid=1 where is_valid=0"
-echo ""
-echo "Creating and validating the Master Bias"
-echo "Starting..."
-{
-    runcf.py  -s $sDate -e $eDate -t 4 --instconfig $inst
-} || {
-    sendmail "Bias Not Generated"
-    exit 1
+if inPhase bias && ! skipped BIAS; then
+    if reused BIAS; then
+        echo ""
+        echo "Reusing the Master Bias, its input frames did not change."
+    else
+        echo ""
+        if selective; then
+            echo "Invalidating the previous master bias."
+            stage invalidate "" calibrations.py $sDate $eDate invalidate BIAS
+        else
+            echo "Invalidating all previous master frame."
+            stage invalidate "" jsubmitsql.py "update t80cftab set is_valid=1 where is_valid=0"
+        fi
+        echo ""
+        echo "Creating and validating the Master Bias"
+        echo "Starting..."
+        if [ -n "$T80S_CHECKPOINTS" ] && ! checkpoints.py $T80S_CHECKPOINTS done $tile $sDate $eDate bias; then
+            resetStages validate_bias,flat,validate,cosmet,coadd
+        fi
+        {
+            stage bias "" runcf.py  -s $(start BIAS) -e $eDate -t 4 --instconfig $inst
+        } || {
+            sendmail "Bias Not Generated"
+            exit 1
 
-}
+        }
 
-validateCF.py j02-BIAS-b$yyyy0$mm0$dd0$ei$mm1$dd1-00-$cName $vcf
+        stage validate_bias "" validateCF.py j02-BIAS-$(period $(start BIAS))-00-$cName $vcf
+    fi
+fi
 
 echo ""
 echo "Creating the Master Sky-Flat, and, performing the reduction"
@@ -121,19 +309,27 @@ echo "of individual images for the field $tile."
 
 echo ""
 
-parallelMasterFlat R I G F660
-parallelMasterFlat U z F378 F395
-parallelMasterFlat F410 F861 F515 F430
+if inPhase flats; then
+    parallelMasterFlat R I G F660
+    parallelMasterFlat U z F378 F395
+    parallelMasterFlat F410 F861 F515 F430
 
-filters=(R I G F660 U z F378 F395 F410 F861 F515 F430)
+    for filt in "${filters[@]}";
+    do
+        reused $filt || stage validate $filt validateCF.py j02-FLAS-$(period $(start $filt))-$filt-00-$cName $vcf
+    done
+fi
+
+if ! inPhase tile; then
+    echo "Master frames finished..."
+    exit $failed
+fi
 
 for filt in "${filters[@]}";
 do
     echo "Starting the reduction of individual images"
     echo "for filter $filt and field $tile."
-    validateCF.py j02-FLAS-b$yyyy0$mm0$dd0$ei$mm1$dd1-$filt-00-$cName $vcf
-    jgetlist.py -t SCIE -f $filt --addcond "Object like '%${tile:0:3}%'" -s $sDate -e $eDate |xargs -I ARG -P $nprR runcosmet.py -o -u ARG
-    jgetlist.py -t SCIE -f $filt --addcond "Object like '%${tile:0:3}%'" -s $sDate -e $eDate |xargs -I ARG -P $nprR runcosmet.py  ARG
+    stage cosmet $filt cosmetstage.py -t $tile -f $filt -s $sDate -e $eDate -p $nprR
     echo ''
     echo ''
 done
@@ -149,7 +345,7 @@ do
     echo ''
     echo ''
     echo ''
-    runcoadding.py -u -o $tile $filt
+    stage coadd $filt runcoadding.py -u -o $tile $filt
 done
 wait
 
@@ -157,3 +353,4 @@ wait
 sendmail
 
 echo "Reduction finished..."
+exit $failed
@@ -9,21 +9,39 @@ import time
 from datetime import datetime, timedelta
 import sched
 import os
-from subprocess import check_call, CalledProcessError
 import copy
+import signal
 import logging
 
-from astropy.io import fits
-
 from config import JYPE_VERSION
 from config import FILTERS, MIN_COMBINE_NUMBER_FLAT, MIN_COMBINE_NUMBER_BIAS
 from config import INSTRUMENT_CONFIG_FILE, RAW_PATH_PATTERN
-from searchimages import count_images, search_images
+from model import db
+from searchimages import count_images_bulk, search_images_bulk, search_tiles
+from searchimages import IncrementalImageCounter
+from headerscan import HeaderScanner
+from headerindex import HeaderIndex
+from tilescheduler import TileScheduler, total_memory_mb
+from tilehashes import InputHashStore, tile_input_hashes, changed_filters
+from reductiondag import RECIPE_FILTERS, MASTERS_TILE
+from newdatatrigger import NewDataWatcher
+from dbpool import ConnectionManager
+from asyncrunner import CommandRunner
+from spans import SpanRecorder, OK, ERROR
+from checkpoints import CheckpointStore, COADDING_STAGES, coadd_failures
+from calibrationwindow import CalibrationWindowPlanner
+from costmodel import CostModel, input_counts, simulate
+from jobqueue import JobQueue
 
 __AUTHOR = "E. S. Pereira"
 __DATE = "14/06/2017"
 __EMAIL = "pereira.somoza@gmail.com"
 
+RECIPES = {"shell": "reductionJypeT80S.sh",
+           "dag": "reductiondag.py"}
+
+RECIPE_NAMES = dict((filt.upper(), filt) for filt in RECIPE_FILTERS)
+
 
 class ReductionBotT80S(object):
     """
@@ -36,6 +54,41 @@ class ReductionBotT80S(object):
         delta_time_hours: Time range between reductions
         work_dir: The location where the bot will save temp data and log files
         delta_days_fb: Time range to search for bias and flat field
+        header_workers: Number of threads reading the headers of raw images
+        tile_source: "db" to get the tiles from the metadata in t80oa, or
+                     "headers" to read them from the raw images
+        max_cpus: Number of CPUs used by the concurrent tile reductions
+        memory_budget_mb: Memory, in MB, used by the concurrent tile
+                          reductions
+        tile_cpus: CPUs reserved for the reduction of one tile
+        tile_memory_mb: Initial memory estimate for the reduction of one
+                        tile
+        recipe: "shell" to run reductionJypeT80S.sh, or "dag" to run the
+                same stages with reductiondag.py
+        incremental: If True, skip the tiles whose input images in the
+                     reduction period did not change since their last
+                     successful reduction. With the dag recipe, only the
+                     changed filters are reduced.
+        db_pool_size: Maximum number of connections with the database
+        command_timeout: Timeout, in seconds, of the auxiliary commands,
+                         e.g. inserttiles.py
+        resume: If True, a tile whose last reduction failed is reduced
+                again for the same period, from its first stage not done
+        reuse_masters: If True, the recipes reuse the valid master bias and
+                       flats built from the same input frames
+        adaptive_window: If True, each master uses the narrowest window,
+                         inside delta_days_fb, with the minimum number of
+                         frames, and the filters without enough flats are
+                         skipped instead of the whole reduction
+        cost_model: If True, the time and memory of each tile are predicted
+                    from the previous reductions, and the longest tiles
+                    are started first
+        job_queue: If True, the jobs of each tile and filter, and of their
+                   masters, are added to t80jobqueue, to be run by the
+                   workers of jobqueue.py in several hosts, instead of
+                   being run by the bot. The table is created on start if
+                   it does not exist. It cannot be used with resume,
+                   reuse_masters and adaptive_window.
     """
 
     def __init__(self,
@@ -47,11 +100,41 @@ class ReductionBotT80S(object):
         self._delta_time_hours = 24,
         self._work_dir = "./"
         self._delta_days_fb = 15
+        self._header_workers = 8
+        self._tile_source = "db"
+        self._max_cpus = os.cpu_count() or 1
+        self._memory_budget_mb = (total_memory_mb() or 16384) * 0.8
+        self._tile_cpus = 4
+        self._tile_memory_mb = 8192
+        self._recipe = "shell"
+        self._incremental = False
+        self._db_pool_size = 2
+        self._command_timeout = None
+        self._resume = False
+        self._reuse_masters = False
+        self._adaptive_window = False
+        self._cost_model = False
+        self._job_queue = False
 
         allowed_keys = set(['client_ip',
                             'delta_time_hours',
                             'work_dir',
-                            'delta_days_fb'])
+                            'delta_days_fb',
+                            'header_workers',
+                            'tile_source',
+                            'max_cpus',
+                            'memory_budget_mb',
+                            'tile_cpus',
+                            'tile_memory_mb',
+                            'recipe',
+                            'incremental',
+                            'db_pool_size',
+                            'command_timeout',
+                            'resume',
+                            'reuse_masters',
+                            'adaptive_window',
+                            'cost_model',
+                            'job_queue'])
 
         self._scheduler = sched.scheduler(timefunc=time.time,
                                           delayfunc=time.sleep)
@@ -67,6 +150,21 @@ class ReductionBotT80S(object):
                         setattr(self, '_' + key, value)
 
         self._extra = {'clientip': client_ip, 'user': user}
+        # The pyDAL pool keeps the connections of the sessions of the bot.
+        db.configure(pool_size=self._db_pool_size)
+        self._db_pool = ConnectionManager(pool_size=self._db_pool_size)
+        self._image_counter = None
+        self._window_planner = CalibrationWindowPlanner()
+        if self._job_queue and (self._resume or self._reuse_masters or
+                                self._adaptive_window):
+            # The workers run their own command, see jobqueue.py -x.
+            raise ValueError("resume, reuse_masters and adaptive_window are "
+                             "not passed to the workers of the job queue")
+        self._queue = JobQueue() if self._job_queue else None
+        self._ready_filters = None
+        self._tile_scheduler = None
+        # End date and filters of the last masters built by the bot.
+        self._masters_built = (None, set())
 
         if self._work_dir[-1] == "/":
             self._work_dir += "reductionBotWDir/"
@@ -79,7 +177,34 @@ class ReductionBotT80S(object):
         if os.path.isdir(self._work_dir + "botLoggin") is False:
             os.makedirs(self._work_dir + "botLoggin")
 
+        self._spans_file = self._work_dir + "spans.jsonl"
+        self._spans = SpanRecorder(self._spans_file,
+                                   self._work_dir + "metrics.prom")
+
+        self._checkpoints_file = self._work_dir + "checkpoints.sqlite"
+        self._checkpoints = None
+        if self._resume:
+            self._checkpoints = CheckpointStore(self._checkpoints_file)
+
+        self._input_hashes = None
+        if self._incremental:
+            self._input_hashes = InputHashStore(self._work_dir +
+                                                "inputHashes.sqlite")
+
+        self._header_index = HeaderIndex(self._work_dir + "headerIndex.sqlite")
         self._logger = logging.getLogger()
+        self._header_scanner = HeaderScanner(RAW_PATH_PATTERN,
+                                             self._header_workers,
+                                             index=self._header_index,
+                                             logger=self._logger,
+                                             extra=self._extra)
+        self._runner = CommandRunner(timeout=self._command_timeout,
+                                     logger=self._logger,
+                                     extra=self._extra)
+        # The recipes have no timeout, their output is also streamed to
+        # the log of the bot.
+        self._recipe_runner = CommandRunner(logger=self._logger,
+                                            extra=self._extra)
 
         _format = "%(asctime)-15s %(clientip)s %(user)-8s %(message)s"
 
@@ -89,31 +214,83 @@ class ReductionBotT80S(object):
         logging.basicConfig(filename=self._work_dir + "/botLoggin/" + loggin_name,
                             level=logging.DEBUG,
                             format=_format)
+        # The debug messages of the event loop have no clientip and user.
+        logging.getLogger("asyncio").setLevel(logging.WARNING)
 
         self._logger.info("The Reduction Bot is Starting", extra=self._extra)
 
+        if self._queue is not None:
+            for sql in self._db_pool.run(self._queue.ensure_table):
+                self._logger.info(sql, extra=self._extra)
+
     def get_next_reduction(self):
         """
         Return a date object representing the next reduction date time.
         """
         return copy.copy(self._next_reduction)
 
-    def has_all_flats(self):
+    def _calibration_window(self):
         """
-        Return True and start date if all need flats were found in the pipeline
-        database, else, return false and the list of filters that need more
-        flats.
+        Return the start and end date used to search for bias and flats.
         """
         end_date = datetime.now().date()
         start_date = datetime.now() - timedelta(days=self._delta_days_fb)
         start_date = start_date.date()
+        return start_date, end_date
+
+    def calibration_counts(self):
+        """
+        Return the number of bias and a dictionary with the number of flats
+        by filter, found in the pipeline database. All values are obtained
+        from a single query, or, in event-driven mode, from the running
+        counts updated with the images ingested since the last check.
+        """
+        start_date, end_date = self._calibration_window()
+        if self._image_counter is not None:
+            self._image_counter.update()
+            counts = self._image_counter.counts(start_date,
+                                                end_date,
+                                                ("BIAS", "FLAS"),
+                                                FILTERS)
+        else:
+            counts = count_images_bulk(start_date,
+                                       end_date,
+                                       ("BIAS", "FLAS"),
+                                       FILTERS)
+        nbias = counts.get(("BIAS", None), 0)
+        nflats = dict((filt, counts.get(("FLAS", filt), 0))
+                      for filt in FILTERS)
+        return nbias, nflats
+
+    def ready_filters(self, nflats=None):
+        """
+        Return the list of filters with the minimum number of flats needed
+        to create the master sky-flat.
+        """
+        if nflats is None:
+            _, nflats = self.calibration_counts()
+        return [filt for filt in FILTERS
+                if nflats.get(filt, 0) >= MIN_COMBINE_NUMBER_FLAT]
+
+    def has_all_flats(self, nflats=None):
+        """
+        Return True and start date if all need flats were found in the pipeline
+        database, else, return false and the list of filters that need more
+        flats.
+        Optional Input:
+            nflats: dictionary with the number of flats by filter, as
+                    returned by calibration_counts.
+        """
+        if nflats is None:
+            _, nflats = self.calibration_counts()
 
+        ready = self.ready_filters(nflats)
         need_more_flats = []
 
         for filt in FILTERS:
-            nflats = count_images(start_date, end_date, "FLAS", filt)
-            if nflats < MIN_COMBINE_NUMBER_FLAT:
-                info = "Need More Flat for Filt {0}.  Found {1}.".format(filt, nflats)
+            if filt not in ready:
+                info = "Need More Flat for Filt {0}.  Found {1}.".format(
+                    filt, nflats.get(filt, 0))
                 self._logger.error(info, extra=self._extra)
                 need_more_flats.append(filt)
 
@@ -122,24 +299,61 @@ class ReductionBotT80S(object):
         else:
             return False, need_more_flats
 
-    def has_all_bias(self):
+    def has_all_bias(self, nbias=None):
         """
         Return True if all nedd bias was found, else, return False.
+        Optional Input:
+            nbias: number of bias, as returned by calibration_counts.
         """
-
-        end_date = datetime.now().date()
-        start_date = datetime.now() - timedelta(days=self._delta_days_fb)
-        start_date = start_date.date()
-        nbias = count_images(start_date, end_date, "BIAS")
+        if nbias is None:
+            nbias, _ = self.calibration_counts()
         if nbias < MIN_COMBINE_NUMBER_BIAS:
             info = "Found only {0} Bias.".format(nbias)
             self._logger.error(info, extra=self._extra)
             return False
         return True
 
-    def _gen_tiles_info(self):
+    def calibration_plan(self):
+        """
+        Return the windows of the master bias and flats, inside the
+        calibration window, as returned by CalibrationWindowPlanner.plan.
+        """
+        start_date, end_date = self._calibration_window()
+        return self._window_planner.plan(start_date, end_date)
+
+    def _check_calibrations(self):
+        """
+        Return True if the bias and flats needed by the reduction were
+        found. With adaptive_window, the bias and the flats of one filter
+        are enough, and the ready filters are kept for the reduction.
+        """
+        if not self._adaptive_window:
+            nbias, nflats = self._db_pool.run(self.calibration_counts)
+            return self.has_all_bias(nbias) is True and \
+                self.has_all_flats(nflats) is True
+
+        plan = self._db_pool.run(self.calibration_plan)
+        for (cftype, filt), window in sorted(plan.items(),
+                                             key=lambda item: str(item[0])):
+            name = filt or cftype
+            if window.start_date is None:
+                info = "Found only {0} {1} for {2}.".format(window.nframes,
+                                                            cftype, name)
+                self._logger.error(info, extra=self._extra)
+            else:
+                info = "Window of {0}: {1} to {2}, {3} frames.".format(
+                    name, window.start_date, window.end_date, window.nframes)
+                self._logger.info(info, extra=self._extra)
+        self._ready_filters = self._window_planner.ready_filters(plan)
+        return len(self._ready_filters) > 0
+
+    def _gen_tiles_info(self, start_date=None, end_date=None, only=None):
         '''
         Get scientific image and generate the tile info
+        Optional Input:
+            start_date, end_date: Period of the images, the default is the
+                                  last night
+            only: If given, only these tiles are reported
         '''
         base_info = '''# 1 PNAME
     # 2 RA
@@ -151,54 +365,76 @@ class ReductionBotT80S(object):
 
         tiles = []
 
-        for filt in FILTERS:
-            s_date = datetime.now() - timedelta(days=1)
-            s_date = s_date.date()
-            imgs = search_images(s_date, s_date, "SCIE", filt=filt)
-            for img in imgs:
-                imgf = None
-
-                if RAW_PATH_PATTERN[-1] == "/":
-                    img_loc = RAW_PATH_PATTERN + img
-                else:
-                    img_loc = RAW_PATH_PATTERN + '/' + img
-
-                for ext in ['fits', 'fits.fz', 'fz']:
-                    if os.path.isfile(img_loc + ext):
-                        imgf = img_loc + ext
-                        break
-                if imgf is not None:
-                    hdu = fits.open(imgf)
-
-                    try:
-                        hd = hdu[0].header
-                        hd['HIERARCH T80S DET EXPTIME']
-                    except KeyError:
-                        hd = hdu[1].header
-                        info = "Header not in HDU 0 : {}".format(img)
-                        self._logger.error(info, extra=self._extra)
-
-                    if "OBJECT" in hd.keys():
-                        tile_name = hd['OBJECT']
-                        if tile_name not in tiles:
-                            tiles.append(tile_name)
-                            base_info += "{0} {1} {2} 1 0.550 11000 \n".format(
-                                tile_name,
-                                hd['CRVAL1'],
-                                hd['CRVAL2'])
-                    else:
-                        info = "No OBJECT key found in the header of image {}".format(
-                            img)
-                        self._logger.warning(info, extra=self._extra)
+        s_date = datetime.now() - timedelta(days=1)
+        s_date = s_date.date()
+        if start_date is None:
+            start_date = s_date
+        if end_date is None:
+            end_date = s_date
+
+        if self._tile_source == "db":
+            tiles_db, imgs = search_tiles(start_date, end_date, FILTERS)
+            for tile_name, ra, dec, radecsys in tiles_db:
+                if only is not None and tile_name not in only:
+                    continue
+                if tile_name not in tiles:
+                    tiles.append(tile_name)
+                    base_info += "{0} {1} {2} {3} 0.550 11000 \n".format(
+                        tile_name,
+                        ra,
+                        dec,
+                        radecsys if radecsys is not None else 1)
+            if len(imgs) != 0:
+                info = "{} images without tile metadata in the database.".format(
+                    len(imgs))
+                self._logger.warning(info, extra=self._extra)
+        else:
+            found = search_images_bulk(start_date, end_date, ["SCIE"],
+                                       FILTERS)
+            imgs = []
+            for filt in FILTERS:
+                imgs.extend(found.get(("SCIE", filt), []))
+
+        for record in self._header_scanner.scan(imgs):
+            if record.error is not None:
+                info = "Could not read the header of image {0}: {1}".format(
+                    record.name, record.error)
+                self._logger.error(info, extra=self._extra)
+                continue
+
+            if record.hdu != 0:
+                info = "Header not in HDU 0 : {}".format(record.name)
+                self._logger.error(info, extra=self._extra)
+
+            if record.object is not None:
+                tile_name = record.object
+                if only is not None and tile_name not in only:
+                    continue
+                if tile_name not in tiles:
+                    tiles.append(tile_name)
+                    base_info += "{0} {1} {2} 1 0.550 11000 \n".format(
+                        tile_name,
+                        record.crval1,
+                        record.crval2)
+            else:
+                info = "No OBJECT key found in the header of image {}".format(
+                    record.name)
+                self._logger.warning(info, extra=self._extra)
 
         return tiles, base_info
 
-    def _insert_tiles_info(self):
+    def _insert_tiles_info(self, **kwargs):
         '''
-        Get scientific image and generate the tile info
+        Get scientific image and generate the tile info. Return the list
+        of tiles, or False if their info was not inserted.
+        Optional Input:
+            The same of _gen_tiles_info
         '''
 
-        tiles, base_info = self._gen_tiles_info()
+        with self._spans.span("tile_discovery") as attrs:
+            tiles, base_info = self._db_pool.run(self._gen_tiles_info,
+                                                 **kwargs)
+            attrs['ntiles'] = len(tiles)
 
         if len(tiles) != 0:
             tname = self._work_dir
@@ -208,51 +444,359 @@ class ReductionBotT80S(object):
 
             self._logger.info(
                 "Inserting Tile Info into DB.", extra=self._extra)
-            try:
-                out_log = self._work_dir
-                out_log += "insert_tiles_" + datetime.now().strftime("%Y%m%d") + ".log"
-                check_call("inserttiles.py {0} >> {1}".format(tname, out_log),
-                           shell=True)
-            except CalledProcessError:
+            out_log = self._work_dir
+            out_log += "insert_tiles_" + datetime.now().strftime("%Y%m%d") + ".log"
+            t0 = time.time()
+            result, = self._runner.run([("inserttiles",
+                                         "inserttiles.py {}".format(tname))],
+                                       log_file=out_log)
+            self._spans.add("tile_insert", t0, time.time(),
+                            OK if result.ok else ERROR,
+                            returncode=result.returncode)
+            if not result.ok:
                 self._logger.error("An Error occurred inserting tiles info",
                                    extra=self._extra)
                 return False
-            return tiles
-        return False
+        return tiles
 
-    def _start_reduction(self):
+    def _start_reduction(self, only=None):
+        """
+        Reduce the tiles of the last night, or only the given tiles, and
+        return the list of tiles that were not reduced and can be tried
+        again.
+        """
         self._logger.info("Starting the reduction process", extra=self._extra)
         end_reduction = datetime.now().strftime("%Y-%m-%d")
         start_date = datetime.now() - timedelta(days=self._delta_days_fb)
         start_date = start_date.strftime("%Y-%m-%d")
 
-        tiles = self._insert_tiles_info()
+        if only is None:
+            tiles = self._insert_tiles_info()
+        else:
+            # A tile may have waited for its calibrations, so its images
+            # are searched in the whole calibration window.
+            s_date, e_date = self._calibration_window()
+            tiles = self._insert_tiles_info(start_date=s_date,
+                                            end_date=e_date,
+                                            only=only)
+            if tiles is False:
+                return list(only)
+            for tile in only:
+                if tile not in tiles:
+                    info = "Tile {0} not found in the last {1} days.".format(
+                        tile, self._delta_days_fb)
+                    self._logger.warning(info, extra=self._extra)
+        failed = []
         if tiles is not False:
+            scheduler = TileScheduler(self._max_cpus,
+                                      self._memory_budget_mb,
+                                      job_cpus=self._tile_cpus,
+                                      job_memory_mb=self._tile_memory_mb,
+                                      longest_first=self._cost_model,
+                                      logger=self._logger,
+                                      extra=self._extra)
+            tile_filters = dict((tile, None) for tile in tiles)
+            hashes = {}
+            if self._incremental:
+                tile_filters, hashes = self._changed_tiles(tiles, start_date,
+                                                           end_reduction)
+            if self._adaptive_window and self._ready_filters is not None:
+                ready = self._with_ready_filters(tile_filters)
+                failed.extend(tile for tile in tile_filters
+                              if tile not in ready)
+                tile_filters = ready
+            costs = {}
+            if self._cost_model:
+                costs = self._db_pool.run(self._predict_costs, tile_filters,
+                                          start_date, end_reduction)
+
+            if self._queue is None and len(tile_filters) != 0:
+                # The masters are shared by all tiles, so they are built
+                # once, before the tiles are reduced at once.
+                if not self._build_masters(tile_filters, start_date,
+                                           end_reduction):
+                    return failed + list(tile_filters)
+
+            periods = {}
             for tile in tiles:
-                command = "reductionJypeT80S.sh {0} {1} {2} {3} {4} {5}".format(
-                    start_date,
-                    end_reduction,
-                    INSTRUMENT_CONFIG_FILE,
-                    tile,
-                    JYPE_VERSION,
-                    self.useremail
-                )
-                try:
-                    check_call(command,
-                               shell=True)
-                    info = "Reducion for Tile {0} end.".format(tile)
+                if tile not in tile_filters:
+                    continue
+                periods[tile] = self._tile_period(tile, start_date,
+                                                  end_reduction)
+                if self._queue is not None:
+                    self._enqueue(tile, tile_filters[tile], periods[tile])
+                    continue
+                command = self._recipe_command(tile, periods[tile],
+                                               tile_filters[tile], "tile")
+                log_file = self._work_dir + "reduction_{0}_{1}.log".format(
+                    tile, datetime.now().strftime("%Y%m%d"))
+                seconds, memory_mb, _ = costs.get(tile, (None, None, None))
+                scheduler.submit(tile, command, log_file=log_file,
+                                 seconds=seconds, memory_mb=memory_mb)
+
+            for job in self._run_scheduler(scheduler):
+                attrs = {}
+                if job['name'] in costs:
+                    # The history of the memory fit of the cost model.
+                    attrs['nframes'] = costs[job['name']][2]
+                    attrs['predicted_seconds'] = job['predicted_seconds']
+                self._spans.add("reduction",
+                                job['start_time'],
+                                job['end_time'],
+                                OK if job['returncode'] == 0 else ERROR,
+                                tile=job['name'],
+                                returncode=job['returncode'],
+                                peak_rss_mb=job['peak_rss_mb'],
+                                cpu_seconds=job['cpu_seconds'],
+                                **attrs)
+                self._spans.load(self._stage_spans_file(job['name']))
+                self._save_checkpoints(job['name'], periods[job['name']],
+                                       job['returncode'],
+                                       datetime.fromtimestamp(
+                                           job['start_time']))
+                if job['returncode'] == 0:
+                    if self._input_hashes is not None:
+                        # The hashes read before the reduction, the images
+                        # that arrived since then were not reduced.
+                        self._input_hashes.save(dict(
+                            ((job['name'], filt), hashes[(job['name'], filt)])
+                            for filt in tile_filters[job['name']]
+                            if (job['name'], filt) in hashes))
+                    info = "Reducion for Tile {0} end.".format(job['name'])
                     self._logger.info(info, extra=self._extra)
-                except CalledProcessError:
+                else:
+                    failed.append(job['name'])
                     info = "An Error occurred for the reducion of Tile: {0}".format(
-                        tile)
+                        job['name'])
                     self._logger.error(info, extra=self._extra)
+        return failed
+
+    def _run_scheduler(self, scheduler):
+        """
+        Run the jobs of a TileScheduler and return their summaries. The
+        jobs run in their own sessions, so they do not get the SIGINT of
+        the terminal: when the bot is interrupted, they are terminated
+        here.
+        """
+        self._tile_scheduler = scheduler
+        try:
+            return scheduler.run()
+        except BaseException:
+            self._logger.info("Stopping the running reductions.",
+                              extra=self._extra)
+            scheduler.terminate()
+            raise
+        finally:
+            self._tile_scheduler = None
+
+    def _recipe_command(self, tile, period, filters, phase):
+        """
+        Return the command of the recipe for a tile, period and phase, see
+        reductiondag.PHASES. filters None reduces all filters.
+        """
+        command = "{0} {1} {2} {3} {4} {5} {6}".format(
+            RECIPES[self._recipe],
+            period[0],
+            period[1],
+            INSTRUMENT_CONFIG_FILE,
+            tile,
+            JYPE_VERSION,
+            self.useremail
+        )
+        if filters is not None and self._recipe == "dag":
+            command += " -f " + " ".join(RECIPE_NAMES[filt.upper()]
+                                         for filt in filters)
+        # The recipe appends the span of each of its stages.
+        command = "T80S_PHASE={0} T80S_SPANS_FILE={1} {2}".format(
+            phase, self._stage_spans_file(tile), command)
+        if self._checkpoints is not None:
+            command = "T80S_CHECKPOINTS={0} {1}".format(
+                self._checkpoints_file, command)
+        if self._reuse_masters:
+            command = "T80S_REUSE_MASTERS=1 " + command
+        if self._adaptive_window:
+            command = "T80S_ADAPTIVE_WINDOW=1 " + command
+        return command
+
+    def _build_masters(self, tile_filters, start_date, end_date):
+        """
+        Build the master bias, and the master flats of the filters of the
+        tiles, with a single run of the recipe. Return True if they were
+        built. The masters are built once per night: the tiles triggered
+        later in the same night use the masters already built.
+        """
+        filters = None
+        if all(value is not None for value in tile_filters.values()):
+            filters = [filt for filt in FILTERS
+                       if any(filt in value
+                              for value in tile_filters.values())]
+        # The shell recipe builds the flats of all filters.
+        needed = set(FILTERS if filters is None or self._recipe != "dag"
+                     else filters)
+        built_date, built_filters = self._masters_built
+        if built_date == end_date and needed <= built_filters:
+            self._logger.info("The master frames of {} were already "
+                              "built.".format(end_date), extra=self._extra)
+            return True
+        command = self._recipe_command(MASTERS_TILE, (start_date, end_date),
+                                       filters, "masters")
+        log_file = self._work_dir + "reduction_{0}_{1}.log".format(
+            MASTERS_TILE, datetime.now().strftime("%Y%m%d"))
+        self._logger.info("Building the master frames.", extra=self._extra)
+        t0 = time.time()
+        result, = self._recipe_runner.run([("masters", command)],
+                                          log_file=log_file)
+        self._spans.add("masters", t0, time.time(),
+                        OK if result.ok else ERROR,
+                        returncode=result.returncode)
+        self._spans.load(self._stage_spans_file(MASTERS_TILE))
+        if not result.ok:
+            self._logger.error("The master frames were not built, the tiles "
+                               "will not be reduced.", extra=self._extra)
+            return False
+        if self._checkpoints is not None:
+            self._checkpoints.clear(MASTERS_TILE)
+        if built_date != end_date:
+            built_filters = set()
+        self._masters_built = (end_date, built_filters | needed)
+        return True
+
+    def _predict_costs(self, tile_filters, start_date, end_date):
+        """
+        Return a dictionary {tile: (seconds, memory_mb, nframes)} with the
+        predicted cost of the reduction of each tile, in its filters, from
+        its input images in the reduction period, and log the predicted
+        makespan.
+        """
+        with self._spans.span("cost_model"):
+            model = CostModel.from_history(spans_file=self._spans_file)
+            counts = input_counts(list(tile_filters), FILTERS, start_date,
+                                  end_date)
+
+        costs = {}
+        jobs = []
+        for tile, filters in tile_filters.items():
+            if filters is None:
+                filters = FILTERS
+            tile_counts = dict((filt, counts[(tile, filt)])
+                               for filt in filters if (tile, filt) in counts)
+            seconds, memory_mb = model.predict_tile(tile_counts)
+            costs[tile] = (seconds, memory_mb, sum(tile_counts.values()))
+            jobs.append({'name': tile,
+                         'seconds': seconds,
+                         'cpus': self._tile_cpus,
+                         'memory_mb': memory_mb or self._tile_memory_mb})
+
+        _, makespan = simulate(jobs, self._max_cpus, self._memory_budget_mb)
+        info = "Predicted makespan for {0} tiles: {1:.0f}s.".format(
+            len(jobs), makespan)
+        self._logger.info(info, extra=self._extra)
+        return costs
+
+    def _enqueue(self, tile, filters, period):
+        """
+        Add the jobs of a tile, one by filter, to the shared job queue,
+        with the jobs of the masters of the period not yet queued.
+        """
+        if filters is None:
+            filters = FILTERS
+        njobs = self._db_pool.run(self._queue.enqueue, [tile], period[0],
+                                  period[1], filters)
+        info = "{0} jobs of Tile {1} added to the queue.".format(njobs, tile)
+        self._logger.info(info, extra=self._extra)
+
+    def _tile_period(self, tile, start_date, end_date):
+        """
+        Return the period (start_date, end_date) of the reduction of a
+        tile: in resume mode, the period of its last reduction that did not
+        finish, if any.
+        """
+        if self._checkpoints is None:
+            return start_date, end_date
+        period = self._checkpoints.incomplete_period(tile)
+        if period is None:
+            return start_date, end_date
+        info = "Resuming the reduction of Tile {0} from {1} to {2}.".format(
+            tile, period[0], period[1])
+        self._logger.info(info, extra=self._extra)
+        return period
+
+    def _save_checkpoints(self, tile, period, returncode, started):
+        """
+        Drop the checkpoints of a tile when its reduction ends, or save the
+        stage where its coadditions, run since the datetime started, failed.
+        """
+        if self._checkpoints is None:
+            return
+        if returncode == 0:
+            self._checkpoints.clear(tile)
+            return
+        failures = self._db_pool.run(coadd_failures, tile, FILTERS,
+                                     started)
+        for filt, code in failures.items():
+            self._checkpoints.mark_failed(tile, "coadd", period,
+                                          RECIPE_NAMES[filt.upper()], code)
+            info = "Coaddition of Tile {0} in filter {1} failed in {2}.".format(
+                tile, filt, COADDING_STAGES.get(code, code))
+            self._logger.error(info, extra=self._extra)
+
+    def _stage_spans_file(self, tile):
+        """
+        Return the file where the recipe writes the spans of its stages for
+        a tile.
+        """
+        return self._work_dir + "spans_{}.jsonl".format(tile)
+
+    def _changed_tiles(self, tiles, start_date, end_date):
+        """
+        Return a dictionary {tile: [filters]} with the tiles, and filters,
+        whose input images in the period changed since their last
+        successful reduction, and the dictionary {(tile, filter): hash} of
+        the current input images.
+        """
+        with self._spans.span("input_hashes"):
+            current = self._db_pool.run(tile_input_hashes, tiles, FILTERS,
+                                        start_date, end_date)
+            changed = changed_filters(tiles, FILTERS, current,
+                                      self._input_hashes.hashes(tiles))
+        for tile in tiles:
+            if tile not in changed:
+                info = "Skipping Tile {0}, its input images did not change.".format(
+                    tile)
+                self._logger.info(info, extra=self._extra)
+            else:
+                info = "Tile {0} changed in the filters: {1}".format(
+                    tile, " ".join(changed[tile]))
+                self._logger.info(info, extra=self._extra)
+        return changed, current
+
+    def _with_ready_filters(self, tile_filters):
+        """
+        Return the dictionary {tile: [filters]} with only the filters whose
+        flats are ready, and without the tiles with no filter left.
+        """
+        ready = {}
+        for tile, filters in tile_filters.items():
+            if filters is None:
+                filters = FILTERS
+            filters = [filt for filt in filters if filt in self._ready_filters]
+            if len(filters) == 0:
+                info = "Skipping Tile {0}, no filter has enough flats.".format(
+                    tile)
+                self._logger.info(info, extra=self._extra)
+                continue
+            ready[tile] = filters
+        return ready
 
     def _rescheduler(self):
         self._next_reduction = datetime.now() + timedelta(hours=self._delta_time_hours)
 
-        if self.has_all_bias() is True:
-            if self.has_all_flats() is True:
+        with self._spans.span("readiness") as attrs:
+            attrs['ready'] = self._check_calibrations()
+        if attrs['ready']:
+            with self._spans.span("reduction_cycle"):
                 self._start_reduction()
+        self._spans.write_prometheus()
 
         info = "Next reduction will be started at: {}".format(
             self._next_reduction)
@@ -288,6 +832,74 @@ class ReductionBotT80S(object):
                                  action=self._rescheduler,
                                  argument=())
 
+    def _poll_new_data(self):
+        """
+        Start the reduction of the tiles whose new data is complete, and
+        schedule the next poll.
+        """
+        with self._spans.span("new_data_poll") as attrs:
+            tiles = self._db_pool.run(self._watcher.poll)
+            attrs['ntiles'] = len(tiles)
+        if len(tiles) != 0:
+            info = "New data complete for the tiles: {}".format(
+                " ".join(tiles))
+            self._logger.info(info, extra=self._extra)
+
+            with self._spans.span("readiness") as attrs:
+                attrs['ready'] = self._check_calibrations()
+            retry = tiles
+            if attrs['ready']:
+                with self._spans.span("reduction_cycle"):
+                    retry = self._start_reduction(only=tiles)
+            if len(retry) != 0:
+                info = "The tiles will be tried again: {}".format(
+                    " ".join(retry))
+                self._logger.info(info, extra=self._extra)
+                self._watcher.defer(retry)
+        self._spans.write_prometheus()
+
+        self._next_reduction = datetime.now() + timedelta(
+            seconds=self._poll_seconds)
+        self._scheduler.enter(self._poll_seconds,
+                              priority=0,
+                              action=self._poll_new_data,
+                              argument=())
+
+    @staticmethod
+    def _interrupt(signum, frame):
+        """
+        Stop the bot on SIGTERM as on SIGINT, so the running reductions are
+        terminated too.
+        """
+        raise KeyboardInterrupt()
+
+    def run_on_new_data(self, poll_seconds=300, debounce_seconds=1800):
+        """
+        Start the bot in event-driven mode: t80oa is polled for new science
+        frames, and a tile is reduced when no new frame of it arrived
+        during the debounce period.
+        input:
+            poll_seconds: Time interval between two polls
+            debounce_seconds: Quiet period before a tile is reduced
+        """
+        self._poll_seconds = poll_seconds
+        self._image_counter = IncrementalImageCounter(
+            self._work_dir + "imageCounts.json",
+            retain_days=self._delta_days_fb + 1,
+            frametypes=("BIAS", "FLAS"))
+        self._watcher = NewDataWatcher(
+            debounce_seconds,
+            watermark_file=self._work_dir + "newDataWatermark.json")
+        self._scheduler.enter(0,
+                              priority=0,
+                              action=self._poll_new_data,
+                              argument=())
+        signal.signal(signal.SIGTERM, self._interrupt)
+        try:
+            self._scheduler.run()
+        except KeyboardInterrupt:
+            self._logger.info("Stopping the Bot.", extra=self._extra)
+
     def run(self, hours, minutes):
         """
         Start the scheduler to run the reduction in autonomous mode.
@@ -296,6 +908,7 @@ class ReductionBotT80S(object):
             minutes: the minutes of firts reduction start
         """
         self._set_time(hours, minutes)
+        signal.signal(signal.SIGTERM, self._interrupt)
         try:
             self._scheduler.run()
         except KeyboardInterrupt:
@@ -341,10 +954,91 @@ if __name__ == "__main__":
                         type=int,
                         default=0)
 
+    PARSER.add_argument("-b",
+                        help="Source of the tiles info: db or headers",
+                        type=str,
+                        choices=["db", "headers"],
+                        default="db")
+
+    PARSER.add_argument("-c",
+                        help="Number of CPUs used by concurrent reductions",
+                        type=int,
+                        default=os.cpu_count() or 1)
+
+    PARSER.add_argument("-M",
+                        help="Memory, in MB, used by concurrent reductions",
+                        type=float,
+                        default=(total_memory_mb() or 16384) * 0.8)
+
+    PARSER.add_argument("-r",
+                        help="Reduction recipe: shell or dag",
+                        type=str,
+                        choices=sorted(RECIPES),
+                        default="shell")
+
+    PARSER.add_argument("-i",
+                        help="Skip tiles whose input images did not change",
+                        action="store_true")
+
+    PARSER.add_argument("-R",
+                        help="Resume failed reductions from their first "
+                             "stage not done",
+                        action="store_true")
+
+    PARSER.add_argument("-k",
+                        help="Reuse the valid master frames built from the "
+                             "same input frames",
+                        action="store_true")
+
+    PARSER.add_argument("-a",
+                        help="Use the narrowest window with enough bias and "
+                             "flats for each master, skipping the filters "
+                             "without enough flats",
+                        action="store_true")
+
+    PARSER.add_argument("-L",
+                        help="Predict the time and memory of the tiles from "
+                             "the previous reductions, and start the longest "
+                             "tiles first",
+                        action="store_true")
+
+    PARSER.add_argument("-Q",
+                        help="Add the jobs of the tiles to the shared job "
+                             "queue, run by the workers of jobqueue.py",
+                        action="store_true")
+
+    PARSER.add_argument("-w",
+                        help="Poll the database for new data every W "
+                             "seconds, instead of the daily reduction",
+                        type=int,
+                        default=0)
+
+    PARSER.add_argument("-q",
+                        help="Quiet period, in seconds, after the last new "
+                             "image of a tile before its reduction",
+                        type=int,
+                        default=1800)
+
     ARGS = PARSER.parse_args()
+    if ARGS.Q and (ARGS.R or ARGS.k or ARGS.a):
+        PARSER.error("-R, -k and -a are not passed to the workers of the job "
+                     "queue, set them in the command of the workers")
 
     bot = ReductionBotT80S(user=ARGS.u,
                            useremail=ARGS.e,
                            delta_time_hours=ARGS.t,
-                           delta_days_fb=ARGS.d)
-    bot.run(ARGS.s, ARGS.m)
+                           delta_days_fb=ARGS.d,
+                           tile_source=ARGS.b,
+                           max_cpus=ARGS.c,
+                           memory_budget_mb=ARGS.M,
+                           recipe=ARGS.r,
+                           incremental=ARGS.i,
+                           resume=ARGS.R,
+                           reuse_masters=ARGS.k,
+                           adaptive_window=ARGS.a,
+                           cost_model=ARGS.L,
+                           job_queue=ARGS.Q)
+    if ARGS.w > 0:
+        bot.run_on_new_data(ARGS.w, ARGS.q)
+    else:
+        bot.run(ARGS.s, ARGS.m)
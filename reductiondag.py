@@ -0,0 +1,536 @@
+#!/usr/bin/env python
+# -*- Coding: UTF-8 -*-
+"""
+Dependency-graph executor for the jype reduction recipe.
+The stages of reductionJypeT80S.sh are encoded as per-filter chains:
+    bias -> flat(f) -> validate(f) -> cosmet(f) -> coadd(f)
+and each stage starts as soon as its own inputs are done, instead of
+waiting for the barriers of the shell script. At the end, the critical
+path shows where the wall-clock time was spent.
+"""
+import os
+import time
+import logging
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from spans import SpanRecorder, OK, ERROR
+from checkpoints import CheckpointStore
+
+# Same filters, and names, of the shell recipe.
+RECIPE_FILTERS = ('R', 'I', 'G', 'F660', 'U', 'z', 'F378', 'F395', 'F410',
+                  'F861', 'F515', 'F430')
+
+# Maximum number of nodes of each pool running at once. The pipeline has a
+# large space complexity, the shell recipe creates four master flats at
+# once.
+POOL_LIMITS = {'flat': 4, 'cosmet': 2, 'coadd': 2}
+
+DONE = "done"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+# Parts of the recipe run in each phase, $T80S_PHASE. The bot builds the
+# masters once, then reduces several tiles at once with them. Without a
+# phase, the whole recipe runs.
+PHASES = {None: ('bias', 'flats', 'tile'),
+          'masters': ('bias', 'flats'),
+          'bias': ('bias',),
+          'flats': ('flats',),
+          'tile': ('tile',)}
+
+# Tile name of the recipes that only build masters, e.g. in checkpoints.
+MASTERS_TILE = "MASTERS"
+
+
+class Node(object):
+    """
+    A command in the reduction graph.
+    Attr:
+        name: Unique name of the node
+        command: Shell command
+        deps: Names of the nodes that must be done before this one
+        pool: Name of the pool that limits the concurrency of the node
+        checkpoint: (stage, filter) of the node in the CheckpointStore
+    """
+
+    def __init__(self, name, command, deps=(), pool=None, checkpoint=None):
+        self.name = name
+        self.command = command
+        self.deps = tuple(deps)
+        self.pool = pool
+        self.checkpoint = checkpoint
+        self.status = None
+        self.returncode = None
+        self.start_time = None
+        self.end_time = None
+
+    @property
+    def duration(self):
+        """
+        Return the wall-clock time of the node, in seconds.
+        """
+        if self.start_time is None or self.end_time is None:
+            return 0.0
+        return self.end_time - self.start_time
+
+
+class DagExecutor(object):
+    """
+    Run the nodes of a dependency graph as soon as their dependencies are
+    done.
+    Optional Attr:
+        max_workers: Maximum number of nodes running at once
+        pool_limits: Dictionary {pool: maximum number of running nodes}
+        logger: logging.Logger used to report the nodes
+        extra: extra dictionary passed to the logger
+        recorder: SpanRecorder that receives a timing span for each node
+        span_attrs: Attributes added to each span, e.g. the tile
+        checkpoints: CheckpointStore of the nodes. The nodes already done
+                     are not run again.
+        checkpoint_key: (tile, (start_date, end_date)) of the checkpoints
+    """
+
+    def __init__(self, max_workers=8, pool_limits=None, logger=None,
+                 extra=None, recorder=None, span_attrs=None,
+                 checkpoints=None, checkpoint_key=None):
+        self._max_workers = max_workers
+        self._pool_limits = dict(POOL_LIMITS if pool_limits is None
+                                 else pool_limits)
+        self._logger = logger
+        self._extra = extra or {}
+        self._recorder = recorder
+        self._span_attrs = span_attrs or {}
+        self._checkpoints = checkpoints
+        self._checkpoint_key = checkpoint_key
+        self._nodes = {}
+        self._order = []
+
+    def _log(self, level, info):
+        if self._logger is not None:
+            self._logger.log(level, info, extra=self._extra)
+        else:
+            print(info)
+
+    def add(self, name, command, deps=(), pool=None, checkpoint=None):
+        """
+        Add a node to the graph. The dependencies must be added before.
+        """
+        if name in self._nodes:
+            raise NameError("Node {} already in the graph".format(name))
+        for dep in deps:
+            if dep not in self._nodes:
+                raise NameError("Unknown dependency {0} of {1}".format(
+                    dep, name))
+        node = Node(name, command, deps, pool, checkpoint)
+        self._nodes[name] = node
+        self._order.append(name)
+        return node
+
+    def node(self, name):
+        """
+        Return the node with the given name.
+        """
+        return self._nodes[name]
+
+    def nodes(self):
+        """
+        Return the nodes in the order they were added.
+        """
+        return [self._nodes[name] for name in self._order]
+
+    def _run_node(self, node):
+        node.start_time = time.time()
+        self._log(logging.INFO, "Starting {}".format(node.name))
+        node.returncode = subprocess.call(node.command, shell=True)
+        node.end_time = time.time()
+        return node
+
+    def _checkpoint_done(self, node):
+        if self._checkpoints is None or node.checkpoint is None:
+            return False
+        tile, period = self._checkpoint_key
+        stage, filt = node.checkpoint
+        return self._checkpoints.is_done(tile, stage, period, filt)
+
+    def _save_checkpoint(self, node):
+        if self._checkpoints is None or node.checkpoint is None:
+            return
+        tile, period = self._checkpoint_key
+        stage, filt = node.checkpoint
+        if node.status == DONE:
+            self._checkpoints.mark_done(tile, stage, period, filt)
+        else:
+            self._checkpoints.mark_failed(tile, stage, period, filt)
+
+    def _descendants(self, node):
+        names = set()
+        pending = [node.name]
+        while pending:
+            name = pending.pop()
+            for other in self._order:
+                if name in self._nodes[other].deps and other not in names:
+                    names.add(other)
+                    pending.append(other)
+        return [self._nodes[name] for name in self._order if name in names]
+
+    def _reset_checkpoints(self, node):
+        # A node that runs again, e.g. a rebuilt master, makes the
+        # checkpoints of the nodes that read its output stale.
+        if self._checkpoints is None:
+            return
+        tile, period = self._checkpoint_key
+        for other in self._descendants(node):
+            if other.checkpoint is not None:
+                stage, filt = other.checkpoint
+                self._checkpoints.reset(tile, period, [stage], filt or "")
+
+    def _ready(self, node):
+        return all(self._nodes[dep].status == DONE for dep in node.deps)
+
+    def _blocked(self, node):
+        return any(self._nodes[dep].status in (FAILED, SKIPPED)
+                   for dep in node.deps)
+
+    def run(self):
+        """
+        Run the graph. Nodes whose dependencies failed are skipped.
+        Return True if all nodes are done.
+        """
+        pending = list(self._order)
+        running = {}
+        pools = {}
+
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            while pending or running:
+                for name in list(pending):
+                    node = self._nodes[name]
+                    if self._blocked(node):
+                        node.status = SKIPPED
+                        pending.remove(name)
+                        self._log(logging.WARNING,
+                                  "Skipping {}, a dependency failed".format(
+                                      name))
+                        continue
+                    if len(running) >= self._max_workers:
+                        continue
+                    if not self._ready(node):
+                        continue
+                    if self._checkpoint_done(node):
+                        node.status = DONE
+                        pending.remove(name)
+                        self._log(logging.INFO,
+                                  "Skipping {}, already done".format(name))
+                        continue
+                    limit = self._pool_limits.get(node.pool)
+                    if limit is not None and pools.get(node.pool, 0) >= limit:
+                        continue
+                    pending.remove(name)
+                    self._reset_checkpoints(node)
+                    pools[node.pool] = pools.get(node.pool, 0) + 1
+                    running[executor.submit(self._run_node, node)] = node
+
+                if not running:
+                    continue
+
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    node = running.pop(future)
+                    pools[node.pool] -= 1
+                    future.result()
+                    if node.returncode == 0:
+                        node.status = DONE
+                        self._log(logging.INFO, "{0} done in {1:.0f}s".format(
+                            node.name, node.duration))
+                    else:
+                        node.status = FAILED
+                        self._log(logging.ERROR,
+                                  "{0} failed with exit status {1}".format(
+                                      node.name, node.returncode))
+                    self._save_checkpoint(node)
+                    if self._recorder is not None:
+                        self._recorder.add(node.name,
+                                           node.start_time,
+                                           node.end_time,
+                                           OK if node.status == DONE
+                                           else ERROR,
+                                           returncode=node.returncode,
+                                           **self._span_attrs)
+
+        return all(node.status == DONE for node in self._nodes.values())
+
+    def critical_path(self):
+        """
+        Return the list of nodes in the critical path: starting from the
+        last node to finish, each step goes to the dependency that
+        finished last.
+        """
+        finished = [node for node in self._nodes.values()
+                    if node.end_time is not None]
+        if len(finished) == 0:
+            return []
+
+        node = max(finished, key=lambda item: item.end_time)
+        path = [node]
+        while node.deps:
+            deps = [self._nodes[dep] for dep in node.deps
+                    if self._nodes[dep].end_time is not None]
+            if len(deps) == 0:
+                break
+            node = max(deps, key=lambda item: item.end_time)
+            path.append(node)
+        path.reverse()
+        return path
+
+    def report(self):
+        """
+        Return a text with the critical path and the time of each node.
+        """
+        path = self.critical_path()
+        if len(path) == 0:
+            return "No node was executed."
+
+        wall = path[-1].end_time - path[0].start_time
+        lines = ["Critical path, {0:.1f}s of wall-clock time:".format(wall)]
+        for node in path:
+            lines.append("    {0:30s} {1:10.1f}s  {2:5.1f}%".format(
+                node.name,
+                node.duration,
+                100.0 * node.duration / wall if wall > 0 else 0.0))
+        return "\n".join(lines)
+
+
+def _split_date(date):
+    yyyy, mm, dd = date.split('-')
+    return yyyy, mm, dd
+
+
+def _period_name(start_date, end_date):
+    """
+    Return the period in the name of the master frames, e.g. b20261001e1018.
+    """
+    yyyy0, mm0, dd0 = _split_date(str(start_date))
+    _, mm1, dd1 = _split_date(str(end_date))
+    return "b{0}{1}{2}e{3}{4}".format(yyyy0, mm0, dd0, mm1, dd1)
+
+
+def build_reduction_graph(start_date, end_date, inst, tile, cname,
+                          filters=RECIPE_FILTERS, nprocess=3, masters=None,
+                          windows=None, phase=None, **kwargs):
+    """
+    Return a DagExecutor with the same stages of reductionJypeT80S.sh, for
+    one tile.
+    Input:
+        start_date, end_date: Dates in the format yyyy-mm-dd
+        inst: File with the instrument info
+        tile: Name of the tile
+        cname: Name of the reduction folder
+    Optional Input:
+        filters: Filters to reduce
+        nprocess: Number of parallel processes reducing individual images
+        masters: Plan of CalibrationManager, {(cftype, filter): CFname or
+                 None}. The masters with a CFname are reused, and only the
+                 previous master of each rebuilt master is invalidated.
+                 None rebuilds all masters, as the shell recipe.
+        windows: Windows of the masters, {(cftype, filter): (start_date,
+                 end_date)}, e.g. from CalibrationWindowPlanner. The
+                 flats without a window use the whole period. The bias
+                 without a window is not built: its look-back period does
+                 not have enough frames.
+        phase: Part of the recipe, a key of PHASES. The phases that do not
+               build all masters invalidate only the masters they build.
+        Any keyword accepted by DagExecutor
+    """
+    if phase not in PHASES:
+        raise ValueError("Unknown phase {}".format(phase))
+    parts = PHASES[phase]
+    selective = masters is not None or phase is not None
+    build_bias = windows is None or ("BIAS", None) in windows
+    windows = windows or {}
+    vcf = 0
+
+    kwargs.setdefault('checkpoint_key', (tile, (start_date, end_date)))
+    dag = DagExecutor(**kwargs)
+    bias_deps = []
+    if 'bias' in parts and build_bias and (
+            masters is None or masters.get(("BIAS", None)) is None):
+        if not selective:
+            invalidate = ('jsubmitsql.py "update t80cftab set is_valid=1 '
+                          'where is_valid=0"')
+        else:
+            invalidate = "calibrations.py {0} {1} invalidate BIAS".format(
+                start_date, end_date)
+        dag.add("invalidate", invalidate, checkpoint=("invalidate", None))
+        bias_start, bias_end = windows.get(("BIAS", None),
+                                           (start_date, end_date))
+        dag.add("bias",
+                "runcf.py -s {0} -e {1} -t 4 --instconfig {2}".format(
+                    bias_start, bias_end, inst),
+                deps=["invalidate"],
+                checkpoint=("bias", None))
+        dag.add("validate_bias",
+                "validateCF.py j02-BIAS-{0}-00-{1} {2}".format(
+                    _period_name(bias_start, bias_end), cname, vcf),
+                deps=["bias"],
+                checkpoint=("validate_bias", None))
+        bias_deps = ["validate_bias"]
+
+    for filt in filters:
+        flat_deps = bias_deps
+        if 'flats' in parts and (masters is None or
+                                 masters.get(("FLAS", filt)) is None):
+            flat_start, flat_end = windows.get(("FLAS", filt),
+                                               (start_date, end_date))
+            flat = "runcf.py -s {0} -e {1} -t 16 --instconfig {2} -f {3}"
+            flat = flat.format(flat_start, flat_end, inst, filt)
+            if selective:
+                invalidate = "calibrations.py {0} {1} invalidate FLAS {2}"
+                flat = invalidate.format(start_date, end_date,
+                                         filt) + " && " + flat
+            dag.add("flat_" + filt,
+                    flat,
+                    deps=bias_deps,
+                    pool="flat",
+                    checkpoint=("flat", filt))
+            dag.add("validate_" + filt,
+                    "validateCF.py j02-FLAS-{0}-{1}-00-{2} {3}".format(
+                        _period_name(flat_start, flat_end), filt, cname,
+                        vcf),
+                    deps=["flat_" + filt],
+                    checkpoint=("validate", filt))
+            flat_deps = ["validate_" + filt]
+        if 'tile' not in parts:
+            continue
+        dag.add("cosmet_" + filt,
+                "cosmetstage.py -t {0} -f {1} -s {2} -e {3} -p {4}".format(
+                    tile, filt, start_date, end_date, nprocess),
+                deps=flat_deps,
+                pool="cosmet",
+                checkpoint=("cosmet", filt))
+        dag.add("coadd_" + filt,
+                "runcoadding.py -u -o {0} {1}".format(tile, filt),
+                deps=["cosmet_" + filt],
+                pool="coadd",
+                checkpoint=("coadd", filt))
+    return dag
+
+
+def sendmail(tile, mail_to, msg=""):
+    """
+    Send the e-mail of the end of the reduction, as the shell recipe.
+    """
+    if not mail_to:
+        return
+    now = time.strftime("%H:%M:%S")
+    body = "The reducion process for {0} was finished at {1}. {2}".format(
+        tile, now, msg)
+    process = subprocess.Popen(["mail",
+                                "-a", "From:jype@jype.com",
+                                "-s",
+                                "noReply:Reduction for {} finished".format(
+                                    tile),
+                                mail_to],
+                               stdin=subprocess.PIPE)
+    process.communicate(body.encode())
+
+
+if __name__ == "__main__":
+    import argparse
+    DESCRIPTION = '''Automatic reduction process for T80s project, using
+    jype. Same recipe of reductionJypeT80S.sh, with each filter reduced as
+    soon as its own inputs are done.
+    '''
+    PARSER = argparse.ArgumentParser(description=DESCRIPTION)
+
+    PARSER.add_argument("start_date", help="Start date yyyy-mm-dd", type=str)
+    PARSER.add_argument("end_date", help="End date yyyy-mm-dd", type=str)
+    PARSER.add_argument("inst", help="File with the instrument info",
+                        type=str)
+    PARSER.add_argument("tile", help="Name of the tile", type=str)
+    PARSER.add_argument("cname", help="Name of the reduction folder",
+                        type=str)
+    PARSER.add_argument("mail_to", help="E-mail of the user", type=str,
+                        nargs='?', default="")
+
+    PARSER.add_argument("-f",
+                        help="Filters to reduce",
+                        type=str,
+                        nargs='+',
+                        default=list(RECIPE_FILTERS))
+
+    PARSER.add_argument("-w",
+                        help="Maximum number of stages running at once",
+                        type=int,
+                        default=8)
+
+    PARSER.add_argument("-p",
+                        help="Number of parallel process to reduce "
+                             "individual images",
+                        type=int,
+                        default=3)
+
+    ARGS = PARSER.parse_args()
+    PHASE = os.environ.get("T80S_PHASE") or None
+    if PHASE not in PHASES:
+        PARSER.error("Unknown T80S_PHASE {}".format(PHASE))
+
+    CHECKPOINTS = None
+    if os.environ.get("T80S_CHECKPOINTS"):
+        CHECKPOINTS = CheckpointStore(os.environ["T80S_CHECKPOINTS"])
+
+    WINDOWS = None
+    if os.environ.get("T80S_ADAPTIVE_WINDOW"):
+        from calibrationwindow import CalibrationWindowPlanner
+        PLANNER = CalibrationWindowPlanner(ARGS.f)
+        PLAN = PLANNER.plan(ARGS.start_date, ARGS.end_date)
+        READY = PLANNER.ready_filters(PLAN)
+        if PLAN[("BIAS", None)].start_date is None:
+            print("Skipping the master bias, only {} bias found.".format(
+                PLAN[("BIAS", None)].nframes))
+        for FILT in ARGS.f:
+            if FILT not in READY:
+                print("Skipping filter {0}, only {1} flats found.".format(
+                    FILT, PLAN[("FLAS", FILT)].nframes))
+        ARGS.f = READY
+        WINDOWS = dict((KEY, (str(WINDOW.start_date), str(WINDOW.end_date)))
+                       for KEY, WINDOW in PLAN.items()
+                       if WINDOW.start_date is not None)
+
+    MASTERS = None
+    if os.environ.get("T80S_REUSE_MASTERS") and PHASE != "tile":
+        from calibrations import CalibrationManager
+        MASTERS = CalibrationManager(ARGS.start_date,
+                                     ARGS.end_date,
+                                     windows=WINDOWS).plan(ARGS.f)
+        for (CFTYPE, FILT), CFNAME in sorted(MASTERS.items(),
+                                             key=lambda item: str(item[0])):
+            if CFNAME is not None:
+                print("Reusing {0} for {1} {2}".format(CFNAME, CFTYPE,
+                                                       FILT or ""))
+
+    DAG = build_reduction_graph(ARGS.start_date,
+                                ARGS.end_date,
+                                ARGS.inst,
+                                ARGS.tile,
+                                ARGS.cname,
+                                filters=ARGS.f,
+                                nprocess=ARGS.p,
+                                masters=MASTERS,
+                                windows=WINDOWS,
+                                phase=PHASE,
+                                max_workers=ARGS.w,
+                                recorder=SpanRecorder(
+                                    os.environ.get("T80S_SPANS_FILE")),
+                                span_attrs={'tile': ARGS.tile},
+                                checkpoints=CHECKPOINTS)
+    SUCCESS = DAG.run()
+    print(DAG.report())
+    if "bias" in [NODE.name for NODE in DAG.nodes()] and \
+            DAG.node("bias").status != DONE:
+        sendmail(ARGS.tile, ARGS.mail_to, "Bias Not Generated")
+        raise SystemExit(1)
+    if 'tile' in PHASES[PHASE]:
+        sendmail(ARGS.tile, ARGS.mail_to)
+    print("Reduction finished...")
+    if not SUCCESS:
+        raise SystemExit(1)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- Coding: UTF-8 -*-
+"""
+Index management and query-plan checker for the Pipeline Data Base.
+The tables of model.py are not migrated by pyDAL, so the indexes needed by
+the hot queries are declared in model.py with db.define_index, and this
+module creates the missing ones. The plans of the queries sent by
+searchimages, tilehashes and the bot are read with EXPLAIN, and the full
+table scans are reported.
+"""
+from datetime import datetime, timedelta
+
+from model import db
+from config import FILTERS
+from dimensions import DIMENSION_TABLES
+
+
+def _engine(database):
+    return database._adapter.dbengine
+
+
+def existing_indexes(tablename, database=db):
+    """
+    Return a dictionary {index name: [columns]} with the indexes of a
+    table, the columns in the index order.
+    """
+    indexes = {}
+    if _engine(database) == "sqlite":
+        rows = database.executesql(
+            'PRAGMA index_list("{}")'.format(tablename))
+        for row in rows:
+            name = row[1]
+            info = database.executesql('PRAGMA index_info("{}")'.format(name))
+            indexes[name] = [column for _, _, column in sorted(info)]
+    else:
+        rows = database.executesql("SHOW INDEX FROM `{}`".format(tablename),
+                                   as_dict=True)
+        columns = {}
+        for row in rows:
+            columns.setdefault(row['Key_name'], []).append(
+                (row['Seq_in_index'], row['Column_name']))
+        for name, value in columns.items():
+            indexes[name] = [column for _, column in sorted(value)]
+    return indexes
+
+
+def _covered(columns, indexes):
+    """
+    Return True if an index starts with the given columns.
+    """
+    columns = [column.lower() for column in columns]
+    for index_columns in indexes.values():
+        index_columns = [column.lower() for column in index_columns]
+        if index_columns[:len(columns)] == columns:
+            return True
+    return False
+
+
+def missing_indexes(database=db, tables=None):
+    """
+    Return the list of (tablename, name, columns) declared in model.py
+    whose columns are not the leading columns of an existing index,
+    optionally only for some tables.
+    """
+    missing = []
+    found = {}
+    for tablename, name, columns in database.indexes():
+        if tables is not None and tablename not in tables:
+            continue
+        if tablename not in found:
+            found[tablename] = existing_indexes(tablename, database)
+        if not _covered(columns, found[tablename]):
+            missing.append((tablename, name, columns))
+    return missing
+
+
+def create_index_sql(tablename, name, columns):
+    """
+    Return the CREATE INDEX statement of an index.
+    """
+    return 'CREATE INDEX {0} ON {1} ({2});'.format(
+        name, tablename, ", ".join(columns))
+
+
+def create_missing_indexes(database=db, dry_run=False):
+    """
+    Create the missing indexes, and return the executed statements. With
+    dry_run, the statements are only returned.
+    """
+    statements = [create_index_sql(*index)
+                  for index in missing_indexes(database)]
+    if not dry_run:
+        for sql in statements:
+            database.executesql(sql)
+        database.commit()
+    return statements
+
+
+def explain(sql, database=db):
+    """
+    Return the plan of a query, as a list of dictionaries.
+    """
+    if _engine(database) == "sqlite":
+        rows = database.executesql("EXPLAIN QUERY PLAN " + sql)
+        return [{'id': row[0], 'parent': row[1], 'detail': row[3]}
+                for row in rows]
+    return database.executesql("EXPLAIN " + sql, as_dict=True)
+
+
+def full_scans(plan, ignore=DIMENSION_TABLES):
+    """
+    Return the tables read with a full scan in a plan returned by explain.
+    The small dimension tables are ignored.
+    """
+    tables = []
+    for step in plan:
+        if 'detail' in step:
+            words = step['detail'].split()
+            # sqlite: "SCAN t80oa", or "SCAN t80oa USING INDEX ..." for
+            # a scan of an index.
+            if len(words) < 2 or words[0] != "SCAN" or \
+                    "INDEX" in step['detail']:
+                continue
+            table = words[1].strip('"`')
+        else:
+            if step.get('type') != "ALL":
+                continue
+            table = step.get('table')
+        if table not in ignore and table not in tables:
+            tables.append(table)
+    return tables
+
+
+def capture_queries(function, *args, **kwargs):
+    """
+    Run function(*args, **kwargs) and return the SELECT statements sent to
+    the database.
+    """
+    # pyDAL keeps the last queries of the thread in db._timings, a private
+    # attribute of the DAL, from 17.7 onwards.
+    if not hasattr(db, '_timings'):
+        raise RuntimeError("This pyDAL version does not record the queries")
+    del db._timings[:]
+    result = function(*args, **kwargs)
+    if hasattr(result, '__next__'):
+        for _ in result:
+            pass
+    return [sql for sql, _ in db._timings
+            if sql.lstrip().upper().startswith("SELECT")]
+
+
+def hot_queries(start_date=None, end_date=None):
+    """
+    Run the query helpers used by the bot, for the period between
+    start_date and end_date, the default is the last night, and return a
+    list of (label, sql).
+    """
+    from searchimages import search_images, count_images_bulk
+    from searchimages import search_images_bulk, search_tiles, iter_images
+    from searchimages import search_images_since
+    from tilehashes import tile_input_hashes
+    from calibrationwindow import count_matrix
+    from costmodel import input_counts
+
+    if start_date is None:
+        start_date = (datetime.now() - timedelta(days=1)).date()
+    if end_date is None:
+        end_date = start_date
+
+    filt = FILTERS[0]
+    tiles, _ = search_tiles(start_date, end_date, FILTERS)
+    tiles = [tile[0] for tile in tiles[:10]] or ["NONE"]
+    last_id = db(db.t80oa).select(db.t80oa.id.max()).first()
+    last_id = last_id[db.t80oa.id.max()] or 0
+
+    calls = [("search_images[BIAS]", search_images,
+              (start_date, end_date, "BIAS")),
+             ("search_images[FLAS]", search_images,
+              (start_date, end_date, "FLAS", filt)),
+             ("search_images[SCIE]", search_images,
+              (start_date, end_date, "SCIE", filt)),
+             ("count_images_bulk", count_images_bulk,
+              (start_date, end_date, ("BIAS", "FLAS"), FILTERS)),
+             ("search_images_bulk", search_images_bulk,
+              (start_date, end_date, ("BIAS", "FLAS", "SCIE"), FILTERS)),
+             ("search_tiles", search_tiles,
+              (start_date, end_date, FILTERS)),
+             ("iter_images", iter_images,
+              (start_date, end_date, "SCIE", filt)),
+             ("search_images_since", search_images_since,
+              (last_id, datetime.now() - timedelta(days=1), start_date)),
+             ("tile_input_hashes", tile_input_hashes,
+              (tiles, FILTERS, start_date, end_date)),
+             ("count_matrix", count_matrix, (start_date, end_date, FILTERS)),
+             ("input_counts", input_counts,
+              (tiles, FILTERS, start_date, end_date))]
+
+    queries = []
+    for label, function, args in calls:
+        for sql in capture_queries(function, *args):
+            queries.append((label, sql))
+    return queries
+
+
+def check_queries(queries=None, database=db):
+    """
+    Return a list of (label, sql, tables) for the queries with full table
+    scans. The default is the list of hot_queries.
+    """
+    if queries is None:
+        queries = hot_queries()
+    report = []
+    for label, sql in queries:
+        tables = full_scans(explain(sql, database))
+        if tables:
+            report.append((label, sql, tables))
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+    PARSER = argparse.ArgumentParser(
+        description="Index management and query-plan checker")
+
+    PARSER.add_argument("-c",
+                        help="Create the missing indexes",
+                        action="store_true")
+
+    PARSER.add_argument("-n",
+                        help="Only print the CREATE INDEX statements",
+                        action="store_true")
+
+    PARSER.add_argument("-e",
+                        help="Run EXPLAIN on the hot queries and report "
+                             "full table scans",
+                        action="store_true")
+
+    ARGS = PARSER.parse_args()
+
+    if ARGS.c or ARGS.n:
+        for SQL in create_missing_indexes(dry_run=not ARGS.c or ARGS.n):
+            print(SQL)
+    else:
+        for TABLENAME, NAME, COLUMNS in missing_indexes():
+            print("Missing index {0} on {1} ({2})".format(
+                NAME, TABLENAME, ", ".join(COLUMNS)))
+
+    if ARGS.e:
+        REPORT = check_queries()
+        for LABEL, SQL, TABLES in REPORT:
+            print("Full scan of {0} in {1}:\n    {2}".format(
+                ", ".join(TABLES), LABEL, SQL))
+        if REPORT:
+            raise SystemExit(1)
@@ -3,19 +3,28 @@
 """
 Search for images in the Pipeline Data Base.
 """
+import os
+import json
+from datetime import datetime, timedelta
+from collections import namedtuple
+
 from model import db
+from dimensions import DIMENSIONS
 
 __AUTHOR = "E. S. Pereira"
 __DATE = "15/06/2017"
 __EMAIL = "pereira.somoza@gmail.com"
 
+ImageRow = namedtuple('ImageRow', ['id', 'Name', 'Object', 'RA', 'DEC',
+                                   'Filter_ID', 'Date'])
+
 
 def search_images(start_date, end_date, frametype, filt=None):
     """
     Return the available images in a given day.
     """
 
-    type_id = db(db.frametype.Name == frametype).select(db.frametype.id).first()
+    type_id = DIMENSIONS.id_of('frametype', frametype)
     nimages = 0
     if frametype == "BIAS":
         nimages = db((db.t80oa.ImageType_ID == type_id)
@@ -26,7 +35,7 @@ def search_images(start_date, end_date, frametype, filt=None):
         nimages = [img.Name for img in nimages]
     else:
         if filt != None:
-            filter_id = db(db.filter.Name == filt).select(db.filter.id).first()
+            filter_id = DIMENSIONS.id_of('filter', filt)
             nimages = db((db.t80oa.ImageType_ID == type_id)
                          &
                          (db.t80oa.Filter_ID == filter_id)
@@ -44,7 +53,7 @@ def count_images(start_date, end_date, frametype, filt=None):
     """
     Return the Number of images in the Pipeline Data Base.
     """
-    type_id = db(db.frametype.Name == frametype).select(db.frametype.id).first()
+    type_id = DIMENSIONS.id_of('frametype', frametype)
     nimages = 0
     if frametype == "BIAS":
         nimages = db((db.t80oa.ImageType_ID == type_id)
@@ -54,7 +63,7 @@ def count_images(start_date, end_date, frametype, filt=None):
                      (db.t80oa.Date <= end_date)).count()
     else:
         if filt != None:
-            filter_id = db(db.filter.Name == filt).select(db.filter.id).first()
+            filter_id = DIMENSIONS.id_of('filter', filt)
             nimages = db((db.t80oa.ImageType_ID == type_id)
                          &
                          (db.t80oa.Filter_ID == filter_id)
@@ -66,9 +75,346 @@ def count_images(start_date, end_date, frametype, filt=None):
             raise NameError("No Filter Passed")
     return nimages
 
-if __name__ == "__main__":
-    from datetime import datetime
 
+def search_images_bulk(start_date, end_date, frametypes, filters):
+    """
+    Return the available images for several frame types and filters, using
+    a single query.
+    The output is a dictionary {(frametype, filter): [names]}. As in
+    search_images, BIAS images do not depend on the filter, and they are
+    listed under the key ("BIAS", None). The names are ordered by id.
+    """
+    types_ids = DIMENSIONS.ids_of('frametype', frametypes)
+    types_names = dict((type_id, frametype)
+                       for frametype, type_id in types_ids.items())
+    filters_names = dict((filter_id, filt) for filt, filter_id in
+                         DIMENSIONS.ids_of('filter', filters).items())
+
+    bias_ids = [type_id for frametype, type_id in types_ids.items()
+                if frametype == "BIAS"]
+    other_ids = [type_id for frametype, type_id in types_ids.items()
+                 if frametype != "BIAS"]
+
+    query = ((db.t80oa.ImageType_ID.belongs(other_ids))
+             &
+             (db.t80oa.Filter_ID.belongs(list(filters_names))))
+    if len(bias_ids) != 0:
+        query |= db.t80oa.ImageType_ID.belongs(bias_ids)
+
+    rows = db(query
+              &
+              (db.t80oa.Date >= start_date)
+              &
+              (db.t80oa.Date <= end_date)).select(db.t80oa.ImageType_ID,
+                                                  db.t80oa.Filter_ID,
+                                                  db.t80oa.Name,
+                                                  orderby=db.t80oa.id,
+                                                  cacheable=True)
+
+    images = {}
+    for row in rows:
+        frametype = types_names[row.ImageType_ID]
+        filt = None if frametype == "BIAS" else filters_names[row.Filter_ID]
+        images.setdefault((frametype, filt), []).append(row.Name)
+    return images
+
+
+def count_images_bulk(start_date, end_date, frametypes, filters=None):
+    """
+    Return the Number of images for several frame types and filters,
+    using a single grouped query.
+    The output is a dictionary {(frametype, filter): nimages}. As in
+    count_images, BIAS images do not depend on the filter, and they are
+    counted under the key ("BIAS", None).
+    If filters is given, only these filters are reported, using the same
+    spelling of the input.
+    """
+    types_ids = DIMENSIONS.ids_of('frametype', frametypes)
+    nimages = db.t80oa.id.count()
+    rows = db((db.t80oa.ImageType_ID.belongs(list(types_ids.values())))
+              &
+              (db.t80oa.Date >= start_date)
+              &
+              (db.t80oa.Date <= end_date)).select(
+                  db.t80oa.ImageType_ID,
+                  db.t80oa.Filter_ID,
+                  nimages,
+                  groupby=db.t80oa.ImageType_ID | db.t80oa.Filter_ID)
+
+    types_names = dict((type_id, frametype)
+                       for frametype, type_id in types_ids.items())
+    filters_names = None
+    if filters is not None:
+        filters_names = dict((filter_id, filt) for filt, filter_id in
+                             DIMENSIONS.ids_of('filter', filters).items())
+
+    counts = {}
+    for row in rows:
+        frametype = types_names[row.t80oa.ImageType_ID]
+        if frametype == "BIAS":
+            filt = None
+        elif filters_names is not None:
+            if row.t80oa.Filter_ID not in filters_names:
+                continue
+            filt = filters_names[row.t80oa.Filter_ID]
+        else:
+            filt = DIMENSIONS.name_of('filter', row.t80oa.Filter_ID)
+        key = (frametype, filt)
+        counts[key] = counts.get(key, 0) + row[nimages]
+    return counts
+
+def search_tiles(start_date, end_date, filters):
+    """
+    Return the tiles observed in the science images of a given period,
+    using the metadata stored in t80oa.
+    The output is a tuple (tiles, missing), where tiles is a list of
+    (Object, RA, DEC, RADECsys_ID), ordered by the first image of each
+    tile, and missing is the list of names of science images without
+    Object, RA or DEC, whose metadata must be read from the image headers.
+    RA, DEC and RADECsys_ID are those of the first image of the tile, so
+    they always come from the same observed image, also near RA = 0.
+    """
+    type_id = DIMENSIONS.id_of('frametype', 'SCIE')
+    filters_ids = list(DIMENSIONS.ids_of('filter', filters).values())
+    query = ((db.t80oa.ImageType_ID == type_id)
+             &
+             (db.t80oa.Filter_ID.belongs(filters_ids))
+             &
+             (db.t80oa.Date >= start_date)
+             &
+             (db.t80oa.Date <= end_date))
+
+    has_metadata = ((db.t80oa.Object != None)
+                    &
+                    (db.t80oa.RA != None)
+                    &
+                    (db.t80oa.DEC != None))
+
+    first_ids = db(query & has_metadata)._select(db.t80oa.id.min(),
+                                                 groupby=db.t80oa.Object)
+    rows = db(db.t80oa.id.belongs(first_ids)).select(db.t80oa.Object,
+                                                     db.t80oa.RA,
+                                                     db.t80oa.DEC,
+                                                     db.t80oa.RADECsys_ID,
+                                                     orderby=db.t80oa.id)
+    tiles = [(row.Object, row.RA, row.DEC, row.RADECsys_ID) for row in rows]
+
+    missing = db(query & ~has_metadata).select(db.t80oa.Name,
+                                               orderby=db.t80oa.id)
+    missing = [img.Name for img in missing]
+    return tiles, missing
+
+def iter_images(start_date, end_date, frametype, filt=None, chunk_size=1000):
+    """
+    Yield the images of search_images as ImageRow tuples, without loading
+    all of them in memory. t80oa is read in pages of chunk_size rows,
+    ordered by id, and each page starts after the last id of the previous
+    one, so the cost of a page does not grow with the offset.
+    """
+    type_id = DIMENSIONS.id_of('frametype', frametype)
+    query = ((db.t80oa.ImageType_ID == type_id)
+             &
+             (db.t80oa.Date >= start_date)
+             &
+             (db.t80oa.Date <= end_date))
+    if frametype != "BIAS":
+        if filt is None:
+            raise NameError("No Filter Passed")
+        query &= db.t80oa.Filter_ID == DIMENSIONS.id_of('filter', filt)
+
+    fields = [db.t80oa[name] for name in ImageRow._fields]
+    last_id = 0
+    while True:
+        rows = db(query & (db.t80oa.id > last_id)).select(
+            *fields,
+            orderby=db.t80oa.id,
+            limitby=(0, chunk_size),
+            cacheable=True)
+        for row in rows:
+            yield ImageRow(*[row[name] for name in ImageRow._fields])
+        if len(rows) < chunk_size:
+            return
+        last_id = rows[-1].id
+
+
+def search_images_since(last_id, last_update=None, start_date=None):
+    """
+    Return the t80oa rows inserted after the image last_id, or updated since
+    last_update (UPDATEDATE_OA). Only the columns needed to count images are
+    returned: id, Date, ImageType_ID, Filter_ID and UPDATEDATE_OA.
+    If start_date is given, older images are not returned.
+    """
+    query = db.t80oa.id > last_id
+    if last_update is not None:
+        query |= db.t80oa.UPDATEDATE_OA >= last_update
+    if start_date is not None:
+        query &= db.t80oa.Date >= start_date
+    return db(query).select(db.t80oa.id,
+                            db.t80oa.Date,
+                            db.t80oa.ImageType_ID,
+                            db.t80oa.Filter_ID,
+                            db.t80oa.UPDATEDATE_OA)
+
+
+class IncrementalImageCounter(object):
+    """
+    Running number of images by date, frame type and filter.
+    Each update reads only the rows inserted or updated since the persisted
+    watermark, so repeated counts cost proportionally to the new data, and
+    not to the size of the window. Images deleted from t80oa are not
+    detected.
+    Only the images of the counted frame types are kept, with their key,
+    so an updated image moves from its old key, and the state file is
+    only written when the counts change.
+    Attr:
+        state_file: JSON file with the watermark and the counted images
+    Optional Attr:
+        retain_days: Only images of the last retain_days are counted
+        frametypes: Only images of these frame types are counted, the
+                    default counts all frame types
+    """
+
+    def __init__(self, state_file, retain_days=30, frametypes=None):
+        self._state_file = state_file
+        self._retain_days = retain_days
+        self._types_ids = None
+        if frametypes is not None:
+            self._types_ids = set(DIMENSIONS.ids_of('frametype',
+                                                    frametypes).values())
+        self._last_id = None
+        self._last_update = None
+        self._images = {}
+        self._counts = {}
+        self._load()
+
+    def _load(self):
+        if not os.path.isfile(self._state_file):
+            return
+        with open(self._state_file) as fin:
+            state = json.load(fin)
+        self._last_id = state['last_id']
+        if state['last_update'] is not None:
+            self._last_update = datetime.strptime(state['last_update'],
+                                                  "%Y-%m-%dT%H:%M:%S")
+        for image_id, key in state['images'].items():
+            if self._counted(key[1]):
+                self._add(int(image_id), tuple(key))
+
+    def _counted(self, type_id):
+        return self._types_ids is None or type_id in self._types_ids
+
+    def _save(self):
+        last_update = None
+        if self._last_update is not None:
+            last_update = self._last_update.strftime("%Y-%m-%dT%H:%M:%S")
+        tmp_file = self._state_file + ".tmp"
+        with open(tmp_file, 'w') as fout:
+            json.dump({'last_id': self._last_id,
+                       'last_update': last_update,
+                       'images': self._images}, fout)
+        os.rename(tmp_file, self._state_file)
+
+    def _add(self, image_id, key):
+        self._images[image_id] = key
+        self._counts[key] = self._counts.get(key, 0) + 1
+
+    def _remove(self, image_id):
+        key = self._images.pop(image_id, None)
+        if key is not None:
+            self._counts[key] -= 1
+            if self._counts[key] == 0:
+                del self._counts[key]
+
+    def update(self):
+        """
+        Read the images inserted or updated since the last update, and
+        return the number of rows read.
+        """
+        start_date = (datetime.now() -
+                      timedelta(days=self._retain_days)).date()
+        rows = search_images_since(self._last_id or 0,
+                                   self._last_update,
+                                   start_date)
+        last_state = (self._last_id, self._last_update)
+        changed = False
+        for row in rows:
+            key = None
+            if row.Date is not None and self._counted(row.ImageType_ID):
+                key = (row.Date.isoformat(), row.ImageType_ID, row.Filter_ID)
+            # The rows updated at the watermark are read again.
+            if self._images.get(row.id) != key:
+                changed = True
+                self._remove(row.id)
+                if key is not None:
+                    self._add(row.id, key)
+            self._last_id = max(self._last_id or 0, row.id)
+            if row.UPDATEDATE_OA is not None:
+                if self._last_update is None or \
+                        row.UPDATEDATE_OA > self._last_update:
+                    self._last_update = row.UPDATEDATE_OA
+
+        start_date = start_date.isoformat()
+        for image_id, key in list(self._images.items()):
+            if key[0] < start_date:
+                changed = True
+                self._remove(image_id)
+
+        if changed or last_state != (self._last_id, self._last_update):
+            self._save()
+        return len(rows)
+
+    def count(self, start_date, end_date, frametype, filt=None):
+        """
+        Return the Number of images, as count_images, from the running
+        counts.
+        """
+        if frametype == "BIAS":
+            filt = None
+        elif filt is None:
+            raise NameError("No Filter Passed")
+        counts = self.counts(start_date, end_date, [frametype],
+                             None if filt is None else [filt])
+        return counts.get((frametype, filt), 0)
+
+    def counts(self, start_date, end_date, frametypes, filters=None):
+        """
+        Return the Number of images for several frame types and filters,
+        with the same output of count_images_bulk, from the running counts.
+        """
+        types_ids = DIMENSIONS.ids_of('frametype', frametypes)
+        for frametype, type_id in types_ids.items():
+            if not self._counted(type_id):
+                raise ValueError("{} images are not counted".format(
+                    frametype))
+        types_names = dict((type_id, frametype)
+                           for frametype, type_id in types_ids.items())
+        filters_names = None
+        if filters is not None:
+            filters_names = dict((filter_id, filt) for filt, filter_id in
+                                 DIMENSIONS.ids_of('filter', filters).items())
+
+        start_date = start_date.isoformat()
+        end_date = end_date.isoformat()
+        counts = {}
+        for (date, type_id, filter_id), nimages in self._counts.items():
+            if date < start_date or date > end_date:
+                continue
+            if type_id not in types_names:
+                continue
+            frametype = types_names[type_id]
+            if frametype == "BIAS":
+                filt = None
+            elif filters_names is not None:
+                if filter_id not in filters_names:
+                    continue
+                filt = filters_names[filter_id]
+            else:
+                filt = DIMENSIONS.name_of('filter', filter_id)
+            key = (frametype, filt)
+            counts[key] = counts.get(key, 0) + nimages
+        return counts
+
+if __name__ == "__main__":
     search_day = datetime.now()
     search_day = search_day.replace(day=28, month=5, year=2017).date()
 
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- Coding: UTF-8 -*-
+"""
+Timing spans of the stages of the reduction bot.
+Each stage, e.g. tile discovery, readiness checks, tile insert or a stage
+of the reduction recipe, is recorded as a span with its start and end
+time. The spans are appended as JSON lines, one span by line, and the
+totals by stage are written as a Prometheus text-format file, to be read
+by the node_exporter textfile collector.
+
+Span line:
+    {"stage": "tile_insert", "start": 1760800000.1, "end": 1760800003.4,
+     "duration": 3.3, "status": "ok", "tile": null, ...}
+"""
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+OK = "ok"
+ERROR = "error"
+
+METRIC_PREFIX = "t80s_bot"
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+class SpanRecorder(object):
+    """
+    Record timing spans, and export them as JSON lines and as Prometheus
+    metrics.
+    Optional Attr:
+        jsonl_file: File where each span is appended as a JSON line
+        prom_file: Prometheus text-format file written by write_prometheus
+    """
+
+    def __init__(self, jsonl_file=None, prom_file=None):
+        self._jsonl_file = jsonl_file
+        self._prom_file = prom_file
+        self._lock = threading.Lock()
+        self._totals = {}
+
+    def add(self, stage, start, end, status=OK, tile=None, **attrs):
+        """
+        Record a span measured elsewhere, e.g. by a subprocess, and return
+        it.
+        """
+        span = {'stage': stage,
+                'start': start,
+                'end': end,
+                'duration': end - start,
+                'status': status,
+                'tile': tile}
+        span.update(attrs)
+
+        with self._lock:
+            total = self._totals.setdefault(stage, {'count': 0,
+                                                    'seconds': 0.0,
+                                                    'errors': 0,
+                                                    'last': 0.0,
+                                                    'last_end': 0.0})
+            total['count'] += 1
+            total['seconds'] += span['duration']
+            if status != OK:
+                total['errors'] += 1
+            if end >= total['last_end']:
+                total['last'] = span['duration']
+                total['last_end'] = end
+
+            if self._jsonl_file is not None:
+                with open(self._jsonl_file, 'a') as fout:
+                    fout.write(json.dumps(span, default=str) + "\n")
+        return span
+
+    @contextmanager
+    def span(self, stage, tile=None, **attrs):
+        """
+        Record the time spent in the block as a span of the stage. The
+        status is error if the block raises an exception. Attributes can
+        be added inside the block through the yielded dictionary.
+        """
+        attrs = dict(attrs)
+        start = time.time()
+        status = OK
+        try:
+            yield attrs
+        except BaseException:
+            status = ERROR
+            raise
+        finally:
+            self.add(stage, start, time.time(), status, tile, **attrs)
+
+    def load(self, filename, remove=True):
+        """
+        Record the spans written in a JSON lines file by another process,
+        e.g. the stages of the reduction recipe. Lines without the duration
+        are completed from start and end. Return the number of spans.
+        """
+        if not os.path.isfile(filename):
+            return 0
+        nspans = 0
+        with open(filename) as fin:
+            for line in fin:
+                line = line.strip()
+                if line == "":
+                    continue
+                try:
+                    span = json.loads(line)
+                except ValueError:
+                    continue
+                span.pop('duration', None)
+                stage = span.pop('stage')
+                start = float(span.pop('start'))
+                end = float(span.pop('end'))
+                status = span.pop('status', OK)
+                tile = span.pop('tile', None)
+                self.add(stage, start, end, status, tile, **span)
+                nspans += 1
+        if remove:
+            os.remove(filename)
+        return nspans
+
+    def totals(self):
+        """
+        Return a dictionary {stage: {'count', 'seconds', 'errors', 'last',
+        'last_end'}} with the totals of the recorded spans.
+        """
+        with self._lock:
+            return dict((stage, dict(total))
+                        for stage, total in self._totals.items())
+
+    def prometheus(self):
+        """
+        Return the totals by stage in the Prometheus text format.
+        """
+        totals = self.totals()
+        metrics = [
+            ("stage_duration_seconds", "summary",
+             "Time spent in each stage of the reduction bot.", None),
+            ("stage_failures_total", "counter",
+             "Number of spans of each stage that failed.", 'errors'),
+            ("stage_last_duration_seconds", "gauge",
+             "Duration of the last span of each stage.", 'last'),
+            ("stage_last_end_timestamp_seconds", "gauge",
+             "Unix time of the end of the last span of each stage.",
+             'last_end')]
+
+        lines = []
+        for name, kind, info, key in metrics:
+            name = "{0}_{1}".format(METRIC_PREFIX, name)
+            lines.append("# HELP {0} {1}".format(name, info))
+            lines.append("# TYPE {0} {1}".format(name, kind))
+            for stage in sorted(totals):
+                label = '{{stage="{}"}}'.format(_label(stage))
+                total = totals[stage]
+                if key is None:
+                    lines.append("{0}_sum{1} {2}".format(name, label,
+                                                         total['seconds']))
+                    lines.append("{0}_count{1} {2}".format(name, label,
+                                                           total['count']))
+                else:
+                    lines.append("{0}{1} {2}".format(name, label, total[key]))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self):
+        """
+        Write the Prometheus file. The file is replaced atomically, so the
+        collector never reads a partial file.
+        """
+        if self._prom_file is None:
+            return
+        tmp_file = self._prom_file + ".tmp"
+        with open(tmp_file, 'w') as fout:
+            fout.write(self.prometheus())
+        os.rename(tmp_file, self._prom_file)
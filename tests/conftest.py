@@ -0,0 +1,27 @@
+"""
+Fixtures of the tests: the model bound to a sqlite copy of the schema.
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from model import db
+from benchmarks import synthetic
+
+
+@pytest.fixture
+def database(tmp_path):
+    """
+    Bind the model to an empty sqlite database with the frame types and
+    filters of the T80S.
+    """
+    filename = str(tmp_path / "t80s.sqlite")
+    synthetic.create_schema(filename)
+    synthetic.bind(filename)
+    yield db
+    db.close()
@@ -0,0 +1,49 @@
+import os
+import time
+import signal
+import threading
+
+import pytest
+
+from asyncrunner import CommandRunner
+
+
+def alive(pid):
+    try:
+        with open("/proc/{}/stat".format(pid)) as fin:
+            stat = fin.read()
+    except (IOError, OSError):
+        return False
+    return stat[stat.rfind(')') + 2] != "Z"
+
+
+def test_run_returns_the_results_in_order(tmp_path):
+    runner = CommandRunner(max_concurrent=2, logger=None)
+    log_file = str(tmp_path / "run.log")
+    results = runner.run([("a", "sleep 0.2; echo a"), ("b", "exit 3")],
+                         log_file=log_file)
+    assert [result.name for result in results] == ["a", "b"]
+    assert [result.returncode for result in results] == [0, 3]
+    with open(log_file) as fin:
+        assert fin.read() == "a\n"
+
+
+def test_interrupted_run_stops_the_commands(tmp_path):
+    runner = CommandRunner(logger=None)
+    pid_files = [tmp_path / "pid1", tmp_path / "pid2"]
+    commands = [("cmd{}".format(i),
+                 "sleep 60 & echo $! > {}; wait".format(pid_file))
+                for i, pid_file in enumerate(pid_files)]
+
+    timer = threading.Timer(1.0, os.kill, (os.getpid(), signal.SIGINT))
+    timer.start()
+    with pytest.raises(KeyboardInterrupt):
+        runner.run(commands)
+    timer.join()
+
+    for pid_file in pid_files:
+        pid = int(pid_file.read_text())
+        deadline = time.time() + 5
+        while alive(pid) and time.time() < deadline:
+            time.sleep(0.1)
+        assert not alive(pid)
@@ -0,0 +1,82 @@
+from datetime import date
+
+from calibrations import CalibrationManager, VALID, INVALID
+from dimensions import DIMENSIONS
+from test_searchimages import insert_image
+
+DAY = date(2026, 10, 17)
+
+
+def insert_master(database, cfname, cftype, filt, names, is_valid=VALID):
+    cf_id = database.t80cftab.insert(
+        CFname=cfname,
+        CFtype_ID=DIMENSIONS.id_of('frametype', cftype),
+        Filter_ID=DIMENSIONS.id_of('filter', filt) if filt else None,
+        is_valid=is_valid)
+    for name in names:
+        image = database(database.t80oa.Name == name).select().first()
+        rc_id = database.rc.insert(NAMERED="r" + name, ori_id=image.id)
+        database.t80cfImgs.insert(CF_ID=cf_id, RC_ID=rc_id)
+    database.commit()
+    return cf_id
+
+
+def insert_frames(database):
+    for i in range(3):
+        insert_image(database, "bias{}.fits".format(i), "BIAS", "R", DAY)
+        insert_image(database, "flat{}.fits".format(i), "FLAS", "R", DAY)
+
+
+def test_master_with_the_same_inputs_is_reused(database):
+    insert_frames(database)
+    insert_master(database, "bias_a", "BIAS", None,
+                  ["bias0.fits", "bias1.fits", "bias2.fits"])
+    insert_master(database, "flat_a", "FLAS", "R",
+                  ["flat2.fits", "flat1.fits", "flat0.fits"])
+
+    manager = CalibrationManager(DAY, DAY)
+    assert manager.plan(["R", "I"]) == {("BIAS", None): "bias_a",
+                                        ("FLAS", "R"): "flat_a",
+                                        ("FLAS", "I"): None}
+
+
+def test_master_with_other_inputs_is_rebuilt(database):
+    insert_frames(database)
+    # A master of a previous window, and one of a window with a frame less.
+    insert_image(database, "bias_old.fits", "BIAS", "R", date(2026, 10, 1))
+    insert_master(database, "bias_old", "BIAS", None,
+                  ["bias_old.fits", "bias0.fits", "bias1.fits",
+                   "bias2.fits"])
+    insert_master(database, "bias_a", "BIAS", None,
+                  ["bias0.fits", "bias1.fits"])
+    insert_master(database, "flat_a", "FLAS", "R",
+                  ["flat0.fits", "flat1.fits", "flat2.fits"])
+
+    manager = CalibrationManager(DAY, DAY)
+    assert manager.find_master("BIAS") is None
+    # The flats are corrected by the bias, so they are rebuilt too.
+    assert manager.find_master("FLAS", "R") == "flat_a"
+    assert manager.reusable("FLAS", "R") is None
+
+    # A new frame in the window changes the input of the flat.
+    insert_master(database, "bias_b", "BIAS", None,
+                  ["bias0.fits", "bias1.fits", "bias2.fits"])
+    insert_image(database, "flat3.fits", "FLAS", "R", DAY)
+    manager = CalibrationManager(DAY, DAY)
+    assert manager.reusable("BIAS") == "bias_b"
+    assert manager.reusable("FLAS", "R") is None
+
+
+def test_invalidated_master_is_not_reused(database):
+    insert_frames(database)
+    insert_master(database, "bias_a", "BIAS", None,
+                  ["bias0.fits", "bias1.fits", "bias2.fits"])
+    insert_master(database, "bias_b", "BIAS", None,
+                  ["bias0.fits", "bias1.fits", "bias2.fits"],
+                  is_valid=INVALID)
+
+    manager = CalibrationManager(DAY, DAY)
+    assert manager.reusable("BIAS") == "bias_a"
+    assert manager.invalidate("BIAS") == 1
+    assert manager.reusable("BIAS") is None
+    assert database(database.t80cftab.is_valid == VALID).count() == 0
@@ -0,0 +1,75 @@
+from datetime import date
+
+import numpy as np
+
+from calibrationwindow import CalibrationWindowPlanner, Window
+from calibrationwindow import count_matrix, narrowest_windows
+from test_searchimages import insert_image
+
+
+def day(number):
+    return date(2026, 10, number)
+
+
+def test_narrowest_windows():
+    counts = np.array([[1, 1, 5],
+                       [0, 1, 0],
+                       [2, 0, 0],
+                       [3, 0, 0]])
+    assert list(narrowest_windows(counts, np.array([3, 2, 6]))) == [1, 4, 0]
+    assert list(narrowest_windows(np.zeros((0, 3), dtype=int), 1)) == \
+        [0, 0, 0]
+
+
+def test_count_matrix(database):
+    insert_image(database, "b1.fits", "BIAS", "R", day(16))
+    insert_image(database, "b2.fits", "BIAS", "G", day(18))
+    insert_image(database, "f1.fits", "FLAS", "R", day(18))
+    insert_image(database, "f2.fits", "FLAS", "R", day(18))
+    insert_image(database, "f3.fits", "FLAS", "Z", day(17))
+    insert_image(database, "s1.fits", "SCIE", "R", day(18))
+    insert_image(database, "f4.fits", "FLAS", "R", day(10))
+
+    dates, counts = count_matrix("2026-10-16", "2026-10-18", ["R", "I"])
+    assert dates == [day(16), day(17), day(18)]
+    assert counts.shape == (3, 3, 2)
+    # The bias of all filters, and the flats of the other filters.
+    assert list(counts[:, :, 0].sum(axis=1)) == [1, 0, 1]
+    assert list(counts[:, 0, 1]) == [0, 0, 2]
+    assert list(counts[:, 2, 1]) == [0, 1, 0]
+    assert counts[:, 1, :].sum() == 0
+
+
+def test_plan_with_a_sparse_filter(database):
+    for i, number in enumerate([10, 17, 18, 18]):
+        insert_image(database, "b{}.fits".format(i), "BIAS", "R",
+                     day(number))
+    for i, number in enumerate([18, 18, 18, 12]):
+        insert_image(database, "r{}.fits".format(i), "FLAS", "R",
+                     day(number))
+    for i, number in enumerate([11, 14]):
+        insert_image(database, "i{}.fits".format(i), "FLAS", "I",
+                     day(number))
+
+    planner = CalibrationWindowPlanner(["R", "I"], min_bias=3, min_flats=3)
+    plan = planner.plan("2026-10-05", "2026-10-18")
+    assert plan[("BIAS", None)] == Window(day(17), day(18), 3)
+    assert plan[("FLAS", "R")] == Window(day(18), day(18), 3)
+    # I has only two flats in the look-back period, it does not block R.
+    assert plan[("FLAS", "I")] == Window(None, day(18), 2)
+    assert planner.ready_filters(plan) == ["R"]
+
+
+def test_plan_of_an_empty_period(database):
+    planner = CalibrationWindowPlanner(["R"], min_bias=3, min_flats=3)
+    plan = planner.plan(day(5), day(18))
+    assert plan == {("BIAS", None): Window(None, day(18), 0),
+                    ("FLAS", "R"): Window(None, day(18), 0)}
+    assert planner.ready_filters(plan) == []
+
+    # Flats without bias are not ready.
+    for i in range(3):
+        insert_image(database, "r{}.fits".format(i), "FLAS", "R", day(18))
+    plan = planner.plan(day(5), day(18))
+    assert plan[("FLAS", "R")].start_date == day(18)
+    assert planner.ready_filters(plan) == []
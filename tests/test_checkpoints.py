@@ -0,0 +1,80 @@
+from datetime import date, datetime, timedelta
+
+from checkpoints import CheckpointStore, coadd_failures
+from dimensions import DIMENSIONS
+
+PERIOD = ("2026-10-03", "2026-10-18")
+
+
+def test_mark_done_is_saved_by_period_and_filter(tmp_path):
+    store = CheckpointStore(str(tmp_path / "checkpoints.sqlite"))
+    store.mark_done("T1", "bias", PERIOD)
+    store.mark_done("T1", "flat", PERIOD, "R")
+
+    assert store.is_done("T1", "bias", PERIOD)
+    assert store.is_done("T1", "flat", PERIOD, "R")
+    assert not store.is_done("T1", "flat", PERIOD, "I")
+    assert not store.is_done("T1", "bias", ("2026-10-04", "2026-10-19"))
+    assert not store.is_done("T2", "bias", PERIOD)
+
+    # Other process reads the same file.
+    other = CheckpointStore(str(tmp_path / "checkpoints.sqlite"))
+    assert other.is_done("T1", "flat", PERIOD, "R")
+    store.mark_failed("T1", "flat", PERIOD, "R", 3)
+    assert not other.is_done("T1", "flat", PERIOD, "R")
+    assert other.stages("T1")[-1] == ("flat", "R", PERIOD[0], PERIOD[1],
+                                      "failed", 3)
+
+
+def test_incomplete_period_is_the_last_one_saved(tmp_path):
+    store = CheckpointStore(str(tmp_path / "checkpoints.sqlite"))
+    assert store.incomplete_period("T1") is None
+    store.mark_done("T1", "bias", ("2026-10-02", "2026-10-17"))
+    store.mark_done("T1", "bias", PERIOD)
+    store.mark_done("T2", "bias", ("2026-10-02", "2026-10-17"))
+    assert store.incomplete_period("T1") == PERIOD
+
+    store.clear("T1", PERIOD)
+    assert store.incomplete_period("T1") == ("2026-10-02", "2026-10-17")
+    store.clear("T1")
+    assert store.incomplete_period("T1") is None
+    assert store.incomplete_period("T2") is not None
+
+
+def test_reset_removes_only_the_given_stages(tmp_path):
+    store = CheckpointStore(str(tmp_path / "checkpoints.sqlite"))
+    for filt in ["R", "I"]:
+        for stage in ["flat", "cosmet", "coadd"]:
+            store.mark_done("T1", stage, PERIOD, filt)
+    store.mark_done("T1", "bias", PERIOD)
+
+    # The master flat of R was rebuilt.
+    store.reset("T1", PERIOD, ["cosmet", "coadd"], "R")
+    assert store.is_done("T1", "flat", PERIOD, "R")
+    assert not store.is_done("T1", "cosmet", PERIOD, "R")
+    assert not store.is_done("T1", "coadd", PERIOD, "R")
+    assert store.is_done("T1", "coadd", PERIOD, "I")
+
+    # The master bias was rebuilt.
+    store.reset("T1", PERIOD, ["flat", "cosmet", "coadd"])
+    assert [stage[0] for stage in store.stages("T1")] == ["bias"]
+
+
+def test_coadd_failures_of_the_current_reduction(database):
+    started = datetime(2026, 10, 18, 12)
+
+    def insert_tile(filt, exit_status, day, updated=None):
+        database.t80tilesinfo.insert(
+            TileName="T1", Filter_ID=DIMENSIONS.id_of('filter', filt),
+            Exit_Status=exit_status, DateInsert=day, UPDATEDATE_tile=updated)
+        database.commit()
+
+    # The failures of the previous reductions.
+    insert_tile("R", 6, date(2026, 10, 1))
+    insert_tile("I", 9, date(2026, 10, 1), datetime(2026, 10, 2))
+    insert_tile("G", 4, date(2026, 10, 1))
+    assert coadd_failures("T1", ["R", "I", "G"], started) == {}
+
+    insert_tile("R", 7, date(2026, 10, 18))
+    insert_tile("I", 0, date(2026, 10, 1), started + timedelta(hours=1))
+    assert coadd_failures("T1", ["R", "I", "G"], started) == {"R": 7}
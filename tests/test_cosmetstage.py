@@ -0,0 +1,60 @@
+import os
+import sys
+import stat
+import subprocess
+
+import pytest
+
+from cosmetstage import run_cosmet_stage
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Fake runcosmet.py: records its calls, and fails the first pass of the
+# images whose name starts with "bad".
+RUNCOSMET = '''#!/bin/sh
+echo "$@" >> {calls}
+case "$1" in
+    -o) case "$(basename "$3")" in bad*) exit 2;; esac;;
+esac
+exit 0
+'''
+
+JGETLIST = '''#!/bin/sh
+printf "good1.fits\\nbad1.fits\\ngood2.fits\\n"
+'''
+
+
+def write_script(path, text):
+    path.write_text(text)
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+
+
+@pytest.fixture
+def fake_bin(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    calls = tmp_path / "calls"
+    write_script(bin_dir / "runcosmet.py", RUNCOSMET.format(calls=calls))
+    write_script(bin_dir / "jgetlist.py", JGETLIST)
+    monkeypatch.setenv("PATH", str(bin_dir) + os.pathsep +
+                       os.environ["PATH"])
+    return calls
+
+
+def test_failed_first_pass_skips_the_second_pass(fake_bin):
+    results = dict(run_cosmet_stage(["good1.fits", "bad1.fits"], 2))
+    assert results == {"good1.fits": [0, 0], "bad1.fits": [2]}
+    calls = sorted(fake_bin.read_text().splitlines())
+    assert calls == ["-o -u bad1.fits", "-o -u good1.fits", "good1.fits"]
+
+
+def test_failures_are_reported_without_failing_the_stage(fake_bin):
+    command = [sys.executable, os.path.join(ROOT, "cosmetstage.py"),
+               "-t", "STRIPE82_0001", "-f", "R", "-s", "2026-10-17",
+               "-e", "2026-10-18"]
+    output = subprocess.run(command, stdout=subprocess.PIPE)
+    assert output.returncode == 0
+    assert b"2 of 3 images corrected." in output.stdout
+
+    assert subprocess.call(command + ["-m", "1"]) == 0
+    assert subprocess.call(command + ["-m", "0"]) == 1
@@ -0,0 +1,79 @@
+from datetime import date
+
+import numpy as np
+import pytest
+
+from costmodel import CostModel, fit_power_law, input_counts, simulate
+from test_searchimages import insert_image
+
+
+def test_fit_power_law_recovers_the_parameters():
+    nframes = np.arange(1, 21, dtype=float)
+    a, b = fit_power_law(nframes, 3.0 * nframes ** 1.5)
+    assert a == pytest.approx(3.0)
+    assert b == pytest.approx(1.5)
+
+    # Few points, a single number of frames, or no valid point.
+    assert fit_power_law(nframes[:5], nframes[:5]) is None
+    assert fit_power_law(np.full(20, 4.0), np.arange(1, 21.0)) is None
+    assert fit_power_law(np.zeros(20), np.ones(20)) is None
+
+
+def test_fit_memory_adds_the_percentile_margin():
+    nframes = np.arange(10, 110, 10, dtype=float)
+    model = CostModel(memory_percentile=100)
+    model.fit_memory(nframes, 50.0 * nframes + 1000)
+    assert model.predict_memory_mb(0) == pytest.approx(1000)
+    assert model.predict_memory_mb(100) == pytest.approx(6000)
+
+    # With the largest residual as margin no observed peak is exceeded.
+    peak_mb = 50.0 * nframes + 1000 + np.array(
+        [0, 10, -10, 0, 20, -20, 0, 5, -5, 0], dtype=float)
+    model.fit_memory(nframes, peak_mb)
+    for n, peak in zip(nframes, peak_mb):
+        assert model.predict_memory_mb(n) >= peak - 1e-6
+
+    model.fit_memory(nframes[:3], nframes[:3])
+    assert model.predict_memory_mb(100) is None
+
+
+def test_predict_tile_without_history():
+    model = CostModel(seconds_per_frame=2.0)
+    assert model.predict_tile({"R": 10, "I": 5}) == (30.0, None)
+    assert model.predict_seconds("R", 0) == 0.0
+
+
+def test_simulate_longest_first():
+    jobs = [{'name': "short", 'seconds': 10.0, 'cpus': 2, 'memory_mb': 10},
+            {'name': "mid", 'seconds': 20.0, 'cpus': 2, 'memory_mb': 10},
+            {'name': "long", 'seconds': 30.0, 'cpus': 2, 'memory_mb': 10}]
+    plan, makespan = simulate(jobs, 4, 100)
+    assert [(job['name'], job['start'], job['end']) for job in plan] == [
+        ("long", 0.0, 30.0), ("mid", 0.0, 20.0), ("short", 20.0, 30.0)]
+    assert makespan == 30.0
+
+    _, fifo = simulate(jobs, 4, 100, longest_first=False)
+    assert fifo == 40.0
+
+    # A job larger than the memory budget runs alone.
+    jobs[2]['memory_mb'] = 200
+    _, makespan = simulate(jobs, 4, 100)
+    assert makespan == 50.0
+    assert simulate([], 4, 100) == ([], 0.0)
+
+
+def test_input_counts_of_the_period(database):
+    for i, day in enumerate([date(2026, 1, 5), date(2026, 10, 17),
+                             date(2026, 10, 18)]):
+        insert_image(database, "r{}.fits".format(i), "SCIE", "R", day,
+                     Object="T1")
+    insert_image(database, "i0.fits", "SCIE", "I", date(2026, 10, 18),
+                 Object="T1")
+    insert_image(database, "f0.fits", "FLAS", "R", date(2026, 10, 18),
+                 Object="T1")
+
+    assert input_counts(["T1"], ["R", "I"]) == {("T1", "R"): 3,
+                                                ("T1", "I"): 1}
+    assert input_counts(["T1"], ["R", "I"], date(2026, 10, 4),
+                        date(2026, 10, 18)) == {("T1", "R"): 2,
+                                                ("T1", "I"): 1}
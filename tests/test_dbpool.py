@@ -0,0 +1,37 @@
+import dbpool
+from dbpool import ConnectionManager
+
+
+class GoneAway(Exception):
+    pass
+
+
+def test_lost_connection_is_closed_once_and_run_again(database,
+                                                      monkeypatch):
+    closes = []
+    close_connection = dbpool._close_connection
+
+    def record_close(db, really):
+        closes.append(really)
+        close_connection(db, really)
+
+    monkeypatch.setattr(dbpool, "_close_connection", record_close)
+    pool = ConnectionManager(database, pool_size=2)
+    calls = []
+
+    def query():
+        calls.append(len(calls))
+        if len(calls) == 1:
+            raise GoneAway(2006, "MySQL server has gone away")
+        return database(database.t80oa).count()
+
+    assert pool.run(query) == 0
+    assert calls == [0, 1]
+    # The broken connection is closed, not sent back to the pool, and the
+    # new one goes back to the pool.
+    assert closes == [True, False]
+    stats = pool.stats()
+    assert stats['reconnects'] == 1
+    assert stats['errors'] == 1
+    assert stats['in_use'] == 0
+    assert stats['checkouts'] == 2
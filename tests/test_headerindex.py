@@ -0,0 +1,63 @@
+import os
+
+import numpy as np
+from astropy.io import fits
+
+from headerindex import HeaderIndex
+from headerscan import HeaderScanner, HeaderRecord, EXPTIME_KEY
+
+
+def write_image(path, tile, shape=(4, 4)):
+    header = fits.Header()
+    header['OBJECT'] = tile
+    header[EXPTIME_KEY] = 30.0
+    fits.PrimaryHDU(np.zeros(shape, dtype=np.int16),
+                    header=header).writeto(path, overwrite=True)
+
+
+def test_entry_is_invalid_when_size_or_mtime_change(tmp_path):
+    index = HeaderIndex(str(tmp_path / "index.sqlite"))
+    record = HeaderRecord("img.", "/raw/img.fits", 0, "T1", 1.0, 2.0, 30.0,
+                          None)
+    index.put(record, 100, 5)
+    index.commit()
+    assert index.get("/raw/img.fits", 100, 5) == record
+    assert index.get("/raw/img.fits", 101, 5) is None
+    assert index.get("/raw/img.fits", 100, 6) is None
+    assert index.find("img.") == record
+    assert index.find("other.") is None
+
+    # The new entry replaces the old one.
+    index.put(record._replace(object="T2"), 101, 6)
+    index.close()
+    index = HeaderIndex(str(tmp_path / "index.sqlite"))
+    assert len(index) == 1
+    assert index.get("/raw/img.fits", 101, 6).object == "T2"
+    assert index.get("/raw/img.fits", 100, 5) is None
+
+
+def test_scanner_reads_again_the_changed_images(tmp_path):
+    raw = tmp_path / "raw"
+    raw.mkdir()
+    path = str(raw / "img.fits")
+    write_image(path, "T1")
+    index = HeaderIndex(str(tmp_path / "index.sqlite"))
+    scanner = HeaderScanner(str(raw), index=index)
+    assert scanner.scan(["img."])[0].object == "T1"
+    assert len(index) == 1
+
+    # The index is used while the image does not change.
+    index.put(index.find("img.")._replace(object="cached"),
+              os.path.getsize(path), os.stat(path).st_mtime_ns)
+    assert scanner.scan(["img."])[0].object == "cached"
+
+    # A new image of another size.
+    write_image(path, "T2", shape=(40, 40))
+    assert scanner.scan(["img."])[0].object == "T2"
+
+    # The same size, with a new modification time.
+    write_image(path, "T3", shape=(40, 40))
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert scanner.scan(["img."])[0].object == "T3"
+    assert len(index) == 1
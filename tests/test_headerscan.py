@@ -0,0 +1,95 @@
+import sqlite3
+
+import numpy as np
+from astropy.io import fits
+
+from headerscan import HeaderScanner, EXPTIME_KEY, read_headers
+
+
+class BrokenIndex(object):
+    """
+    A HeaderIndex whose sqlite file is locked.
+    """
+
+    def __getattr__(self, name):
+        def locked(*args):
+            raise sqlite3.OperationalError("database is locked")
+        return locked
+
+
+def test_index_errors_fall_back_to_the_fits_header(tmp_path):
+    header = fits.Header()
+    header['OBJECT'] = "T1"
+    header[EXPTIME_KEY] = 30.0
+    fits.PrimaryHDU(np.zeros((4, 4), dtype=np.int16),
+                    header=header).writeto(str(tmp_path / "img.fits"))
+
+    scanner = HeaderScanner(str(tmp_path), index=BrokenIndex(),
+                            trust_index=True)
+    record, = scanner.scan(["img."])
+    assert record.error is None
+    assert record.object == "T1"
+    assert record.exptime == 30.0
+
+
+def science_header(tile):
+    header = fits.Header()
+    header['OBJECT'] = tile
+    header['CRVAL1'] = 10.5
+    header['CRVAL2'] = -20.25
+    header[EXPTIME_KEY] = 60.0
+    return header
+
+
+def test_compressed_image_header(tmp_path):
+    path = str(tmp_path / "img.fits.fz")
+    data = np.arange(35 * 21, dtype=np.int16).reshape(35, 21)
+    fits.HDUList([fits.PrimaryHDU(),
+                  fits.CompImageHDU(data, science_header("T1"))]).writeto(
+                      path)
+
+    hdu, header = read_headers(path)
+    assert hdu == 1
+    expected = fits.getheader(path, 1, disable_image_compression=True)
+    assert list(header.items()) == list(expected.items())
+    # The keys read by the bot are those of the decompressed image.
+    image = fits.getheader(path, 1)
+    for key in ('OBJECT', 'CRVAL1', 'CRVAL2', EXPTIME_KEY):
+        assert header[key] == image[key]
+
+
+def test_multi_hdu_image_headers(tmp_path):
+    path = str(tmp_path / "img.fits")
+    # Data units that do not fill their last block, so the scan must skip
+    # the padding.
+    fits.HDUList([fits.PrimaryHDU(np.ones((7, 5), dtype=np.float32)),
+                  fits.ImageHDU(np.ones((13, 3), dtype=np.int16),
+                                science_header("T2"))]).writeto(path)
+
+    hdu, header = read_headers(path)
+    assert hdu == 1
+    assert list(header.items()) == list(fits.getheader(path, 1).items())
+
+    record, = HeaderScanner(str(tmp_path)).scan(["img."])
+    assert (record.hdu, record.object, record.crval1, record.crval2,
+            record.exptime) == (1, "T2", 10.5, -20.25, 60.0)
+
+
+def test_data_units_with_heap_are_skipped(tmp_path):
+    path = str(tmp_path / "img.fits.fz")
+    header = science_header("T3")
+    del header[EXPTIME_KEY]
+    fits.HDUList([fits.PrimaryHDU(),
+                  fits.CompImageHDU(np.ones((30, 30), dtype=np.int32),
+                                    header),
+                  fits.ImageHDU(np.ones((2, 2)), science_header("T4"))
+                  ]).writeto(path)
+
+    hdu, header = read_headers(path, max_hdus=3)
+    assert hdu == 2
+    assert list(header.items()) == list(fits.getheader(path, 2).items())
+
+    # Without the exposure time in the first HDUs, the HDU 1 is used.
+    hdu, header = read_headers(path, max_hdus=2)
+    assert hdu == 1
+    assert header['OBJECT'] == "T3"
@@ -0,0 +1,74 @@
+from datetime import date, datetime, timedelta
+
+from jobqueue import JobQueue, QUEUED, RUNNING, FAILED
+from reductiondag import MASTERS_TILE
+
+
+def later(queue):
+    return datetime.now() + timedelta(seconds=queue.lease_seconds + 1)
+
+
+def test_expired_lease_is_claimed_by_another_worker(database):
+    queue = JobQueue(database, lease_seconds=60, max_attempts=3)
+    queue.create_table()
+    day = date(2026, 10, 17)
+    assert queue.enqueue(["T1"], day, day, ["R"]) == 3
+
+    job = queue.claim("w1")
+    assert (job.TileName, job.Filter) == (MASTERS_TILE, "")
+    # The flats wait for the bias.
+    assert queue.claim("w2") is None
+
+    assert queue.requeue_expired() == (0, 0)
+    assert queue.requeue_expired(later(queue)) == (1, 0)
+    assert database.t80jobqueue[job.id].Status == QUEUED
+
+    again = queue.claim("w2")
+    assert again.id == job.id
+    assert again.Worker == "w2"
+    assert again.Attempts == 2
+    # The first worker lost the job.
+    assert not queue.heartbeat(job.id, "w1")
+    assert not queue.finish(job.id, "w1", 0)
+    assert queue.heartbeat(job.id, "w2")
+    assert database.t80jobqueue[job.id].Status == RUNNING
+
+
+def test_expired_lease_fails_after_max_attempts(database):
+    queue = JobQueue(database, lease_seconds=60, max_attempts=1)
+    queue.create_table()
+    day = date(2026, 10, 17)
+    queue.enqueue(["T1"], day, day, ["R"])
+
+    job = queue.claim("w1")
+    # The jobs that depend on the bias fail with it.
+    assert queue.requeue_expired(later(queue)) == (0, 3)
+    assert [row.Status for row in queue.jobs()] == [FAILED] * 3
+    assert queue.claim("w2") is None
+
+    # A failed job is queued again by a new enqueue.
+    assert queue.enqueue(["T1"], day, day, ["R"]) == 3
+    assert queue.claim("w2").id == job.id
+
+
+def test_ensure_table_creates_the_table_and_its_new_columns(database):
+    queue = JobQueue(database)
+    database.executesql("DROP TABLE t80jobqueue")
+    assert queue.existing_columns() is None
+    assert queue.ensure_table() == []
+    assert "dependson" in [column.lower()
+                           for column in queue.existing_columns()]
+
+    # The table of the first version, without DependsOn.
+    database.executesql("DROP TABLE t80jobqueue")
+    database.executesql(
+        "CREATE TABLE t80jobqueue (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "TileName CHAR(45), Filter CHAR(10), StartDate DATE, EndDate DATE, "
+        "Status INTEGER, Worker CHAR(64), Attempts INTEGER, "
+        "ExitStatus INTEGER, LeaseExpires TIMESTAMP, Heartbeat TIMESTAMP, "
+        "DateInsert TIMESTAMP)")
+    assert queue.ensure_table() == [
+        "ALTER TABLE t80jobqueue ADD COLUMN DependsOn INTEGER;"]
+    assert queue.ensure_table() == []
+    day = date(2026, 10, 17)
+    assert queue.enqueue(["T1"], day, day, ["R"]) == 3
@@ -0,0 +1,122 @@
+import os
+import time
+import signal
+import threading
+
+import pytest
+
+from reductionbott80s import ReductionBotT80S
+from tilescheduler import TileScheduler
+
+
+def alive(pid):
+    try:
+        with open("/proc/{}/stat".format(pid)) as fin:
+            stat = fin.read()
+    except (IOError, OSError):
+        return False
+    return stat[stat.rfind(')') + 2] != "Z"
+
+
+def test_interrupted_bot_terminates_the_running_reductions(database,
+                                                           tmp_path):
+    bot = ReductionBotT80S("test", "test@localhost", work_dir=str(tmp_path))
+    pid_file = tmp_path / "pid"
+    scheduler = TileScheduler(4, 100000, poll_interval=0.1)
+    # The recipe starts its own children, as runcf.py and the coadds.
+    scheduler.submit("T1", "sleep 60 & echo $! > {}; wait".format(pid_file))
+
+    timer = threading.Timer(1.0, os.kill, (os.getpid(), signal.SIGINT))
+    timer.start()
+    with pytest.raises(KeyboardInterrupt):
+        bot._run_scheduler(scheduler)
+    timer.join()
+
+    pid = int(pid_file.read_text())
+    deadline = time.time() + 5
+    while alive(pid) and time.time() < deadline:
+        time.sleep(0.1)
+    assert not alive(pid)
+
+
+class FakeResult(object):
+
+    def __init__(self, returncode):
+        self.returncode = returncode
+        self.ok = returncode == 0
+
+
+class FakeRunner(object):
+
+    def __init__(self, returncode=0):
+        self.returncode = returncode
+        self.commands = []
+
+    def run(self, commands, timeout=None, log_file=None):
+        self.commands.extend(command for _, command in commands)
+        return [FakeResult(self.returncode) for _ in commands]
+
+
+def test_masters_are_built_once_per_night(database, tmp_path):
+    bot = ReductionBotT80S("test", "test@localhost", work_dir=str(tmp_path),
+                           recipe="dag")
+    bot._recipe_runner = FakeRunner()
+    assert bot._build_masters({"T1": ["R"]}, "2026-10-03", "2026-10-18")
+    assert bot._build_masters({"T2": ["R"]}, "2026-10-03", "2026-10-18")
+    assert len(bot._recipe_runner.commands) == 1
+    # A filter not built yet, and a new night, build the masters again.
+    assert bot._build_masters({"T3": ["I"]}, "2026-10-03", "2026-10-18")
+    assert bot._build_masters({"T1": ["R"]}, "2026-10-04", "2026-10-19")
+    assert len(bot._recipe_runner.commands) == 3
+    assert bot._build_masters({"T1": ["I"]}, "2026-10-04", "2026-10-19")
+    assert len(bot._recipe_runner.commands) == 4
+
+
+def test_triggered_tiles_not_reduced_are_tried_again(database, tmp_path,
+                                                     monkeypatch):
+    bot = ReductionBotT80S("test", "test@localhost", work_dir=str(tmp_path))
+    bot._recipe_runner = FakeRunner(returncode=1)
+    searched = []
+
+    def insert_tiles_info(**kwargs):
+        searched.append((kwargs['start_date'], kwargs['end_date']))
+        return [tile for tile in ["T1", "T2"] if tile in kwargs['only']]
+
+    monkeypatch.setattr(bot, "_insert_tiles_info", insert_tiles_info)
+    # The masters failed, no tile was reduced.
+    assert bot._start_reduction(only=["T1", "T2", "T3"]) == ["T1", "T2"]
+    assert searched == [bot._calibration_window()]
+
+    class Watcher(object):
+
+        def __init__(self):
+            self.deferred = []
+
+        def poll(self):
+            return ["T1", "T2"]
+
+        def defer(self, tiles):
+            self.deferred.extend(tiles)
+
+    bot._watcher = Watcher()
+    bot._poll_seconds = 300
+    monkeypatch.setattr(bot, "_check_calibrations", lambda: False)
+    bot._poll_new_data()
+    assert bot._watcher.deferred == ["T1", "T2"]
+
+    bot._watcher.deferred = []
+    monkeypatch.setattr(bot, "_check_calibrations", lambda: True)
+    monkeypatch.setattr(bot, "_start_reduction", lambda only: ["T2"])
+    bot._poll_new_data()
+    assert bot._watcher.deferred == ["T2"]
+
+
+def test_job_queue_rejects_the_recipe_options(database, tmp_path):
+    with pytest.raises(ValueError):
+        ReductionBotT80S("test", "test@localhost", work_dir=str(tmp_path),
+                         job_queue=True, reuse_masters=True)
+    database.executesql("DROP TABLE t80jobqueue")
+    bot = ReductionBotT80S("test", "test@localhost", work_dir=str(tmp_path),
+                           job_queue=True)
+    # The bot created the table on start.
+    assert bot._db_pool.run(bot._queue.existing_columns) is not None
@@ -0,0 +1,67 @@
+from checkpoints import CheckpointStore
+from reductiondag import DagExecutor, build_reduction_graph
+from reductiondag import DONE, FAILED, SKIPPED
+
+
+def test_failure_skips_only_the_dependent_nodes():
+    dag = DagExecutor()
+    dag.add("bias", "true")
+    dag.add("flat_R", "false", deps=["bias"])
+    dag.add("flat_I", "true", deps=["bias"])
+    dag.add("cosmet_R", "true", deps=["flat_R"])
+    dag.add("coadd_R", "true", deps=["cosmet_R"])
+    dag.add("cosmet_I", "true", deps=["flat_I"])
+
+    assert dag.run() is False
+    status = dict((node.name, node.status) for node in dag.nodes())
+    assert status == {"bias": DONE,
+                      "flat_R": FAILED,
+                      "flat_I": DONE,
+                      "cosmet_R": SKIPPED,
+                      "coadd_R": SKIPPED,
+                      "cosmet_I": DONE}
+    assert dag.node("cosmet_R").returncode is None
+
+
+def test_rebuilt_node_resets_the_checkpoints_of_its_dependents(tmp_path):
+    store = CheckpointStore(str(tmp_path / "checkpoints.sqlite"))
+    period = ("2026-10-01", "2026-10-18")
+    store.mark_done("T1", "validate", period, "R")
+    store.mark_done("T1", "coadd", period, "I")
+
+    dag = DagExecutor(checkpoints=store, checkpoint_key=("T1", period))
+    dag.add("flat_R", "true", checkpoint=("flat", "R"))
+    dag.add("validate_R", "true", deps=["flat_R"],
+            checkpoint=("validate", "R"))
+    dag.add("coadd_I", "false", checkpoint=("coadd", "I"))
+
+    assert dag.run() is True
+    assert dag.node("validate_R").returncode == 0
+    assert dag.node("coadd_I").returncode is None
+
+
+def test_phases_split_the_recipe():
+    names = dict((phase, [node.name for node in build_reduction_graph(
+        "2026-10-01", "2026-10-18", "inst", "T1", "NAME", filters=["R"],
+        phase=phase).nodes()]) for phase in (None, "masters", "tile"))
+    assert names["masters"] == ["invalidate", "bias", "validate_bias",
+                                "flat_R", "validate_R"]
+    assert names["tile"] == ["cosmet_R", "coadd_R"]
+    assert names[None] == names["masters"] + names["tile"]
+
+
+def test_bias_without_window_is_not_built():
+    period = ("2026-10-01", "2026-10-18")
+    names = [node.name for node in build_reduction_graph(
+        period[0], period[1], "inst", "T1", "NAME", filters=[],
+        windows={}, phase="masters").nodes()]
+    assert names == []
+
+    dag = build_reduction_graph(
+        period[0], period[1], "inst", "T1", "NAME", filters=["R"],
+        windows={("BIAS", None): ("2026-10-15", "2026-10-18")},
+        phase="masters")
+    assert [node.name for node in dag.nodes()] == [
+        "invalidate", "bias", "validate_bias", "flat_R", "validate_R"]
+    assert "-s 2026-10-15 -e 2026-10-18" in dag.node("bias").command
+    assert "-s 2026-10-01 -e 2026-10-18" in dag.node("flat_R").command
@@ -0,0 +1,19 @@
+from schemaindexes import capture_queries, create_missing_indexes
+from schemaindexes import missing_indexes
+
+
+def test_missing_indexes_are_created_once(database):
+    missing = missing_indexes(database, tables=["t80oa"])
+    assert ("t80oa", "idx_t80oa_object", ("Object",)) in missing
+    assert all(tablename == "t80oa" for tablename, _, _ in missing)
+
+    statements = create_missing_indexes(database)
+    assert len(statements) >= len(missing)
+    assert missing_indexes(database) == []
+    assert create_missing_indexes(database) == []
+
+
+def test_capture_queries_returns_the_selects(database):
+    queries = capture_queries(lambda: database(database.t80oa).select())
+    # Newer pyDAL versions also test the connection with SELECT 1.
+    assert [sql for sql in queries if "t80oa" in sql] == queries[-1:]
@@ -0,0 +1,107 @@
+import json
+from datetime import date, datetime, timedelta
+
+from dimensions import DIMENSIONS
+from searchimages import count_images, count_images_bulk, search_tiles
+from searchimages import IncrementalImageCounter
+
+
+def insert_image(database, name, frametype, filt, day, **fields):
+    database.t80oa.insert(Name=name,
+                          ImageType_ID=DIMENSIONS.id_of('frametype',
+                                                        frametype),
+                          Filter_ID=DIMENSIONS.id_of('filter', filt),
+                          Date=day,
+                          **fields)
+    database.commit()
+
+
+def test_search_tiles_uses_the_first_image_of_each_tile(database):
+    day = date(2026, 10, 17)
+    insert_image(database, "a.fits", "SCIE", "R", day, Object="T2",
+                 RA=359.9, DEC=-1.0, RADECsys_ID=1)
+    insert_image(database, "b.fits", "SCIE", "I", day, Object="T1",
+                 RA=10.0, DEC=5.0, RADECsys_ID=1)
+    insert_image(database, "c.fits", "SCIE", "I", day, Object="T2",
+                 RA=0.1, DEC=-1.2, RADECsys_ID=2)
+    insert_image(database, "d.fits", "SCIE", "R", day)
+
+    tiles, missing = search_tiles(day, day, ["R", "I"])
+    tiles = [(tile, float(ra), float(dec), radecsys)
+             for tile, ra, dec, radecsys in tiles]
+    assert tiles == [("T2", 359.9, -1.0, 1), ("T1", 10.0, 5.0, 1)]
+    assert missing == ["d.fits"]
+
+
+def test_count_images_bulk_matches_count_images(database):
+    day = date(2026, 10, 17)
+    insert_image(database, "bias1.fits", "BIAS", "R", day)
+    insert_image(database, "bias2.fits", "BIAS", "I", day)
+    insert_image(database, "flat1.fits", "FLAS", "R", day)
+    insert_image(database, "flat2.fits", "FLAS", "R", day)
+    insert_image(database, "flat3.fits", "FLAS", "I", day)
+    insert_image(database, "flat4.fits", "FLAS", "I", date(2026, 10, 20))
+    insert_image(database, "sci1.fits", "SCIE", "R", day)
+
+    filters = ["R", "I", "Z"]
+    counts = count_images_bulk(day, day, ["BIAS", "FLAS", "SCIE"], filters)
+    assert counts.get(("BIAS", None), 0) == count_images(day, day, "BIAS")
+    for frametype in ("FLAS", "SCIE"):
+        for filt in filters:
+            assert counts.get((frametype, filt), 0) == \
+                count_images(day, day, frametype, filt)
+    assert counts[("BIAS", None)] == 2
+    assert counts[("FLAS", "I")] == 1
+
+
+def test_incremental_counts_match_count_images(database, tmp_path):
+    today = date.today()
+    yesterday = today - timedelta(days=1)
+    old = today - timedelta(days=40)
+    inserted = datetime.now() - timedelta(hours=1)
+    for name, frametype, filt, day in [("bias1.fits", "BIAS", "R", yesterday),
+                                       ("flat1.fits", "FLAS", "R", yesterday),
+                                       ("flat2.fits", "FLAS", "I", today),
+                                       ("flat3.fits", "FLAS", "I", old),
+                                       ("sci1.fits", "SCIE", "R", today)]:
+        insert_image(database, name, frametype, filt, day,
+                     UPDATEDATE_OA=inserted)
+
+    state_file = str(tmp_path / "counts.json")
+    counter = IncrementalImageCounter(state_file, retain_days=10,
+                                      frametypes=("BIAS", "FLAS"))
+
+    def check():
+        counts = counter.counts(yesterday, today, ("BIAS", "FLAS"),
+                                ["R", "I"])
+        assert counts.get(("BIAS", None), 0) == count_images(
+            yesterday, today, "BIAS")
+        for filt in ("R", "I"):
+            assert counts.get(("FLAS", filt), 0) == count_images(
+                yesterday, today, "FLAS", filt)
+
+    assert counter.update() == 4
+    check()
+    # Only the counted frame types are saved.
+    with open(state_file) as fin:
+        assert len(json.load(fin)['images']) == 3
+
+    # A new flat, and a flat classified again as a science image.
+    insert_image(database, "flat4.fits", "FLAS", "R", today)
+    flat2 = database(database.t80oa.Name == "flat2.fits").select().first()
+    flat2.update_record(ImageType_ID=DIMENSIONS.id_of('frametype', 'SCIE'),
+                        UPDATEDATE_OA=datetime.now())
+    database.commit()
+    counter.update()
+    check()
+    assert counter.count(yesterday, today, "FLAS", "I") == 0
+
+    # The state file is not written when nothing changed.
+    mtime = tmp_path.joinpath("counts.json").stat().st_mtime_ns
+    counter.update()
+    assert tmp_path.joinpath("counts.json").stat().st_mtime_ns == mtime
+
+    reloaded = IncrementalImageCounter(state_file, retain_days=10,
+                                       frametypes=("BIAS", "FLAS"))
+    assert reloaded.counts(yesterday, today, ("BIAS", "FLAS")) == \
+        counter.counts(yesterday, today, ("BIAS", "FLAS"))
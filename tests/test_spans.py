@@ -0,0 +1,56 @@
+import json
+
+import pytest
+
+from spans import SpanRecorder, OK, ERROR
+
+
+def test_spans_round_trip_through_jsonl_and_prometheus(tmp_path):
+    recipe_file = str(tmp_path / "spans_T1.jsonl")
+    recipe = SpanRecorder(jsonl_file=recipe_file)
+    recipe.add("bias", 100.0, 110.0, tile="T1", nframes=5)
+    recipe.add("coadd", 110.0, 150.0, ERROR, tile="T1")
+    with open(recipe_file, 'a') as fout:
+        # A span without duration, and a broken line.
+        fout.write('{"stage": "bias", "start": 200, "end": 204}\n')
+        fout.write('{"stage": \n')
+
+    bot_file = str(tmp_path / "spans.jsonl")
+    prom_file = str(tmp_path / "bot.prom")
+    bot = SpanRecorder(jsonl_file=bot_file, prom_file=prom_file)
+    with pytest.raises(RuntimeError):
+        with bot.span("tile_discovery") as attrs:
+            attrs['ntiles'] = 2
+            raise RuntimeError("no database")
+    assert bot.load(recipe_file) == 3
+
+    with open(bot_file) as fin:
+        spans = [json.loads(line) for line in fin]
+    assert [(span['stage'], span['status']) for span in spans] == [
+        ("tile_discovery", ERROR), ("bias", OK), ("coadd", ERROR),
+        ("bias", OK)]
+    assert spans[0]['ntiles'] == 2
+    assert spans[1]['nframes'] == 5
+    assert spans[3]['duration'] == 4.0
+
+    # The recipe file is removed, so its spans are loaded once.
+    assert bot.load(recipe_file) == 0
+    assert bot.totals()['bias'] == {'count': 2, 'seconds': 14.0,
+                                    'errors': 0, 'last': 4.0,
+                                    'last_end': 204.0}
+
+    bot.write_prometheus()
+    with open(prom_file) as fin:
+        text = fin.read()
+    assert text == bot.prometheus()
+    metrics = dict(line.rsplit(" ", 1) for line in text.splitlines()
+                   if not line.startswith("#"))
+    assert float(metrics['t80s_bot_stage_duration_seconds_sum'
+                         '{stage="bias"}']) == 14.0
+    assert float(metrics['t80s_bot_stage_duration_seconds_count'
+                         '{stage="coadd"}']) == 1
+    assert float(metrics['t80s_bot_stage_failures_total'
+                         '{stage="coadd"}']) == 1
+    assert float(metrics['t80s_bot_stage_last_end_timestamp_seconds'
+                         '{stage="bias"}']) == 204.0
+    assert "# TYPE t80s_bot_stage_duration_seconds summary" in text
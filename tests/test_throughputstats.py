@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from throughputstats import aggregate, group_percentiles, scaling_exponent
+
+
+def test_group_percentiles_match_numpy():
+    rng = np.random.RandomState(3)
+    codes = rng.randint(0, 4, 200)
+    values = rng.exponential(100.0, 200)
+    values[::7] = np.nan
+    # The group 4 has no values.
+    percentiles = (0, 25, 50, 90, 99, 100)
+    result = group_percentiles(codes, values, 5, percentiles)
+
+    assert result.shape == (5, len(percentiles))
+    for group in range(4):
+        group_values = values[(codes == group) & ~np.isnan(values)]
+        assert result[group] == pytest.approx(
+            np.percentile(group_values, percentiles))
+    assert np.isnan(result[4]).all()
+
+
+def test_aggregate_by_key():
+    data = {'filter': np.array(["R", "I", "R", "R", "I"], dtype=object)}
+    values = np.array([1.0, 10.0, 3.0, np.nan, 20.0])
+    groups = aggregate(data, ['filter'], values, (50,))
+    assert groups == [{'group': "I", 'count': 2, 'mean': 15.0, 'p50': 15.0},
+                      {'group': "R", 'count': 2, 'mean': 2.0, 'p50': 2.0}]
+
+
+def test_scaling_exponent_recovers_the_power_law():
+    ncombined = np.arange(1, 41, dtype=float)
+    rng = np.random.RandomState(5)
+    values = 2.0 * ncombined ** 1.5 * rng.lognormal(0.0, 0.01, 40)
+    assert scaling_exponent(ncombined, values) == pytest.approx(1.5, abs=0.01)
+
+    # Few points, or a single number of combined images.
+    assert scaling_exponent(ncombined[:5], values[:5]) is None
+    assert scaling_exponent(np.full(40, 8.0), values) is None
@@ -0,0 +1,57 @@
+from datetime import date
+
+from dimensions import DIMENSIONS
+from tilehashes import InputHashStore, tile_input_hashes, changed_filters
+
+
+def insert_science(database, name, tile, filt, day):
+    database.t80oa.insert(Name=name,
+                          ImageType_ID=DIMENSIONS.id_of('frametype', 'SCIE'),
+                          Filter_ID=DIMENSIONS.id_of('filter', filt),
+                          Object=tile,
+                          Date=day)
+    database.commit()
+
+
+def changed(store, start_date, end_date):
+    current = tile_input_hashes(["T1", "T2"], ["R", "I"], start_date,
+                                end_date)
+    return changed_filters(["T1", "T2"], ["R", "I"], current,
+                           store.hashes(["T1", "T2"])), current
+
+
+def test_second_run_without_new_frames_skips_the_tile(database, tmp_path):
+    store = InputHashStore(str(tmp_path / "hashes.sqlite"))
+    insert_science(database, "a.fits", "T1", "R", date(2026, 10, 10))
+    insert_science(database, "b.fits", "T1", "I", date(2026, 10, 11))
+
+    tiles, current = changed(store, "2026-10-01", "2026-10-15")
+    assert tiles == {"T1": ["R", "I"]}
+    store.save(current)
+
+    tiles, _ = changed(store, "2026-10-01", "2026-10-15")
+    assert tiles == {}
+
+    insert_science(database, "c.fits", "T1", "I", date(2026, 10, 12))
+    tiles, _ = changed(store, "2026-10-01", "2026-10-15")
+    assert tiles == {"T1": ["I"]}
+
+
+def test_frames_outside_the_period_are_not_hashed(database, tmp_path):
+    store = InputHashStore(str(tmp_path / "hashes.sqlite"))
+    insert_science(database, "a.fits", "T1", "R", date(2026, 10, 10))
+    _, current = changed(store, "2026-10-01", "2026-10-15")
+    store.save(current)
+
+    insert_science(database, "old.fits", "T1", "R", date(2026, 9, 1))
+    tiles, _ = changed(store, "2026-10-01", "2026-10-15")
+    assert tiles == {}
+
+
+def test_hashes_are_kept_in_the_file(tmp_path):
+    filename = str(tmp_path / "hashes.sqlite")
+    store = InputHashStore(filename)
+    store.save({("T1", "R"): "abc"})
+    store.close()
+    hashes = InputHashStore(filename).hashes(["T1", "T2"])
+    assert hashes == {("T1", "R"): "abc"}
@@ -0,0 +1,66 @@
+import tilescheduler
+from tilescheduler import TileJob, TileScheduler
+
+
+def running_job(name, cpus, memory_mb, rss_mb=0.0):
+    job = TileJob(name, "true", cpus, memory_mb)
+    job.rss_mb = rss_mb
+    job.peak_rss_mb = rss_mb
+    return job
+
+
+def test_admission_respects_the_cpu_and_memory_budget(monkeypatch):
+    monkeypatch.setattr(tilescheduler, "available_memory_mb", lambda: None)
+    scheduler = TileScheduler(8, 10000, job_cpus=4, job_memory_mb=4000)
+
+    big = scheduler.submit("big", "true", cpus=16, memory_mb=50000)
+    # A job larger than the budget runs alone.
+    assert scheduler._next_job() is big
+    scheduler._pending.remove(big)
+
+    scheduler._running.append(running_job("T1", 4, 4000))
+    job = scheduler.submit("T2", "true")
+    assert scheduler._next_job() is job
+
+    scheduler._running.append(running_job("T3", 4, 4000))
+    # All the CPUs are reserved.
+    assert scheduler._next_job() is None
+
+    scheduler._running.pop()
+    scheduler._running[0].peak_rss_mb = 7000
+    # The observed peak of T1 leaves no memory for the estimate of T2.
+    assert scheduler._next_job() is None
+
+
+def test_admission_keeps_memory_for_the_growth_of_running_jobs(monkeypatch):
+    monkeypatch.setattr(tilescheduler, "available_memory_mb", lambda: 5000)
+    scheduler = TileScheduler(16, 100000, job_memory_mb=4000)
+    scheduler._running.append(running_job("T1", 4, 3000, rss_mb=1000))
+    scheduler.submit("T2", "true")
+    # T1 may still grow 2000 MB, so 4000 MB do not fit in 5000 MB.
+    assert scheduler._next_job() is None
+
+    scheduler._running[0].rss_mb = 3000
+    assert scheduler._next_job() is not None
+
+
+def test_longest_first_fills_the_budget_with_smaller_jobs(monkeypatch):
+    monkeypatch.setattr(tilescheduler, "available_memory_mb", lambda: None)
+    scheduler = TileScheduler(8, 10000, longest_first=True)
+    scheduler._running.append(running_job("T1", 4, 4000))
+    short = scheduler.submit("short", "true", memory_mb=2000, seconds=10)
+    scheduler.submit("long", "true", memory_mb=8000, seconds=100)
+    longest = scheduler.submit("longest", "true", memory_mb=6000,
+                               seconds=200)
+
+    assert scheduler._next_job() is longest
+    scheduler._running[0].peak_rss_mb = 5000
+    # Only the short job fits the memory left by T1.
+    assert scheduler._next_job() is short
+
+    fifo = TileScheduler(8, 10000)
+    fifo._running.append(running_job("T1", 4, 5000))
+    fifo.submit("long", "true", memory_mb=8000, seconds=100)
+    fifo.submit("short", "true", memory_mb=2000, seconds=10)
+    # Without longest_first the queue waits for its first job.
+    assert fifo._next_job() is None
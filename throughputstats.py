@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+# -*- Coding: UTF-8 -*-
+"""
+Historical throughput analytics of the pipeline.
+The stage times of the tiles (the Tim* columns of t80tilesinfo) and the
+master frames of t80cftab are read once, and aggregated with NumPy by
+filter, tile, PROC_VERSION and month. For each stage the report gives the
+percentiles, the trend along the months and how the time scales with the
+number of combined images, flagging the stages that grow faster than
+NCombined.
+"""
+import json
+from datetime import date
+
+import numpy as np
+
+from model import db
+from dimensions import DIMENSIONS
+
+# Stage time columns of t80tilesinfo, in the order of the pipeline.
+TILE_STAGES = ('TimPrepSci', 'TimCompCat', 'TimAstrPho', 'TimCombMed',
+               'TimObjMask', 'TimCombMea', 'TimTilStat', 'TimSingFCat',
+               'TimDualFCat', 'TimTilPSFAnaly', 'TimMaskImp', 'TimTotalTile')
+
+GROUP_KEYS = ('filter', 'tile', 'proc_version', 'month')
+
+PERCENTILES = (50, 90, 99)
+
+# Minimum number of points to fit a trend or a scaling law.
+MIN_POINTS = 10
+
+
+def _column(rows, field, dtype=float):
+    """
+    Return a column of a pyDAL Rows as an array, None values as NaN for
+    float columns.
+    """
+    values = [row[field] for row in rows]
+    if dtype is float:
+        return np.array([np.nan if value is None else float(value)
+                         for value in values])
+    return np.array(values, dtype=object)
+
+
+def _months(dates):
+    """
+    Return the months, as 'yyyy-mm', of a list of dates.
+    """
+    return np.array([None if value is None else
+                     "{0:04d}-{1:02d}".format(value.year, value.month)
+                     for value in dates], dtype=object)
+
+
+def _names(table, ids):
+    return np.array([DIMENSIONS.name_of(table, row_id) or str(row_id)
+                     for row_id in ids], dtype=object)
+
+
+def load_tile_timings(start_date=None, end_date=None):
+    """
+    Return a dictionary of arrays with one element by t80tilesinfo entry:
+    tile, filter, proc_version, month, ncombined, exit_status, and a 2D
+    array times, with one column by stage of TILE_STAGES.
+    """
+    table = db.t80tilesinfo
+    query = table.id > 0
+    if start_date is not None:
+        query &= table.DateInsert >= start_date
+    if end_date is not None:
+        query &= table.DateInsert <= end_date
+
+    fields = [table.TileName, table.Filter_ID, table.PROC_VERSION,
+              table.DateInsert, table.NCombined, table.Exit_Status]
+    fields += [table[stage] for stage in TILE_STAGES]
+    rows = db(query).select(*fields)
+
+    times = np.empty((len(rows), len(TILE_STAGES)))
+    for i, stage in enumerate(TILE_STAGES):
+        times[:, i] = _column(rows, stage)
+    return {'tile': _column(rows, 'TileName', object),
+            'filter': _names('filter', _column(rows, 'Filter_ID', object)),
+            'proc_version': _column(rows, 'PROC_VERSION', object),
+            'month': _months(_column(rows, 'DateInsert', object)),
+            'ncombined': _column(rows, 'NCombined'),
+            'exit_status': _column(rows, 'Exit_Status'),
+            'times': times}
+
+
+def load_master_frames(start_date=None, end_date=None):
+    """
+    Return a dictionary of arrays with one element by t80cftab entry:
+    cftype, filter, proc_version, month, ncombined, exit_status and
+    is_valid.
+    """
+    table = db.t80cftab
+    query = table.id > 0
+    if start_date is not None:
+        query &= table.DateInsert >= start_date
+    if end_date is not None:
+        query &= table.DateInsert <= end_date
+
+    rows = db(query).select(table.CFtype_ID, table.Filter_ID,
+                            table.PROC_VERSION, table.DateInsert,
+                            table.NCombined, table.Exit_Status,
+                            table.is_valid)
+    return {'cftype': _names('frametype', _column(rows, 'CFtype_ID', object)),
+            'filter': _names('filter', _column(rows, 'Filter_ID', object)),
+            'proc_version': _column(rows, 'PROC_VERSION', object),
+            'month': _months(_column(rows, 'DateInsert', object)),
+            'ncombined': _column(rows, 'NCombined'),
+            'exit_status': _column(rows, 'Exit_Status'),
+            'is_valid': _column(rows, 'is_valid')}
+
+
+def group_codes(data, keys):
+    """
+    Return the group labels and, for each element, the code of its group,
+    for the combination of the columns in keys.
+    """
+    columns = [np.array([str(value) for value in data[key]], dtype=object)
+               for key in keys]
+    labels = columns[0]
+    for column in columns[1:]:
+        labels = labels + "/" + column
+    return np.unique(labels, return_inverse=True)
+
+
+def group_percentiles(codes, values, ngroups, percentiles=PERCENTILES):
+    """
+    Return an array (ngroups, len(percentiles)) with the percentiles of the
+    values of each group, with linear interpolation. NaN values are
+    ignored, and groups without values are NaN.
+    """
+    valid = ~np.isnan(values)
+    codes = codes[valid]
+    values = values[valid]
+    order = np.lexsort((values, codes))
+    values = values[order]
+    counts = np.bincount(codes, minlength=ngroups)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    result = np.full((ngroups, len(percentiles)), np.nan)
+    has_values = counts > 0
+    for j, percentile in enumerate(percentiles):
+        position = starts + (counts - 1) * percentile / 100.0
+        low = np.floor(position).astype(int)
+        high = np.ceil(position).astype(int)
+        frac = position - low
+        result[has_values, j] = (values[low[has_values]] *
+                                 (1 - frac[has_values]) +
+                                 values[high[has_values]] *
+                                 frac[has_values])
+    return result
+
+
+def aggregate(data, keys, values, percentiles=PERCENTILES):
+    """
+    Return a list of dictionaries, one by group of the columns in keys, with
+    the number of values, the mean and the percentiles of values.
+    """
+    labels, codes = group_codes(data, keys)
+    ngroups = len(labels)
+    valid = ~np.isnan(values)
+    counts = np.bincount(codes[valid], minlength=ngroups)
+    sums = np.bincount(codes[valid], weights=values[valid],
+                       minlength=ngroups)
+    pvalues = group_percentiles(codes, values, ngroups, percentiles)
+
+    groups = []
+    for i, label in enumerate(labels):
+        if counts[i] == 0:
+            continue
+        group = {'group': label,
+                 'count': int(counts[i]),
+                 'mean': float(sums[i] / counts[i])}
+        for j, percentile in enumerate(percentiles):
+            group['p{}'.format(percentile)] = float(pvalues[i, j])
+        groups.append(group)
+    return groups
+
+
+def monthly_trend(months, values):
+    """
+    Return the monthly medians of values and the relative growth by year
+    of a linear fit to them, or None if there are few months.
+    """
+    valid = ~np.isnan(values) & (months != None)
+    if np.count_nonzero(valid) == 0:
+        return [], None
+    labels, codes = np.unique(months[valid], return_inverse=True)
+    medians = group_percentiles(codes, values[valid], len(labels), (50,))[:, 0]
+    series = list(zip(labels.tolist(), medians.tolist()))
+    if len(labels) < 3:
+        return series, None
+
+    index = np.array([int(label[:4]) * 12 + int(label[5:7])
+                      for label in labels])
+    slope, _ = np.polyfit(index - index[0], medians, 1)
+    level = np.median(medians)
+    if level <= 0:
+        return series, None
+    return series, float(12 * slope / level)
+
+
+def scaling_exponent(ncombined, values):
+    """
+    Return the exponent b of the fit values = a * ncombined ** b, or None
+    if there are few points. b > 1 means that the time grows faster than
+    the number of combined images.
+    """
+    valid = (ncombined > 0) & (values > 0)
+    if np.count_nonzero(valid) < MIN_POINTS or \
+            np.unique(ncombined[valid]).size < 2:
+        return None
+    exponent, _ = np.polyfit(np.log(ncombined[valid]),
+                             np.log(values[valid]), 1)
+    return float(exponent)
+
+
+def stage_report(data, keys=GROUP_KEYS, margin=0.1):
+    """
+    Return a dictionary {stage: report} with, for each stage of the
+    tiles, the aggregation by each key, the monthly trend, the scaling
+    exponent with NCombined and whether it grows faster than NCombined.
+    """
+    report = {}
+    failed = ~np.isnan(data['exit_status']) & (data['exit_status'] != 0)
+    for i, stage in enumerate(TILE_STAGES):
+        values = data['times'][:, i]
+        series, growth = monthly_trend(data['month'], values)
+        exponent = scaling_exponent(data['ncombined'], values)
+        report[stage] = {
+            'count': int(np.count_nonzero(~np.isnan(values))),
+            'failed': int(np.count_nonzero(failed & ~np.isnan(values))),
+            'groups': dict((key, aggregate(data, [key], values))
+                           for key in keys),
+            'monthly_median': series,
+            'growth_per_year': growth,
+            'ncombined_exponent': exponent,
+            'superlinear': exponent is not None and exponent > 1 + margin}
+    return report
+
+
+def master_frame_report(data):
+    """
+    Return the number of master frames, the failure and validity rates and
+    the NCombined percentiles, by month, frame type and filter.
+    """
+    labels, codes = group_codes(data, ['month', 'cftype', 'filter'])
+    ngroups = len(labels)
+    counts = np.bincount(codes, minlength=ngroups)
+    failed = ~np.isnan(data['exit_status']) & (data['exit_status'] != 0)
+    valid = data['is_valid'] == 0
+    nfailed = np.bincount(codes, weights=failed, minlength=ngroups)
+    nvalid = np.bincount(codes, weights=valid, minlength=ngroups)
+    pvalues = group_percentiles(codes, data['ncombined'], ngroups)
+
+    groups = []
+    for i, label in enumerate(labels):
+        group = {'group': label,
+                 'count': int(counts[i]),
+                 'failed': int(nfailed[i]),
+                 'valid': int(nvalid[i])}
+        for j, percentile in enumerate(PERCENTILES):
+            group['ncombined_p{}'.format(percentile)] = float(pvalues[i, j])
+        groups.append(group)
+    return groups
+
+
+def print_report(report, keys):
+    """
+    Print the stage report.
+    """
+    for stage, info in report.items():
+        if info['count'] == 0:
+            continue
+        growth = info['growth_per_year']
+        exponent = info['ncombined_exponent']
+        print("{0}: {1} entries, {2} failed, growth {3} by year, "
+              "NCombined exponent {4}{5}".format(
+                  stage, info['count'], info['failed'],
+                  "-" if growth is None else "{:+.1%}".format(growth),
+                  "-" if exponent is None else "{:.2f}".format(exponent),
+                  "  <- grows faster than NCombined"
+                  if info['superlinear'] else ""))
+        for key in keys:
+            print("    by {}:".format(key))
+            for group in info['groups'][key]:
+                print("        {0:30s} n={1:<6d} mean={2:<9.1f} "
+                      "p50={3:<9.1f} p90={4:<9.1f} p99={5:.1f}".format(
+                          group['group'], group['count'], group['mean'],
+                          group['p50'], group['p90'], group['p99']))
+
+
+if __name__ == "__main__":
+    import argparse
+    PARSER = argparse.ArgumentParser(
+        description="Historical throughput analytics of the pipeline")
+
+    PARSER.add_argument("-s",
+                        help="Start date yyyy-mm-dd",
+                        type=str,
+                        default=None)
+
+    PARSER.add_argument("-e",
+                        help="End date yyyy-mm-dd",
+                        type=str,
+                        default=None)
+
+    PARSER.add_argument("-g",
+                        help="Aggregate the stage times by these keys",
+                        type=str,
+                        nargs='+',
+                        choices=GROUP_KEYS,
+                        default=['filter', 'proc_version', 'month'])
+
+    PARSER.add_argument("-m",
+                        help="Margin over 1 of the NCombined exponent to "
+                             "flag a stage",
+                        type=float,
+                        default=0.1)
+
+    PARSER.add_argument("-o",
+                        help="Save the report in a JSON file",
+                        type=str,
+                        default=None)
+
+    ARGS = PARSER.parse_args()
+    START = date(*map(int, ARGS.s.split('-'))) if ARGS.s else None
+    END = date(*map(int, ARGS.e.split('-'))) if ARGS.e else None
+
+    REPORT = stage_report(load_tile_timings(START, END), ARGS.g, ARGS.m)
+    MASTERS = master_frame_report(load_master_frames(START, END))
+    print_report(REPORT, ARGS.g)
+    print("Master frames by month, type and filter:")
+    for GROUP in MASTERS:
+        print("    {0:30s} n={1:<6d} failed={2:<4d} valid={3:<6d} "
+              "NCombined p50={4:.0f}".format(
+                  GROUP['group'], GROUP['count'], GROUP['failed'],
+                  GROUP['valid'], GROUP['ncombined_p50']))
+
+    if ARGS.o is not None:
+        with open(ARGS.o, 'w') as fout:
+            json.dump({'tiles': REPORT, 'master_frames': MASTERS}, fout,
+                      indent=2)
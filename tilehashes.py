@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- Coding: UTF-8 -*-
+"""
+Raw-input hashes of the tiles, used to skip the reduction of tiles whose
+input frames did not change.
+The hash of a tile and filter is the md5 of the sorted names of its
+science images in t80oa observed in the reduction period. After a
+successful reduction, the bot saves the hashes of the reduced tile in an
+InputHashStore, and the next reductions compare with them.
+"""
+import time
+import hashlib
+import sqlite3
+import threading
+
+from model import db
+from dimensions import DIMENSIONS
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS input_hashes (
+    tile TEXT,
+    filter TEXT,
+    hash TEXT,
+    updated REAL,
+    PRIMARY KEY (tile, filter)
+);
+'''
+
+
+def input_hash(names):
+    """
+    Return the md5 hex digest of a set of image names.
+    """
+    md5 = hashlib.md5()
+    md5.update("\n".join(sorted(names)).encode())
+    return md5.hexdigest()
+
+
+def tile_input_hashes(tiles, filters, start_date=None, end_date=None):
+    """
+    Return a dictionary {(tile, filter): hash} with the hash of the science
+    images of each tile and filter, observed between start_date and
+    end_date if given, using a single query over t80oa. Pairs without
+    images are not in the output.
+    """
+    type_id = DIMENSIONS.id_of('frametype', 'SCIE')
+    filters_ids = DIMENSIONS.ids_of('filter', filters)
+    filters_names = dict((filter_id, filt)
+                         for filt, filter_id in filters_ids.items())
+
+    query = ((db.t80oa.ImageType_ID == type_id)
+             &
+             (db.t80oa.Object.belongs(list(tiles)))
+             &
+             (db.t80oa.Filter_ID.belongs(list(filters_ids.values()))))
+    if start_date is not None:
+        query &= db.t80oa.Date >= start_date
+    if end_date is not None:
+        query &= db.t80oa.Date <= end_date
+    rows = db(query).select(db.t80oa.Object, db.t80oa.Filter_ID,
+                            db.t80oa.Name)
+
+    names = {}
+    for row in rows:
+        key = (row.Object, filters_names[row.Filter_ID])
+        names.setdefault(key, []).append(row.Name)
+
+    return dict((key, input_hash(value)) for key, value in names.items())
+
+
+class InputHashStore(object):
+    """
+    Input hashes of the last successful reduction of each tile and filter,
+    stored in a sqlite file.
+    Attr:
+        filename: The sqlite file. It is created if it does not exist.
+    Optional Attr:
+        timeout: Time, in seconds, waiting for the lock of the file when
+                 other process is writing
+    """
+
+    def __init__(self, filename, timeout=60):
+        self._filename = filename
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(filename, timeout=timeout,
+                                     check_same_thread=False)
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+
+    def hashes(self, tiles):
+        """
+        Return a dictionary {(tile, filter): hash} with the hashes saved
+        for the tiles.
+        """
+        tiles = list(tiles)
+        if len(tiles) == 0:
+            return {}
+        sql = "SELECT tile, filter, hash FROM input_hashes WHERE tile IN "
+        sql += "({})".format(", ".join("?" * len(tiles)))
+        with self._lock:
+            rows = self._conn.execute(sql, tiles).fetchall()
+        return dict(((tile, filt), value) for tile, filt, value in rows)
+
+    def save(self, hashes):
+        """
+        Save the hashes {(tile, filter): hash} of a successful reduction.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO input_hashes VALUES (?, ?, ?, ?)",
+                [(tile, filt, value, now)
+                 for (tile, filt), value in hashes.items()])
+            self._conn.commit()
+
+    def close(self):
+        """
+        Close the sqlite file.
+        """
+        with self._lock:
+            self._conn.close()
+
+
+def changed_filters(tiles, filters, current, stored):
+    """
+    Return a dictionary {tile: [filters]} with the filters of each tile
+    whose current hash, see tile_input_hashes, differs from the stored
+    hash of its last reduction. Filters without images are not reported,
+    and tiles without changes are not in the output.
+    """
+    changed = {}
+    for tile in tiles:
+        for filt in filters:
+            key = (tile, filt)
+            if key in current and current[key] != stored.get(key):
+                changed.setdefault(tile, []).append(filt)
+    return changed
@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+# -*- Coding: UTF-8 -*-
+"""
+Concurrent scheduler for the reduction of tiles.
+Several reductions run at once under a CPU and memory budget. The memory
+of each running reduction, including all the processes started by it, is
+read from /proc, and a new tile is admitted only when the budget allows.
+With the predicted time of each tile, see costmodel.py, the longest tile
+that fits the budget is started first.
+"""
+import os
+import time
+import signal
+import logging
+import subprocess
+from collections import deque
+
+PROC = "/proc"
+
+
+def _read_proc_stat():
+    """
+    Return two dictionaries, {pid: ppid} and {pid: cpu seconds}, for all
+    processes in /proc.
+    """
+    parents = {}
+    cpu = {}
+    ticks = float(os.sysconf('SC_CLK_TCK'))
+    for entry in os.listdir(PROC):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(os.path.join(PROC, entry, "stat")) as fin:
+                stat = fin.read()
+        except (IOError, OSError):
+            continue
+        # The command name may contain spaces, it ends at the last ')'.
+        fields = stat[stat.rfind(')') + 2:].split()
+        pid = int(entry)
+        parents[pid] = int(fields[1])
+        cpu[pid] = (int(fields[11]) + int(fields[12])) / ticks
+    return parents, cpu
+
+
+def _rss_mb(pid):
+    """
+    Return the resident memory, in MB, of a process.
+    """
+    try:
+        with open(os.path.join(PROC, str(pid), "status")) as fin:
+            for line in fin:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError):
+        pass
+    return 0.0
+
+
+def process_tree_usage(pids):
+    """
+    Return a dictionary {pid: (rss in MB, cpu seconds)} with the resources
+    used by each process and all its descendants.
+    """
+    if not os.path.isdir(PROC):
+        return dict((pid, (0.0, 0.0)) for pid in pids)
+
+    parents, cpu = _read_proc_stat()
+    children = {}
+    for child, parent in parents.items():
+        children.setdefault(parent, []).append(child)
+
+    usage = {}
+    for pid in pids:
+        rss = 0.0
+        cpu_time = 0.0
+        stack = [pid]
+        while stack:
+            current = stack.pop()
+            rss += _rss_mb(current)
+            cpu_time += cpu.get(current, 0.0)
+            stack.extend(children.get(current, []))
+        usage[pid] = (rss, cpu_time)
+    return usage
+
+
+def available_memory_mb():
+    """
+    Return the memory available in the machine, in MB, or None if it is
+    not known.
+    """
+    try:
+        with open(os.path.join(PROC, "meminfo")) as fin:
+            for line in fin:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def total_memory_mb():
+    """
+    Return the total memory of the machine, in MB, or None if it is not
+    known.
+    """
+    try:
+        with open(os.path.join(PROC, "meminfo")) as fin:
+            for line in fin:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError):
+        pass
+    return None
+
+
+class TileJob(object):
+    """
+    A reduction command waiting or running in the TileScheduler.
+    Attr:
+        name: Name of the job, usually the tile name
+        command: Shell command
+        cpus: Number of CPUs reserved for the job
+        memory_mb: Memory, in MB, reserved for the job before its usage is
+                   known
+        log_file: File that receives the output of the command
+        seconds: Predicted wall-clock time of the job
+    """
+
+    def __init__(self, name, command, cpus, memory_mb, log_file=None,
+                 seconds=None):
+        self.name = name
+        self.command = command
+        self.cpus = cpus
+        self.memory_mb = memory_mb
+        self.log_file = log_file
+        self.seconds = seconds
+        self.process = None
+        self.start_time = None
+        self.end_time = None
+        self.returncode = None
+        self.rss_mb = 0.0
+        self.peak_rss_mb = 0.0
+        self.cpu_seconds = 0.0
+
+    def reserved_memory_mb(self):
+        """
+        Return the memory reserved for the job: the largest value between
+        the estimate and the peak usage already observed.
+        """
+        return max(self.memory_mb, self.peak_rss_mb)
+
+    def summary(self):
+        """
+        Return a dictionary with the resources used by the job.
+        """
+        wall = None
+        if self.start_time is not None and self.end_time is not None:
+            wall = self.end_time - self.start_time
+        return {'name': self.name,
+                'returncode': self.returncode,
+                'start_time': self.start_time,
+                'end_time': self.end_time,
+                'wall_seconds': wall,
+                'predicted_seconds': self.seconds,
+                'cpu_seconds': self.cpu_seconds,
+                'peak_rss_mb': self.peak_rss_mb}
+
+
+class TileScheduler(object):
+    """
+    Run several reduction commands at once, under a CPU and memory budget.
+    Attr:
+        max_cpus: Number of CPUs that the running jobs can reserve
+        memory_mb: Memory, in MB, that the running jobs can reserve
+    Optional Attr:
+        job_cpus: CPUs reserved by each job
+        job_memory_mb: Initial memory estimate for each job. When a job
+                       ends, the estimate grows to its observed peak.
+        poll_interval: Time, in seconds, between two resource samples
+        longest_first: If True, start the pending job with the longest
+                       predicted time that fits the budget, instead of
+                       the first submitted job
+        logger: logging.Logger used to report the jobs
+        extra: extra dictionary passed to the logger
+    """
+
+    def __init__(self, max_cpus, memory_mb, **kwargs):
+        self._max_cpus = max_cpus
+        self._memory_mb = memory_mb
+        self._job_cpus = kwargs.get('job_cpus', 4)
+        self._job_memory_mb = kwargs.get('job_memory_mb', 8192)
+        self._poll_interval = kwargs.get('poll_interval', 5)
+        self._longest_first = kwargs.get('longest_first', False)
+        self._logger = kwargs.get('logger')
+        self._extra = kwargs.get('extra', {})
+        self._pending = deque()
+        self._running = []
+        self._done = []
+
+    def _log(self, level, info):
+        if self._logger is not None:
+            self._logger.log(level, info, extra=self._extra)
+
+    def submit(self, name, command, cpus=None, memory_mb=None, log_file=None,
+               seconds=None):
+        """
+        Add a command to the queue. The jobs are started in the order they
+        were submitted, or, with longest_first, by their predicted time.
+        """
+        job = TileJob(name,
+                      command,
+                      cpus if cpus is not None else self._job_cpus,
+                      memory_mb,
+                      log_file,
+                      seconds)
+        self._pending.append(job)
+        return job
+
+    def _estimate(self, job):
+        if job.memory_mb is None:
+            return self._job_memory_mb
+        return job.memory_mb
+
+    def _can_start(self, job):
+        if len(self._running) == 0:
+            # A job larger than the budget runs alone.
+            return True
+
+        used_cpus = sum(running.cpus for running in self._running)
+        if used_cpus + job.cpus > self._max_cpus:
+            return False
+
+        reserved = sum(running.reserved_memory_mb()
+                       for running in self._running)
+        needed = self._estimate(job)
+        if reserved + needed > self._memory_mb:
+            return False
+
+        # The running jobs may not be at their peak yet.
+        growth = sum(max(running.reserved_memory_mb() - running.rss_mb, 0)
+                     for running in self._running)
+        available = available_memory_mb()
+        if available is not None and needed + growth > available:
+            return False
+        return True
+
+    def _next_job(self):
+        """
+        Return the next pending job that can start, or None.
+        """
+        if not self._longest_first:
+            if self._pending and self._can_start(self._pending[0]):
+                return self._pending[0]
+            return None
+        # Smaller jobs fill the budget left by the longest ones.
+        for job in sorted(self._pending, key=lambda job: -(job.seconds or 0)):
+            if self._can_start(job):
+                return job
+        return None
+
+    def _start(self, job):
+        job.memory_mb = self._estimate(job)
+        # A new session, so terminate stops the whole process tree of the
+        # recipe and not only its shell.
+        if job.log_file is not None:
+            with open(job.log_file, 'a') as fout:
+                job.process = subprocess.Popen(job.command,
+                                               shell=True,
+                                               stdout=fout,
+                                               stderr=subprocess.STDOUT,
+                                               start_new_session=True)
+        else:
+            job.process = subprocess.Popen(job.command, shell=True,
+                                           start_new_session=True)
+        job.start_time = time.time()
+        self._running.append(job)
+        info = "Starting {0}, reserving {1} CPUs and {2:.0f} MB.".format(
+            job.name, job.cpus, job.reserved_memory_mb())
+        self._log(logging.INFO, info)
+
+    def _sample(self):
+        usage = process_tree_usage([job.process.pid for job in self._running])
+        for job in self._running:
+            rss, cpu_time = usage.get(job.process.pid, (0.0, 0.0))
+            job.rss_mb = rss
+            job.peak_rss_mb = max(job.peak_rss_mb, rss)
+            job.cpu_seconds = max(job.cpu_seconds, cpu_time)
+
+    def _reap(self):
+        for job in list(self._running):
+            returncode = job.process.poll()
+            if returncode is None:
+                continue
+            job.returncode = returncode
+            job.end_time = time.time()
+            self._running.remove(job)
+            self._done.append(job)
+            if job.peak_rss_mb > self._job_memory_mb:
+                self._job_memory_mb = job.peak_rss_mb
+            info = ("{0} finished with exit status {1} in {2:.0f}s, "
+                    "peak memory {3:.0f} MB, {4:.0f} CPU seconds.").format(
+                        job.name, returncode, job.end_time - job.start_time,
+                        job.peak_rss_mb, job.cpu_seconds)
+            self._log(logging.INFO if returncode == 0 else logging.ERROR,
+                      info)
+
+    def run(self):
+        """
+        Run all submitted jobs and return their summaries, in the order
+        they finished.
+        """
+        while self._pending or self._running:
+            self._sample()
+            self._reap()
+            # One job by sample, so the next admission sees its memory.
+            job = self._next_job()
+            if job is not None:
+                self._pending.remove(job)
+                self._start(job)
+            if self._running:
+                time.sleep(self._poll_interval)
+
+        done = [job.summary() for job in self._done]
+        self._done = []
+        return done
+
+    def terminate(self):
+        """
+        Stop all running jobs and drop the pending ones.
+        """
+        self._pending.clear()
+        for job in self._running:
+            try:
+                os.killpg(job.process.pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for job in self._running:
+            job.process.wait()
+        self._reap()